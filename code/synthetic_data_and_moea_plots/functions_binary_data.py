@@ -0,0 +1,94 @@
+##############################################################################################################
+### functions_binary_data.py - python functions for tables of float columns stored as raw little-endian float64
+###     .npy (one contiguous row per column) plus a small json header, read back lazily by memory-mapping
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import numpy as np
+import pandas as pd
+import os
+import json
+from datetime import datetime
+
+
+BINARY_FORMAT_VERSION = 1
+BLOCK_ROWS = 2 ** 16   # rows copied per block when writing
+
+
+
+##########################################################################
+######### create binary table of nRows x columns & write its json header ###########
+############## Returns writable memmap (columns x nRows) #########################################
+##########################################################################
+def open_binary_table(filenameBase, columns, nRows, meta = None, index = None):
+  # file is filenameBase.npy, column-major so each column is contiguous (np.load(mmap_mode='r')[j] is column j, &
+  #   any reader of raw float64 can take column j at byte offset header + 8 * j * nRows). header is filenameBase.json,
+  #   with column names, index (name of column to use as row index, if any) & any other meta (seeds, constants...).
+  #   caller fills the memmap in blocks of rows & flushes.
+  header = {'format_version': BINARY_FORMAT_VERSION, 'dtype': '<f8', 'layout': 'column-major', 'nRows': int(nRows),
+            'columns': list(columns), 'index': index, 'created': datetime.now().isoformat(timespec='seconds')}
+  header.update({} if meta is None else meta)
+  with open(filenameBase + '.json', 'w') as f:
+    json.dump(header, f, indent=2)
+  return (np.lib.format.open_memmap(filenameBase + '.npy', mode='w+', dtype='<f8', shape=(len(columns), nRows)))
+
+
+
+##########################################################################
+######### write dict of equal-length columns (arrays or series) to binary table, in blocks of rows ###########
+############## No return #########################################
+##########################################################################
+def save_binary_table(filenameBase, data, meta = None, index = None, blockRows = BLOCK_ROWS):
+  columns = list(data)
+  nRows = len(data[columns[0]])
+  if (index is not None):
+    # index stored as float64 like other columns, cast back to its own dtype on load
+    meta = dict({} if meta is None else meta, indexDtype=np.asarray(data[index]).dtype.str)
+  table = open_binary_table(filenameBase, columns, nRows, meta, index)
+  for j, col in enumerate(columns):
+    values = np.asarray(data[col])
+    for start in range(0, nRows, blockRows):
+      table[j, start:(start + blockRows)] = values[start:(start + blockRows)]
+  table.flush()
+  del table
+
+
+
+##########################################################################
+######### json header of binary table ###########
+############## Returns dict #########################################
+##########################################################################
+def read_binary_header(filenameBase):
+  with open(filenameBase + '.json', 'r') as f:
+    return (json.load(f))
+
+
+
+##########################################################################
+######### binary table as dataframe of memory-mapped columns (no data read until used, shared across processes) ###########
+############## Returns tuple (dataframe, header dict) #########################################
+##########################################################################
+def load_binary_table(filenameBase, columns = None):
+  # columns are read-only views of the file. new columns can be added to the dataframe as usual.
+  header = read_binary_header(filenameBase)
+  table = np.load(filenameBase + '.npy', mmap_mode='r')
+  if (table.shape != (len(header['columns']), header['nRows'])):
+    raise ValueError(filenameBase + '.npy shape ' + str(table.shape) + ' does not match its header')
+  position = {col: j for j, col in enumerate(header['columns'])}
+  columns = [col for col in header['columns'] if col != header['index']] if columns is None else columns
+  df = pd.DataFrame({col: table[position[col]] for col in columns}, copy=False)
+  if (header['index'] is not None):
+    df.index = pd.Index(np.asarray(table[position[header['index']]]).astype(header.get('indexDtype', '<f8')),
+                        name=header['index'])
+  return (df, header)
+
+
+
+##########################################################################
+######### read table from binary if present, else from text file (e.g. inputs generated before the binary format) ###########
+############## Returns tuple (dataframe, header dict, empty if read from text) #########################################
+##########################################################################
+def load_table(filenameBase, textFilename, **readCsvArgs):
+  if (os.path.exists(filenameBase + '.npy') and os.path.exists(filenameBase + '.json')):
+    return (load_binary_table(filenameBase))
+  return (pd.read_csv(textFilename, **readCsvArgs), {})
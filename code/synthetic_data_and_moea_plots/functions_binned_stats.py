@@ -0,0 +1,48 @@
+##############################################################################################################
+### functions_binned_stats.py - python functions for conditional (binned) statistics of one or more value columns,
+###     from a single sort of the bin codes rather than a masked scan per bin
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import numpy as np
+
+
+
+##########################################################################
+######### per-bin count, mean, std & quantiles for several value columns at once ###########
+############## Returns dict: 'count' (nBins), and per value column a dict of 'mean', 'std' (nBins x ...) & 'quantile' (nBins x nQuantiles x ...) #########################################
+##########################################################################
+def binned_stats(key, values, bins = None, nBins = None, quantiles = (), ddof = 1, total = False):
+  # key is binned by np.digitize if bin edges are given (bin i is [bins[i-1], bins[i]), so nBins = len(bins) + 1),
+  #   else key is integer bin codes 0..nBins-1. values is dict of arrays (n,) or (n, m), stats taken along first axis.
+  #   quantiles are np/pandas 'linear'. empty bins give nan. total=True appends stats over all rows as last bin.
+  if (bins is not None):
+    codes = np.digitize(key, bins)
+    nBins = len(bins) + 1
+  else:
+    codes = np.asarray(key, dtype=int)
+    nBins = codes.max() + 1 if nBins is None else nBins
+  # stable sort of small int codes is a radix sort, O(n)
+  order = np.argsort(codes.astype(np.int16) if nBins < 2 ** 15 else codes, kind='stable')
+  count = np.bincount(codes, minlength=nBins)
+  ends = np.cumsum(count)
+  segments = [slice(end - n, end) for n, end in zip(count, ends)]
+  if (total):
+    segments.append(slice(0, len(codes)))
+    count = np.append(count, len(codes))
+
+  stats = {'count': count}
+  quantiles = np.asarray(quantiles, dtype=float)
+  for name, val in values.items():
+    valSorted = np.asarray(val, dtype=float)[order]
+    shape = valSorted.shape[1:]
+    stats[name] = {'mean': np.full((len(segments),) + shape, np.nan), 'std': np.full((len(segments),) + shape, np.nan),
+                   'quantile': np.full((len(segments), len(quantiles)) + shape, np.nan)}
+    for i, seg in enumerate(segments):
+      valBin = valSorted[seg]
+      if (len(valBin) > 0):
+        stats[name]['mean'][i] = valBin.mean(axis=0)
+        stats[name]['quantile'][i] = np.quantile(valBin, quantiles, axis=0)
+      if (len(valBin) > ddof):
+        stats[name]['std'][i] = valBin.std(axis=0, ddof=ddof)
+  return (stats)
@@ -0,0 +1,194 @@
+##############################################################################################################
+### functions_cache.py - python functions for an on-disk cache of computed results, keyed by a hash of the
+###     input data, all parameters & the source of the code computing them, so results are only recomputed when
+###     their inputs or code change
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import numpy as np
+import pandas as pd
+import os
+import hashlib
+import pickle
+import shutil
+import threading
+
+import functions_data_store
+
+
+CACHE_VERSION = 1                  # part of every key, bump to invalidate all entries
+CACHE_MAX_BYTES = 4 * 2 ** 30      # least recently used entries are evicted beyond this
+CACHE_STATS = {'hits': 0, 'misses': 0, 'invalid': 0, 'evicted': 0}
+CACHE_STATS_LOCK = threading.Lock()   # cached() may run on several threads (pipeline stages)
+
+
+
+##########################################################################
+######### feed arrays, pandas objects, dicts, lists & scalars into a hash, by content ###########
+############## No return, updates sha #########################################
+##########################################################################
+def hash_update(sha, obj):
+  if isinstance(obj, pd.DataFrame):
+    sha.update(b'DataFrame')
+    hash_update(sha, obj.index.values)
+    for col in obj.columns:
+      hash_update(sha, col)
+      hash_update(sha, obj[col].values)
+  elif isinstance(obj, pd.Series):
+    sha.update(b'Series')
+    hash_update(sha, obj.name)
+    hash_update(sha, obj.index.values)
+    hash_update(sha, obj.values)
+  elif isinstance(obj, np.ndarray) and obj.dtype != object:
+    sha.update(('%s%s' % (obj.dtype.str, obj.shape)).encode())
+    sha.update(np.ascontiguousarray(obj).tobytes())
+  elif isinstance(obj, dict):
+    sha.update(b'dict')
+    for key in sorted(obj, key=repr):
+      hash_update(sha, key)
+      hash_update(sha, obj[key])
+  elif isinstance(obj, (list, tuple, np.ndarray)):
+    sha.update(('%s%d' % (type(obj).__name__, len(obj))).encode())
+    for item in obj:
+      hash_update(sha, item)
+  else:
+    sha.update(repr(obj).encode())
+
+
+
+##########################################################################
+######### fingerprint of source code: contents of source files of modules ###########
+############## Returns hex string #########################################
+##########################################################################
+def source_fingerprint(modules):
+  sha = hashlib.sha1()
+  for module in modules:
+    with open(module.__file__, 'rb') as f:
+      sha.update(f.read())
+  return (sha.hexdigest())
+
+
+
+##########################################################################
+######### cache key for a named computation on inputs & params, by code in modules ###########
+############## Returns hex string #########################################
+##########################################################################
+def cache_key(name, inputs, params, code = ()):
+  sha = hashlib.sha1()
+  hash_update(sha, [CACHE_VERSION, name, inputs, params, source_fingerprint(code)])
+  return (sha.hexdigest())
+
+
+
+##########################################################################
+######### add to a cache stats counter, thread safe ###########
+############## No return #########################################
+##########################################################################
+def cache_count(stat, n = 1):
+  with CACHE_STATS_LOCK:
+    CACHE_STATS[stat] += n
+
+
+
+##########################################################################
+######### return cached result of compute() for these inputs & params, else compute & store it ###########
+############## Returns result #########################################
+##########################################################################
+def cached(dir_cache, name, compute, inputs, params, redo = False, save = True, maxBytes = CACHE_MAX_BYTES,
+           code = ()):
+  # inputs/params can be anything hash_update handles. code lists the modules compute depends on (usually the
+  #   caller's own), so editing their source invalidates entries. dicts, dataframes, series & arrays are stored as
+  #   data store datasets (per-column chunk files, see functions_data_store), anything else pickled. entries are
+  #   validated on load (key & checksums), so corrupt or mismatched entries count as misses. hits refresh the entry's
+  #   mtime, for lru eviction. pickled entries of earlier versions are still read.
+  key = cache_key(name, inputs, params, code)
+  dataset = name + '_' + key
+  filename = dir_cache + dataset + '.pkl'
+  if (not redo and functions_data_store.dataset_header(dir_cache, dataset) is not None):
+    try:
+      if (functions_data_store.dataset_header(dir_cache, dataset)['meta']['key'] == key):
+        result = functions_data_store.read_dataset(dir_cache, dataset)
+        os.utime(dir_cache + dataset + '/meta.json')
+        cache_count('hits')
+        return (result)
+    except Exception:
+      pass
+    cache_count('invalid')
+    functions_data_store.delete_dataset(dir_cache, dataset)
+  elif (not redo and os.path.exists(filename)):
+    try:
+      with open(filename, 'rb') as f:
+        entry = pickle.load(f)
+      if (entry['key'] == key and hashlib.sha1(entry['payload']).hexdigest() == entry['checksum']):
+        result = pickle.loads(entry['payload'])
+        os.utime(filename)
+        cache_count('hits')
+        return (result)
+    except Exception:
+      pass
+    cache_count('invalid')
+    if (os.path.exists(filename)):
+      os.remove(filename)
+
+  cache_count('misses')
+  result = compute()
+  if (save):
+    os.makedirs(dir_cache, exist_ok=True)
+    if (isinstance(result, (dict, pd.DataFrame, pd.Series, np.ndarray))):
+      functions_data_store.write_dataset(dir_cache, dataset, result, meta={'key': key, 'name': name})
+    else:
+      payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+      entry = {'key': key, 'name': name, 'checksum': hashlib.sha1(payload).hexdigest(), 'payload': payload}
+      with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(filename + '.tmp', filename)
+    cache_evict(dir_cache, maxBytes)
+  return (result)
+
+
+
+##########################################################################
+######### delete least recently used cache entries until total size is within maxBytes ###########
+############## No return #########################################
+##########################################################################
+def cache_evict(dir_cache, maxBytes = CACHE_MAX_BYTES):
+  # entries are .pkl files & dataset directories (mtime of their meta.json). entries removed meanwhile (e.g. by
+  #   another thread evicting) or still being written (.tmp) are skipped
+  entries = []
+  for f in os.listdir(dir_cache):
+    path = os.path.join(dir_cache, f)
+    try:
+      if (f.endswith('.pkl')):
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+      elif (os.path.isdir(path) and '.tmp' not in f):
+        size = sum(os.path.getsize(os.path.join(path, g)) for g in os.listdir(path))
+        entries.append((os.path.getmtime(os.path.join(path, 'meta.json')), size, path))
+    except FileNotFoundError:
+      pass
+  entries = sorted(entries)
+  totalBytes = sum(size for mtime, size, f in entries)
+  # newest entry is never evicted, even if it alone is over the limit
+  for mtime, size, f in entries[:-1]:
+    if (totalBytes <= maxBytes):
+      break
+    totalBytes -= size
+    try:
+      if (os.path.isdir(f)):
+        shutil.rmtree(f)
+      else:
+        os.remove(f)
+      cache_count('evicted')
+    except FileNotFoundError:
+      pass
+
+
+
+##########################################################################
+######### cache hits/misses so far ###########
+############## Returns string #########################################
+##########################################################################
+def cache_report():
+  with CACHE_STATS_LOCK:
+    return ('cache hits: %d, misses: %d, invalid: %d, evicted: %d' % (CACHE_STATS['hits'], CACHE_STATS['misses'],
+                                                                     CACHE_STATS['invalid'], CACHE_STATS['evicted']))
@@ -0,0 +1,268 @@
+##############################################################################################################
+### functions_data_store.py - python functions for an on-disk store of generated datasets (synthetic series,
+###     cached results): per-column files of compressed row chunks, read lazily by column & row range
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import numpy as np
+import pandas as pd
+import os
+import json
+import zlib
+import pickle
+import shutil
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+STORE_FORMAT_VERSION = 1
+CHUNK_BYTES = 4 * 2 ** 20   # uncompressed bytes per chunk of rows
+COMPRESS_LEVEL = 1          # zlib level. float bytes are shuffled (byte planes) first, which helps much more
+MIN_COMPRESSION = 1.2       # chunks compressing less than this (e.g. continuous random draws) are kept raw
+N_THREADS = 4               # threads (de)compressing chunks, zlib releases the gil
+
+
+
+##########################################################################
+######### compress/decompress a chunk of rows: byte planes shuffled, then zlib, or raw if that doesn't pay ###########
+############## Returns tuple (bytes, compressed flag) / array #########################################
+##########################################################################
+def compress_chunk(values):
+  values = np.ascontiguousarray(values)
+  planes = values.view(np.uint8).reshape(-1, values.dtype.itemsize).T
+  data = zlib.compress(planes.tobytes(), COMPRESS_LEVEL)
+  if (len(data) * MIN_COMPRESSION > values.nbytes):
+    return (values.tobytes(), False)
+  return (data, True)
+
+def decompress_chunk(data, compressed, dtype, shape):
+  dtype = np.dtype(dtype)
+  if (not compressed):
+    return (np.frombuffer(data, dtype=dtype).reshape(shape))
+  planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(dtype.itemsize, -1)
+  return (np.ascontiguousarray(planes.T).view(dtype).reshape(shape))
+
+
+
+##########################################################################
+######### write a dataset: dataframe, series, array, or (nested) dict of them plus other small objects ###########
+############## No return #########################################
+##########################################################################
+def write_dataset(dir_store, name, data, meta = None):
+  # numeric arrays, series & dataframe columns are stored as one file per column, of compressed chunks along the first
+  #   axis (rows), with a crc per chunk. anything else (scalars, object columns, non-str keys...) goes whole into
+  #   attrs.pkl. meta (generator params, seeds...) is kept in meta.json with the layout & creation time. written to a
+  #   temporary directory first, so a dataset is either complete or absent.
+  dirData = dir_store + name + '/'
+  dirTmp = dir_store + name + '.tmp%d_%d/' % (os.getpid(), threading.get_ident())
+  shutil.rmtree(dirTmp, ignore_errors=True)
+  os.makedirs(dirTmp)
+  attrs = {}
+  columns = []
+  layout = _layout(data, '', attrs, columns)
+  executor = ThreadPoolExecutor(max_workers=N_THREADS)
+  try:
+    for i, (node, values) in enumerate(columns):
+      node['file'] = 'c%04d.bin' % i
+      rowBytes = max(values[:1].nbytes, 1)
+      chunkRows = max(CHUNK_BYTES // rowBytes, 1)
+      starts = range(0, values.shape[0], chunkRows)
+      node['chunkRows'] = chunkRows
+      node['chunks'] = []
+      offset = 0
+      with open(dirTmp + node['file'], 'wb') as f:
+        for chunk, compressed in executor.map(compress_chunk, [values[s:(s + chunkRows)] for s in starts]):
+          f.write(chunk)
+          node['chunks'].append([offset, len(chunk), zlib.crc32(chunk), compressed])
+          offset += len(chunk)
+  finally:
+    executor.shutdown()
+  attrsPayload = pickle.dumps(attrs, protocol=pickle.HIGHEST_PROTOCOL)
+  with open(dirTmp + 'attrs.pkl', 'wb') as f:
+    f.write(attrsPayload)
+  nRows = max([values.shape[0] for node, values in columns], default=0)
+  header = {'format_version': STORE_FORMAT_VERSION, 'name': name, 'created': datetime.now().isoformat(timespec='seconds'),
+            'nRows': nRows, 'attrsCrc': zlib.crc32(attrsPayload), 'meta': {} if meta is None else meta, 'layout': layout}
+  with open(dirTmp + 'meta.json', 'w') as f:
+    json.dump(header, f, indent=1, default=_json_default)
+  shutil.rmtree(dirData, ignore_errors=True)
+  os.replace(dirTmp, dirData)
+
+def _layout(data, path, attrs, columns):
+  # layout tree for data, collecting (node, values) of columns to write & objects for attrs
+  if (isinstance(data, dict) and all(isinstance(k, str) and '/' not in k for k in data)):
+    return ({'kind': 'dict', 'items': {k: _layout(v, path + '/' + k, attrs, columns) for k, v in data.items()}})
+  if (isinstance(data, pd.DataFrame) and _numeric(data.dtypes) and all(isinstance(c, str) for c in data.columns)
+      and data.columns.is_unique and _index_storable(data.index)):
+    return ({'kind': 'dataframe', 'columns': {c: _column(data[c].values, columns) for c in data.columns},
+             'index': _index(data.index, columns)})
+  if (isinstance(data, pd.Series) and _numeric([data.dtype]) and _index_storable(data.index)):
+    return ({'kind': 'series', 'name': data.name if isinstance(data.name, (str, int, float)) else None,
+             'values': _column(data.values, columns), 'index': _index(data.index, columns)})
+  if (isinstance(data, np.ndarray) and data.ndim > 0 and _numeric([data.dtype])):
+    return (_column(data, columns))
+  attrs[path] = data
+  return ({'kind': 'attr', 'path': path})
+
+def _numeric(dtypes):
+  return (all(isinstance(d, np.dtype) and d.kind in 'biuf' for d in dtypes))
+
+def _column(values, columns):
+  node = {'kind': 'array', 'dtype': values.dtype.str, 'shape': list(values.shape)}
+  columns.append((node, values))
+  return (node)
+
+def _default_index(index):
+  return (isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1 and index.name is None)
+
+def _index_storable(index):
+  return (_default_index(index) or (index.nlevels == 1 and _numeric([index.dtype])))
+
+def _index(index, columns):
+  # default range index isn't stored
+  if (_default_index(index)):
+    return (None)
+  return ({'name': index.name if isinstance(index.name, str) else None, 'values': _column(index.values, columns)})
+
+def _json_default(obj):
+  if (isinstance(obj, np.generic)):
+    return (obj.item())
+  if (isinstance(obj, np.ndarray)):
+    return (obj.tolist())
+  if (isinstance(obj, (pd.DataFrame, pd.Series))):
+    return (obj.to_dict())
+  return (repr(obj))
+
+
+
+##########################################################################
+######### json-able summary of a fitted model dict for dataset meta: numbers & small arrays only ###########
+############## Returns dict #########################################
+##########################################################################
+def model_meta(model, maxSize = 64):
+  return ({k: v for k, v in model.items() if isinstance(k, str) and isinstance(v, (int, float, np.number, np.ndarray))
+           and np.size(v) <= maxSize})
+
+
+
+##########################################################################
+######### dataset header: meta, creation time, layout ###########
+############## Returns dict, or None if no such dataset #########################################
+##########################################################################
+def dataset_header(dir_store, name):
+  filename = dir_store + name + '/meta.json'
+  if (not os.path.exists(filename)):
+    return (None)
+  with open(filename, 'r') as f:
+    return (json.load(f))
+
+
+
+##########################################################################
+######### read dataset, or only some of it: columns (top-level keys or '/'-paths to nested ones), rows [start, stop) ###########
+############## Returns data as written (dataframe, dict...), restricted to columns & rows #########################################
+##########################################################################
+def read_dataset(dir_store, name, columns = None, rows = None):
+  # rows applies to columns with the dataset's full row count (nRows, the longest column); shorter ones (e.g. a
+  #   params table alongside synthetic series) are read whole. only chunks overlapping rows are read. raises
+  #   ValueError if a chunk or attrs fails its crc check.
+  dirData = dir_store + name + '/'
+  header = dataset_header(dir_store, name)
+  if (header is None):
+    raise FileNotFoundError('no dataset ' + name + ' in ' + dir_store)
+  layout = _select(header['layout'], columns)
+  with open(dirData + 'attrs.pkl', 'rb') as f:
+    attrsPayload = f.read()
+  if (zlib.crc32(attrsPayload) != header['attrsCrc']):
+    raise ValueError('attrs of dataset ' + name + ' failed crc check')
+  attrs = pickle.loads(attrsPayload)
+  executor = ThreadPoolExecutor(max_workers=N_THREADS)
+  try:
+    return (_build(layout, dirData, attrs, header['nRows'], rows, executor))
+  finally:
+    executor.shutdown()
+
+def _select(layout, columns):
+  # prune layout to requested paths, keeping enclosing dicts & dataframes
+  if (columns is None):
+    return (layout)
+  selected = {'kind': layout['kind'], 'items': {}} if layout['kind'] == 'dict' else dict(layout, columns={})
+  for path in columns:
+    keys = path.strip('/').split('/')
+    src, dst = layout, selected
+    for depth, key in enumerate(keys):
+      if (src['kind'] == 'dict'):
+        if (depth == len(keys) - 1):
+          dst['items'][key] = src['items'][key]
+        else:
+          src = src['items'][key]
+          if (key not in dst['items']):
+            dst['items'][key] = {'kind': 'dict', 'items': {}} if src['kind'] == 'dict' else dict(src, columns={})
+          dst = dst['items'][key]
+      elif (src['kind'] == 'dataframe' and depth == len(keys) - 1):
+        dst['columns'][key] = src['columns'][key]
+      else:
+        raise KeyError(path)
+  return (selected)
+
+def _build(node, dirData, attrs, nRows, rows, executor):
+  if (node['kind'] == 'dict'):
+    return ({k: _build(v, dirData, attrs, nRows, rows, executor) for k, v in node['items'].items()})
+  if (node['kind'] == 'attr'):
+    return (attrs[node['path']])
+  if (node['kind'] == 'array'):
+    return (_read_column(node, dirData, nRows, rows, executor))
+  index = None
+  if (node['index'] is not None):
+    index = pd.Index(_read_column(node['index']['values'], dirData, nRows, rows, executor), name=node['index']['name'])
+  if (node['kind'] == 'series'):
+    values = _read_column(node['values'], dirData, nRows, rows, executor)
+    if (index is None):
+      index = pd.RangeIndex(*_row_range(node['values'], nRows, rows))
+    return (pd.Series(values, index=index, name=node['name'], copy=False))
+  data = {c: _read_column(col, dirData, nRows, rows, executor) for c, col in node['columns'].items()}
+  if (index is None):
+    first = node['index']['values'] if node['index'] is not None else next(iter(node['columns'].values()), None)
+    index = pd.RangeIndex(*_row_range(first, nRows, rows)) if first is not None else None
+  return (pd.DataFrame(data, index=index, copy=False))
+
+def _row_range(node, nRows, rows):
+  length = node['shape'][0]
+  if (rows is None or length != nRows):
+    return (0, length)
+  start, stop, step = (rows if isinstance(rows, slice) else slice(*rows)).indices(length)
+  return (start, stop)
+
+def _read_column(node, dirData, nRows, rows, executor):
+  start, stop = _row_range(node, nRows, rows)
+  chunkRows = node['chunkRows']
+  first, last = start // chunkRows, -(-stop // chunkRows)
+  shape = list(node['shape'])
+  values = np.empty([stop - start] + shape[1:], dtype=node['dtype'])
+  if (stop <= start):
+    return (values)
+  with open(dirData + node['file'], 'rb') as f:
+    raw = []
+    for c in range(first, last):
+      offset, nBytes, crc, compressed = node['chunks'][c]
+      f.seek(offset)
+      raw.append(f.read(nBytes))
+      if (zlib.crc32(raw[-1]) != crc):
+        raise ValueError('chunk %d of %s failed crc check' % (c, dirData + node['file']))
+  compressed = [node['chunks'][c][3] for c in range(first, last)]
+  chunkShapes = [[min(chunkRows, shape[0] - c * chunkRows)] + shape[1:] for c in range(first, last)]
+  chunks = executor.map(decompress_chunk, raw, compressed, [node['dtype']] * len(raw), chunkShapes)
+  for c, chunk in zip(range(first, last), chunks):
+    lo, hi = max(start, c * chunkRows), min(stop, (c + 1) * chunkRows)
+    values[(lo - start):(hi - start)] = chunk[(lo - c * chunkRows):(hi - c * chunkRows)]
+  return (values)
+
+
+
+##########################################################################
+######### delete dataset ###########
+############## No return #########################################
+##########################################################################
+def delete_dataset(dir_store, name):
+  shutil.rmtree(dir_store + name + '/', ignore_errors=True)
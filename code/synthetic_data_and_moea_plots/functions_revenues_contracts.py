@@ -6,12 +6,24 @@
 
 import numpy as np
 import pandas as pd
+import os
+import sys
+import hashlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import cm
 import statsmodels.formula.api as sm
 import seaborn as sns
 from scipy import stats as st
-from scipy.optimize import minimize
+from scipy.special import ndtr
+from scipy.interpolate import RegularGridInterpolator
+
+import functions_binary_data
+import functions_binned_stats
+import functions_cache
+import functions_density
+import functions_water_year
 
 
 sns.set_style('white')
@@ -24,86 +36,175 @@ col = [cmap(0.1),cmap(0.3),cmap(0.6),cmap(0.8)]
 N_SAMPLES = 1000000
 eps = 1e-13
 
+# snow index contracts as legs of the payoff registry (PAYOFFS), each with its own lambda (None: lambdaRisk). the cfd
+#   short call side is priced with lambda=0.
+SNOW_CONTRACT_LEGS = {'put': [('put', None)], 'shortcall': [('shortcall', None)],
+                      'cfd': [('put', None), ('shortcall', 0.)]}
+
+PRICING_SURFACE_VERSION = 2  # bump when pricing changes, so saved surfaces are rebuilt
+PRICING_SURFACE_OUTPUTS = ['capX', 'capY', 'premPut', 'premShortCall', 'dPremPut']
+WANG_CACHE_LAMBDAS = 2  # per-lambda distortion weights (& prefix sums) kept on a wang sample
+
+
+
+##########################################################################
+######### get fixed demand, rates, & fraction of surplus sold to mtid for revenue model ###########
+############## Returns dict of revenue model params #########################################
+##########################################################################
+
+def get_revenue_params(gen, hp_GWh, hp_dolPerKwh):
+  ### rel b/w swe/gen and mtid
+  # plt.scatter(hp_GWh.mtid.loc[2010:2016], swe.danWtAvg.loc[2010:2016])
+  # np.corrcoef(hp_GWh.mtid.loc[2010:2016], swe.danWtAvg.loc[2010:2016])
+  # get total amt above muni demand in each yr
+  gen['aboveMuni'] = gen.tot - hp_GWh['M'].iloc[hp_GWh.shape[0] - 1] / 12
+  gen['mtid'] = gen.aboveMuni.apply(lambda x: max(x, 0))
+  # gen.mtid.loc[(gen.wmnth < 7) ] = 0     # assume mtid only buys power Apr-Sept
+  hp_GWh['estMtid'] = np.nan
+  hp_GWh.estMtid.loc[2010:2016] = gen.loc[gen.wyear > 2009, :].groupby('wyear').sum().mtid
+  # plt.scatter(hp_GWh.estMtid.loc[2010:2016], hp_GWh.mtid.loc[2010:2016])
+  # np.corrcoef(hp_GWh.estMtid.loc[2010:2016], hp_GWh.mtid.loc[2010:2016])
+  # reg to get percentage estimated for mtid
+  lmMtid = sm.ols(formula='mtid ~ est-1',
+                  data=pd.DataFrame({'mtid': hp_GWh.mtid.loc[2010:2016], 'est': hp_GWh.estMtid.loc[2010:2016]}))
+  lmMtid = lmMtid.fit()
+  # print(lmMtid.summary())
+
+  # plt.scatter(hp_GWh.estMtid.loc[2010:2016], lmMtid.predict())
+  # gen.mtid = gen.mtid * mtidGrowFrac
+  # gen['aboveMuniMtid'] = np.where(gen.aboveMuni > 0, gen.aboveMuni - gen.mtid, gen.aboveMuni)
+  # plt.plot(gen.wmnth.loc[gen.wyear==2012],gen.aboveMuni.loc[gen.wyear==2012])
+  # plt.plot(gen.aboveMuni)
+  # plt.plot(gen.aboveMuniMtid)
+  # plt.plot(gen.mtid)
+
+  # const monthly muni demand & 2016 rates, with fraction of surplus to mtid from regression above
+  revParams = {'dem_M_GWh': hp_GWh['M'].iloc[hp_GWh.shape[0] - 1] / 12,
+               'mtidFrac': lmMtid.params[0],
+               'rate_DolPerkWh_M': hp_dolPerKwh['M'].iloc[hp_dolPerKwh.shape[0] - 1],
+               'rate_DolPerkWh_mtid': hp_dolPerKwh['mtid'].iloc[hp_dolPerKwh.shape[0] - 1]}
+  return (revParams)
+
+
+
+##########################################################################
+######### revenue model for monthly gen & power price ###########
+############## Returns array of monthly revenues ($M/mnth), same shape as inputs #########################################
+##########################################################################
+
+# revenue model: monthly gen & price, assume const demand to muni, 48% surplus (from regression) to mtid throughout year (only if mtid rate < wholesale).
+# Rest to Wholesale. Also must buy power to meet unmet muni. Works elementwise on arrays of any shape (e.g. (years, 12)).
+def revenue_model_milDollars(sampGen_GWh, sampPow_DolPerkWh, dem_M_GWh, mtidFrac, rate_DolPerkWh_M,
+                             rate_DolPerkWh_mtid):
+  dem_mtid_GWh = np.maximum((sampGen_GWh - dem_M_GWh) * mtidFrac, 0)
+  dem_mtid_GWh = np.where(sampPow_DolPerkWh < rate_DolPerkWh_mtid, 0, dem_mtid_GWh)
+  # dem_mtid_GWh.loc[(dem_mtid_GWh.index % 12 < 6)] = 0  # assume mtid only buys power Apr-Sept
+  rev = (dem_M_GWh * rate_DolPerkWh_M + dem_mtid_GWh * rate_DolPerkWh_mtid + \
+         (sampGen_GWh - dem_M_GWh - dem_mtid_GWh) * sampPow_DolPerkWh)
+  return (rev)  # returns revenues in $Mil
+
+
+
+##########################################################################
+######### tariff/demand scenarios for revenue model: each historical year's muni demand, rates & mtid fraction ###########
+############## Returns dataframe of revenue model params, one row per year (scenario) #########################################
+##########################################################################
+def get_revenue_scenarios(gen, hp_GWh, hp_dolPerKwh, mtidByYear = True):
+  # years without muni/mtid rates on record are left out. mtid fraction is each year's sales over estimated surplus
+  #   where known (2010-2016), else the regression fraction. last row with mtidByYear=False is get_revenue_params.
+  revParams = get_revenue_params(gen, hp_GWh, hp_dolPerKwh)
+  scenarios = pd.DataFrame({'dem_M_GWh': hp_GWh['M'] / 12,
+                            'mtidFrac': revParams['mtidFrac'],
+                            'rate_DolPerkWh_M': hp_dolPerKwh['M'],
+                            'rate_DolPerkWh_mtid': hp_dolPerKwh['mtid']})
+  if (mtidByYear):
+    mtidFracYear = (hp_GWh.mtid / hp_GWh.estMtid).replace([np.inf, -np.inf], np.nan)
+    scenarios['mtidFrac'] = mtidFracYear.fillna(revParams['mtidFrac'])
+  scenarios = scenarios.loc[(scenarios.rate_DolPerkWh_M > 0) & (scenarios.rate_DolPerkWh_mtid > 0)]
+  return (scenarios)
+
+
+
+##########################################################################
+######### revenue for a matrix of tariff/demand scenarios on the same synthetic gen & power draws, in one blocked pass ###########
+############## Returns array of annual revenues ($M), (scenarios x years), or monthly (scenarios x years x 12) #########################################
+##########################################################################
+def revenue_scenario_sweep(sampGen_GWh, sampPow_DolPerkWh, scenarios, annual = True, blockYears = 8192, out = None):
+  # sampGen/sampPow are (years x 12). scenarios is dataframe or dict with revenue_model_milDollars param names, each
+  #   a scalar or array (nScenarios). years are taken in blocks, all scenarios at once, through scratch buffers allocated
+  #   once, so memory is O(blockYears x 12 x nScenarios) beyond the output. same arithmetic as revenue_model_milDollars
+  #   & same water-year sum as simulate_revenue, so a scenario with the current params matches revSim['revWyr'].
+  sampGen_GWh = np.asarray(sampGen_GWh)
+  sampPow_DolPerkWh = np.asarray(sampPow_DolPerkWh)
+  keys = ['dem_M_GWh', 'mtidFrac', 'rate_DolPerkWh_M', 'rate_DolPerkWh_mtid']
+  params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(scenarios[k], dtype=float)) for k in keys])
+  dem_M_GWh, mtidFrac, rate_DolPerkWh_M, rate_DolPerkWh_mtid = [p.reshape(-1, 1, 1) for p in params]
+  nScenarios, nYears = len(params[0]), sampGen_GWh.shape[0]
+  if (out is None):
+    out = np.empty((nScenarios, nYears) if annual else (nScenarios, nYears, 12))
+  fixedRev = dem_M_GWh * rate_DolPerkWh_M
+
+  # scratch, (scenarios x 12 x block), so the ufuncs & the water-year sum run over contiguous months of the block
+  blockYears = min(blockYears, nYears)
+  surplus = np.empty((nScenarios, 12, blockYears))
+  dem_mtid_GWh = np.empty(surplus.shape)
+  rev = np.empty(surplus.shape)
+  mtidBuys = np.empty(surplus.shape, dtype=bool)
+  genBlock, powBlock = np.empty((12, blockYears)), np.empty((12, blockYears))
+  for start in range(0, nYears, blockYears):
+    n = min(blockYears, nYears - start)
+    g, p = genBlock[:, :n], powBlock[:, :n]
+    np.copyto(g, sampGen_GWh[start:(start + n)].T)
+    np.copyto(p, sampPow_DolPerkWh[start:(start + n)].T)
+    s, m, r, buys = surplus[:, :, :n], dem_mtid_GWh[:, :, :n], rev[:, :, :n], mtidBuys[:, :, :n]
+    np.subtract(g, dem_M_GWh, out=s)
+    np.multiply(s, mtidFrac, out=m)
+    np.maximum(m, 0, out=m)
+    # mtid buys nothing in months wholesale price is below its rate. m >= 0 here, so masking by product is exact
+    np.greater_equal(p, rate_DolPerkWh_mtid, out=buys)
+    np.multiply(m, buys, out=m)
+    np.multiply(m, rate_DolPerkWh_mtid, out=r)
+    np.add(fixedRev, r, out=r)
+    np.subtract(s, m, out=s)
+    np.multiply(s, p, out=s)
+    np.add(r, s, out=r)
+    if (annual):
+      for i in range(nScenarios):
+        out[i, start:(start + n)] = functions_water_year.month_sum(r[i].T)
+    else:
+      out[:, start:(start + n)] = r.transpose(0, 2, 1)
+  return (out)
+
 
 
 ##########################################################################
 ######### Simulate revenue, matching SFPUC 2016 rates and demands ###########
-############## Returns dataframe of monthly revenues ($M/mnth) #########################################
-##########################################################################
-
-def simulate_revenue(dir_generated_inputs, gen, hp_GWh, hp_dolPerKwh, genSynth, powSynth, redo = False, save = False):
-  if (redo):
-    # nYr = int(len(powSynth) / 12)
-    # yrSim = np.full((1, nYr * 12), 0)
-    # for i in range(1, nYr):
-    #     yrSim[0, (12 * i):(12 * (i + 1))] = i
-
-    ### rel b/w swe/gen and mtid
-    # plt.scatter(hp_GWh.mtid.loc[2010:2016], swe.danWtAvg.loc[2010:2016])
-    # np.corrcoef(hp_GWh.mtid.loc[2010:2016], swe.danWtAvg.loc[2010:2016])
-    # get total amt above muni demand in each yr
-    gen['aboveMuni'] = gen.tot - hp_GWh['M'].iloc[hp_GWh.shape[0] - 1] / 12
-    gen['mtid'] = gen.aboveMuni.apply(lambda x: max(x, 0))
-    # gen.mtid.loc[(gen.wmnth < 7) ] = 0     # assume mtid only buys power Apr-Sept
-    hp_GWh['estMtid'] = np.nan
-    hp_GWh.estMtid.loc[2010:2016] = gen.loc[gen.wyear > 2009, :].groupby('wyear').sum().mtid
-    # plt.scatter(hp_GWh.estMtid.loc[2010:2016], hp_GWh.mtid.loc[2010:2016])
-    # np.corrcoef(hp_GWh.estMtid.loc[2010:2016], hp_GWh.mtid.loc[2010:2016])
-    # reg to get percentage estimated for mtid
-    lmMtid = sm.ols(formula='mtid ~ est-1',
-                    data=pd.DataFrame({'mtid': hp_GWh.mtid.loc[2010:2016], 'est': hp_GWh.estMtid.loc[2010:2016]}))
-    lmMtid = lmMtid.fit()
-    # print(lmMtid.summary())
-
-    # plt.scatter(hp_GWh.estMtid.loc[2010:2016], lmMtid.predict())
-    mtidGrowFrac = lmMtid.params[0]
-    # gen.mtid = gen.mtid * mtidGrowFrac
-    # gen['aboveMuniMtid'] = np.where(gen.aboveMuni > 0, gen.aboveMuni - gen.mtid, gen.aboveMuni)
-    # plt.plot(gen.wmnth.loc[gen.wyear==2012],gen.aboveMuni.loc[gen.wyear==2012])
-    # plt.plot(gen.aboveMuni)
-    # plt.plot(gen.aboveMuniMtid)
-    # plt.plot(gen.mtid)
-
-
-    # revenue model: monthly gen & price, assume const demand to muni, 48% surplus (from regression above) to mtid throughout year (only if mtid rate < wholesale).
-    # Rest to Wholesale. Also must buy power to meet unmet muni.
-    def revenue_model_milDollars(sampGen_GWh, sampPow_DolPerkWh, dem_M_GWh, mtidFrac, rate_DolPerkWh_M,
-                           rate_DolPerkWh_mtid):
-      dem_mtid_GWh = np.maximum((sampGen_GWh - dem_M_GWh) * mtidFrac, 0)
-      dem_mtid_GWh.loc[(sampPow_DolPerkWh < rate_DolPerkWh_mtid).values] = 0
-      # dem_mtid_GWh.loc[(dem_mtid_GWh.index % 12 < 6)] = 0  # assume mtid only buys power Apr-Sept
-      rev = (dem_M_GWh * rate_DolPerkWh_M + dem_mtid_GWh * rate_DolPerkWh_mtid + \
-             (sampGen_GWh - dem_M_GWh - dem_mtid_GWh) * sampPow_DolPerkWh)
-      return (rev)  # returns revenues in $Mil
+############## Returns historical revenue dataframe, power price sample, & dict of synthetic monthly (years x 12) & annual revenues ($M) #########################################
+##########################################################################
+
+def simulate_revenue(dir_generated_inputs, gen, hp_GWh, hp_dolPerKwh, genSynth, powSynth, redo = False, save = True):
+  # results cached under dir_generated_inputs/cache, keyed by hash of all inputs & of this module's source: only
+  #   recomputed if inputs or code change (or redo), & only stored if save.
+  def compute():
+    revParams = get_revenue_params(gen, hp_GWh, hp_dolPerKwh)
 
     # simulated revs for synthetic time series
-    revSim = revenue_model_milDollars(genSynth.gen,
-                                powSynth.powPrice/1000,
-                                hp_GWh['M'].iloc[hp_GWh.shape[0] - 1] / 12,
-                                mtidGrowFrac,
-                                hp_dolPerKwh['M'].iloc[hp_dolPerKwh.shape[0] - 1] ,
-                                hp_dolPerKwh['mtid'].iloc[hp_dolPerKwh.shape[0] - 1] )
-    powHistSample = powSynth.powPrice.iloc[3600:(3600+len(gen.tot))].reset_index(drop=True)
+    # (years, 12) layout. annual sums are taken at full precision, monthly revs then kept as float32 (plots only)
+    rev = revenue_model_milDollars(genSynth['gen'], powSynth['powPrice'] / 1000, **revParams)
+    revSim = {'rev': rev.astype(np.float32), 'revWyr': functions_water_year.annual_sum(rev)}
+    powHistSample = pd.Series(powSynth['powPrice'].ravel()[3600:(3600+len(gen.tot))], name='powPrice')
     # simulated revs for historical generation w/ random synth power price & current fixed muni/mtid rates
-    revHist = pd.DataFrame({'rev': revenue_model_milDollars(gen.tot.reset_index(drop=True),
-                                                      powSynth.powPrice.iloc[3600:(3600+len(gen.tot))].reset_index(drop=True)/1000,
-                                                      hp_GWh['M'].iloc[hp_GWh.shape[0] - 1] / 12,
-                                                      mtidGrowFrac,
-                                                      hp_dolPerKwh['M'].iloc[hp_dolPerKwh.shape[0] - 1],
-                                                      hp_dolPerKwh['mtid'].iloc[hp_dolPerKwh.shape[0] - 1]),
+    revHist = pd.DataFrame({'rev': revenue_model_milDollars(gen.tot.values, powHistSample.values / 1000, **revParams),
                             'wmnth': gen.wmnth,
                             'wyear': gen.wyear})
+    return ({'revHist': revHist, 'powHistSample': powHistSample, 'revSim': revSim})
 
-    if (save):
-      revSim.to_pickle(dir_generated_inputs + 'revSim.pkl')
-      revHist.to_pickle(dir_generated_inputs + 'revHist.pkl')
-      powHistSample.to_pickle(dir_generated_inputs + 'powHistSample.pkl')
-
-
-  else:
-    revSim = pd.read_pickle(dir_generated_inputs + 'revSim.pkl')
-    revHist = pd.read_pickle(dir_generated_inputs + 'revHist.pkl')
-    powHistSample = pd.read_pickle(dir_generated_inputs + 'powHistSample.pkl')
+  # estMtid is added to hp_GWh by get_revenue_params, so left out of the key
+  inputs = {'gen': gen[['tot', 'wmnth', 'wyear']], 'hp_GWh': hp_GWh.drop(columns='estMtid', errors='ignore'),
+            'hp_dolPerKwh': hp_dolPerKwh, 'gen_synth': genSynth['gen'], 'pow_synth': powSynth['powPrice']}
+  result = functions_cache.cached(dir_generated_inputs + 'cache/', 'simulate_revenue', compute, inputs, {}, redo=redo,
+                                  save=save, code=[sys.modules[__name__], functions_water_year])
+  revHist, powHistSample, revSim = result['revHist'], result['powHistSample'], result['revSim']
 
   return (revHist, powHistSample, revSim)
 
@@ -116,22 +217,18 @@ def simulate_revenue(dir_generated_inputs, gen, hp_GWh, hp_dolPerKwh, genSynth,
 
 def plot_SweFebApr_SweGen_SweRev(dir_figs, swe, gen, revHist, sweSynth, genSynth, revSim, sweWtParams,
                                 MEAN_REVENUE, COST_FRACTION, histRev):
-  nYr = int(len(revSim) / 12)
-  yrSim = np.full((1, nYr * 12), 0)
-  for i in range(1, nYr):
-    yrSim[0, (12 * i):(12 * (i + 1))] = i
-  revSimWyr = revSim.groupby(yrSim[0, :(nYr * 12)]).sum()
-  revHistWyr = revHist.groupby('wyear').rev.sum()
+  revSimWyr = pd.Series(revSim['revWyr'])
+  revHistWyr = pd.Series(functions_water_year.annual_sum(revHist.rev.values, revHist.wmnth.iloc[0]),
+                         index=np.unique(revHist.wyear))
   revSimWyr = revSimWyr - MEAN_REVENUE*COST_FRACTION
   revHistWyr = revHistWyr - MEAN_REVENUE*COST_FRACTION
 
-  genSynthWyr = genSynth.groupby('wyr').sum()
-  genWyr = gen.groupby('wyear').sum()
+  genSynthWyr = pd.DataFrame({'gen': genSynth['gen'].sum(axis=1)})
+  genWyr = pd.DataFrame({'tot': functions_water_year.annual_sum(gen.tot.values, gen.wmnth.iloc[0])},
+                        index=np.unique(gen.wyear))
 
   sweWtSynth = (sweWtParams[0] * sweSynth.danFeb + sweWtParams[1] * sweSynth.danApr)
   sweWtHist = (sweWtParams[0] * swe.danFeb + sweWtParams[1] * swe.danApr)
-  genSynthWyr['sweWt'] = (sweWtParams[0] * genSynthWyr['sweFeb'] + sweWtParams[1] * genSynthWyr['sweApr'])
-  genWyr['sweWt'] = (sweWtParams[0] * genWyr['sweFeb'] + sweWtParams[1] * genWyr['sweApr'])
 
   fig = plt.figure(figsize=(7,2.5))
   gs1 = fig.add_gridspec(nrows=1, ncols=3, left=0, right=1, wspace=0.6, hspace=0.)
@@ -175,38 +272,227 @@ def plot_SweFebApr_SweGen_SweRev(dir_figs, swe, gen, revHist, sweSynth, genSynth
 
 
 
+##########################################################################
+######### payoff library: vectorized payout fns of asset (in any order), with params dict, for wang pricing ###########
+############## Each returns array of payouts, same shape as asset #########################################
+##########################################################################
+
+def payoff_put(asset, params):
+  return (np.maximum(params['k'] - asset, 0))
+
+def payoff_call(asset, params):
+  return (np.maximum(asset - params['k'], 0))
+
+def payoff_cappedcall(asset, params):
+  return (np.minimum(np.maximum(asset - params['k'], 0), params['cap'] - params['k']))
+
+def payoff_shortcall(asset, params):
+  # short capped call
+  return (np.maximum(-np.maximum(asset - params['k'], 0), -(params['cap'] - params['k'])))
+
+def payoff_collar(asset, params):
+  # long put at k, short call at kCall (>= k)
+  return (np.maximum(params['k'] - asset, 0) - np.maximum(asset - params['kCall'], 0))
+
+def payoff_cfd(asset, params):
+  # capped contract for differences, long put & short capped call at same strike, all priced with one lambda
+  return (payoff_put(asset, params) + payoff_shortcall(asset, params))
+
+def payoff_ladder(asset, params):
+  # sum of puts, weights[j] at strikes[j]
+  return (sum(w * np.maximum(k - asset, 0) for w, k in ladder_rungs(params)))
+
+def ladder_rungs(params):
+  # (weight, strike) for each rung of a ladder. rungs are on the last axis, so a family of ladders can be priced at once
+  weights = np.moveaxis(np.asarray(params['weights'], dtype=float), -1, 0)
+  strikes = np.moveaxis(np.asarray(params['strikes'], dtype=float), -1, 0)
+  return (zip(weights, strikes))
+
+def payoff_putWithLastYrTrig(asset, params):
+  # put that pays nothing in yrs after asset > lastYrTrig (asset must be in time order)
+  payout = np.maximum(params['k'] - asset, 0)
+  payout[1:][asset[:-1] > params['lastYrTrig']] = 0
+  payout[0] = 0
+  return (payout)
+
+# payoff registry. direction: payout is non-decreasing ('asc') or non-increasing ('desc') in asset, so payouts are
+#   sorted by the cached asset order, or None (path dependent) to sort payouts themselves. lamSign: sign of lambda in
+#   wang transform (loads premium for the buyer). legs: payout as sum of coef * put/call(strike), for closed-form
+#   batch pricing (wang_premium_family); None if not piecewise linear in asset.
+PAYOFFS = {
+  'put': {'payout': payoff_put, 'direction': 'desc', 'lamSign': -1,
+          'legs': lambda p: [(1., 'put', p['k'])]},
+  'call': {'payout': payoff_call, 'direction': 'asc', 'lamSign': 1,
+           'legs': lambda p: [(1., 'call', p['k'])]},
+  'cappedcall': {'payout': payoff_cappedcall, 'direction': 'asc', 'lamSign': 1,
+                 'legs': lambda p: [(1., 'call', p['k']), (-1., 'call', p['cap'])]},
+  'shortcall': {'payout': payoff_shortcall, 'direction': 'desc', 'lamSign': -1,
+                'legs': lambda p: [(-1., 'call', p['k']), (1., 'call', p['cap'])]},
+  'collar': {'payout': payoff_collar, 'direction': 'desc', 'lamSign': -1,
+             'legs': lambda p: [(1., 'put', p['k']), (-1., 'call', p['kCall'])]},
+  'cfd': {'payout': payoff_cfd, 'direction': 'desc', 'lamSign': -1,
+          'legs': lambda p: [(1., 'put', p['k']), (-1., 'call', p['k']), (1., 'call', p['cap'])]},
+  'ladder': {'payout': payoff_ladder, 'direction': 'desc', 'lamSign': -1,
+             'legs': lambda p: [(w, 'put', k) for w, k in ladder_rungs(p)]},
+  'putWithLastYrTrig': {'payout': payoff_putWithLastYrTrig, 'direction': None, 'lamSign': -1, 'legs': None},
+}
+
+
+
+##########################################################################
+######### sample for wang transform pricing: asset sorted once, with cached normal scores of cumulative probs ###########
+############## Returns dict used by wang_kernel #########################################
+##########################################################################
+
+def wang_sample(asset, prob = None):
+  # prob defaults to equal weights (1/n). cumulative probs & their normal quantiles only depend on the sample & the
+  #   sort direction, so they are cached on the sample ('zCum'). distortion weights & their prefix sums are cached for
+  #   the last WANG_CACHE_LAMBDAS lambdas only, since each is one or two n-arrays.
+  asset = np.asarray(asset, dtype=float)
+  n = len(asset)
+  prob = np.full(n, 1 / n) if prob is None else np.asarray(prob, dtype=float) * np.ones(n)
+  order = np.argsort(asset, kind='stable')
+  sample = {'asset': asset, 'prob': prob, 'order': order, 'assetSorted': asset[order], 'zCum': {}, 'weights': {},
+            'prefix': {}}
+  return (sample)
+
+def wang_payout(asset, contractType, k, cap=-1., lastYrTrig=-1., **params):
+  # contract payouts from payoff registry, in the order of asset. other payoff params (kCall, strikes, weights) by name.
+  #   unknown contract types pay nan.
+  if contractType not in PAYOFFS:
+    return (np.full(len(asset), np.nan))
+  return (PAYOFFS[contractType]['payout'](asset, dict(params, k=k, cap=cap, lastYrTrig=lastYrTrig)))
+
+def wang_zcum(sample, direction):
+  # asset cdf in normal scores, for payouts sorted ascending in asset order ('asc') or reversed ('desc')
+  if direction not in sample['zCum']:
+    probSorted = sample['prob'][sample['order']] if direction == 'asc' else sample['prob'][sample['order'][::-1]]
+    sample['zCum'][direction] = st.norm.ppf(np.cumsum(probSorted))
+  return (sample['zCum'][direction])
+
+def wang_cache_put(cache, key, value):
+  # bounded cache of per-lambda arrays on a sample: oldest entry dropped beyond WANG_CACHE_LAMBDAS
+  cache[key] = value
+  while len(cache) > WANG_CACHE_LAMBDAS:
+    cache.pop(next(iter(cache)))
+  return (value)
+
+def wang_weights(sample, direction, lam):
+  # risk-distorted probs for payouts sorted ascending, when that order is the asset order ('asc') or reversed ('desc')
+  if (direction, lam) not in sample['weights']:
+    dum = st.norm.cdf(wang_zcum(sample, direction) + lam)  # risk transformed payout cdf
+    # risk transformed asset pdf
+    return (wang_cache_put(sample['weights'], (direction, lam), np.append(dum[0], np.diff(dum))))
+  return (sample['weights'][(direction, lam)])
+
+def wang_kernel(sample, contractType, lam, k, cap=-1., lastYrTrig=-1., **params):
+  # premium under wang transform & net payout (payout - premium, in sample's original order). for payoffs monotone in
+  #   asset, sorting payouts is just the (cached) asset order, forwards or reversed.
+  direction = PAYOFFS[contractType]['direction'] if contractType in PAYOFFS else None
+  if contractType in PAYOFFS:
+    lam = PAYOFFS[contractType]['lamSign'] * abs(lam)
+  payout = wang_payout(sample['asset'], contractType, k, cap, lastYrTrig, **params)
+  if direction == 'desc':
+    payoutSorted = wang_payout(sample['assetSorted'], contractType, k, cap, **params)[::-1]
+    weights = wang_weights(sample, 'desc', lam)
+  elif direction == 'asc':
+    payoutSorted = wang_payout(sample['assetSorted'], contractType, k, cap, **params)
+    weights = wang_weights(sample, 'asc', lam)
+  else:
+    payoutOrder = np.argsort(payout, kind='stable')
+    payoutSorted = payout[payoutOrder]
+    dum = st.norm.cdf(st.norm.ppf(np.cumsum(sample['prob'][payoutOrder])) + lam)
+    weights = np.append(dum[0], np.diff(dum))
+  # nansum, as pandas sum: cumsum of probs can round just above 1, giving nan weight for the top payout, which is skipped
+  prem = np.nansum(weights * payoutSorted)
+  return (prem, payout - prem)
+
+def wang_premium_lambdas(sample, contractType, lamList, k, cap=-1., chunkSize=16, derivative=False, **params):
+  # wang premium for many lambdas at once (monotone payoffs), from one sort of the sample. distortion weights
+  #   are built as a (chunk of lambdas x n) matrix, over only the nonzero payouts plus the cdf just below them, since
+  #   zero payouts add nothing to the premium. chunks of lambdas bound memory to chunkSize x n.
+  # derivative=True also returns d(prem)/d(lambda), from the same matrix: the transformed cdf is ndtr(z + lam), so
+  #   d/dlam of each weight is the difference of normal pdfs. sign is for lambda as given (>= 0 taken as +).
+  lamList = np.asarray(lamList, dtype=float)
+  lamSign = np.where(lamList < 0, -1., 1.) * PAYOFFS[contractType]['lamSign']
+  lamList = PAYOFFS[contractType]['lamSign'] * np.abs(lamList)
+  direction = PAYOFFS[contractType]['direction']
+  payoutSorted = wang_payout(sample['assetSorted'], contractType, k, cap, **params)
+  payoutSorted = payoutSorted[::-1] if direction == 'desc' else payoutSorted
+  zCum = wang_zcum(sample, direction)
+  # zero payouts add nothing, so only keep from first nonzero payout on (for one-sided payoffs like put, call, shortcall
+  #   this drops the whole block of zeros)
+  nonzero = np.nonzero(payoutSorted)[0]
+  first = nonzero[0] if len(nonzero) > 0 else len(payoutSorted)
+  payoutSorted = payoutSorted[first:]
+  zCum = np.append(-np.inf if first == 0 else zCum[first - 1], zCum[first:])  # -inf gives cdf 0 below the first
+  prem = np.empty(len(lamList))
+  dPrem = np.empty(len(lamList))
+  for start in range(0, len(lamList), chunkSize):
+    lams = lamList[start:(start + chunkSize)]
+    zLam = zCum[np.newaxis, :] + lams[:, np.newaxis]
+    weights = np.diff(ndtr(zLam), axis=1)
+    prem[start:(start + chunkSize)] = np.nansum(weights * payoutSorted, axis=1)
+    if (derivative):
+      dWeights = np.diff(np.exp(-0.5 * zLam * zLam), axis=1) / np.sqrt(2 * np.pi)  # normal pdf
+      dPrem[start:(start + chunkSize)] = np.nansum(dWeights * payoutSorted, axis=1)
+  if (derivative):
+    return (prem, lamSign * dPrem)
+  return (prem)
+
+def wang_premium_family(sample, contractType, lam, **params):
+  # wang premiums for a family of contracts of one payoff type, e.g. all strike/cap combinations, at one lambda.
+  #   params are arrays broadcast against each other (e.g. k=strikes[:, None], cap=caps[None, :]). payoffs with legs
+  #   are priced in closed form: with distortion weights w on asset sorted ascending, put(k) = k * sum(w; x < k) -
+  #   sum(w * x; x < k) & similarly for calls, from cached prefix sums & a binary search per strike. path dependent
+  #   payoffs fall back to wang_kernel per contract.
+  entry = PAYOFFS[contractType]
+  # ladder rungs are on last axis of strikes & weights, so not part of the family shape
+  shape = np.broadcast(*[np.asarray(v)[..., 0] if key in ['strikes', 'weights'] else np.asarray(v)
+                         for key, v in params.items()]).shape
+  if (entry['legs'] is None):
+    prem = np.empty(shape)
+    params = {key: np.broadcast_to(v, shape) for key, v in params.items()}
+    for i in np.ndindex(*shape):
+      pointParams = {key: v[i] for key, v in params.items()}
+      prem[i] = wang_kernel(sample, contractType, lam, pointParams.pop('k'), pointParams.pop('cap', -1.),
+                            pointParams.pop('lastYrTrig', -1.), **pointParams)[0]
+    return (prem)
+
+  direction = entry['direction']
+  lam = entry['lamSign'] * abs(lam)
+  if (direction, lam) not in sample['prefix']:
+    weights = wang_weights(sample, direction, lam)
+    weights = np.nan_to_num(weights[::-1] if direction == 'desc' else weights)  # asset order, nan as in nansum
+    wang_cache_put(sample['prefix'], (direction, lam), (np.append(0., np.cumsum(weights)),
+                                                        np.append(0., np.cumsum(weights * sample['assetSorted']))))
+  cumW, cumWX = sample['prefix'][(direction, lam)]
+  prem = np.zeros(shape)
+  for coef, legType, strike in entry['legs'](params):
+    strike = np.asarray(strike, dtype=float)
+    if (legType == 'put'):
+      below = np.searchsorted(sample['assetSorted'], strike, side='left')
+      prem = prem + coef * (strike * cumW[below] - cumWX[below])
+    else:
+      below = np.searchsorted(sample['assetSorted'], strike, side='right')
+      prem = prem + coef * ((cumWX[-1] - cumWX[below]) - strike * (cumW[-1] - cumW[below]))
+  return (prem)
+
+
+
 ##########################################################################
 ######### wang transform function ###########
 ############## Returns dataframe with net payout #########################################
 ##########################################################################
 
-def wang(df, contractType, lam, k, cap=-1., premOnly=False, lastYrTrig=-1., count=0):  # df should be dataframe with columns 'asset' and 'prob'; contractType is 'put' or 'call'
+def wang(df, contractType, lam, k, cap=-1., premOnly=False, lastYrTrig=-1., count=0, sample=None, **params):  # df should be dataframe with columns 'asset' and 'prob'; contractType is a key of PAYOFFS
   # print(count)
-  if contractType == 'put':
-    df['payout'] = df['asset'].apply(lambda x: max(k - x, 0))
-    lam = -abs(lam)
-  elif contractType == 'call':
-    df['payout'] = df['asset'].apply(lambda x: max(x - k, 0))
-    lam = abs(lam)
-  elif contractType == 'shortcall':
-    df['payout'] = df['asset'].apply(lambda x: max(-max(x - k, 0), -(cap - k)))
-    lam = -abs(lam)
-  elif contractType == 'putWithLastYrTrig':
-    df['payout'] = df['asset'].apply(lambda x: max(k - x, 0))
-    gttrig = (df['asset'].iloc[:-1] > lastYrTrig).values
-    df['payout'].iloc[1:].loc[gttrig] = 0
-    df['payout'].iloc[0] = 0
-    lam = -abs(lam)
-  else:
-    df['payout'] = np.nan
-  df.sort_values(inplace=True, by='payout')
-  dum = df['prob'].cumsum()  # asset cdf
-  dum = st.norm.cdf(st.norm.ppf(dum) + lam)  # risk transformed payout cdf
-  dum = np.append(dum[0], np.diff(dum))  # risk transformed asset pdf
-  prem = (dum * df['payout']).sum()
+  # pass sample from wang_sample(df['asset'], df['prob']) to reuse sort & cached probs across calls
+  if sample is None:
+    sample = wang_sample(df['asset'].values, df['prob'].values)
+  prem, netPayout = wang_kernel(sample, contractType, lam, k, cap, lastYrTrig, **params)
   if premOnly == False:
-    df.sort_index(inplace=True)
-    return ((df['payout'] - prem))
+    return (pd.Series(netPayout, index=df.index, name='payout'))
   else:
     return prem
 
@@ -219,42 +505,24 @@ def wang(df, contractType, lam, k, cap=-1., premOnly=False, lastYrTrig=-1., coun
 ##########################################################################
 
 def snow_contract_payout(dir_generated_inputs, sweWtSynth, contractType = 'put', label='Wt', lambdaRisk = 0.25, strikeQuantile = 0.6,
-                       capQuantile = 0.95, redo = False, save = False):
-
-  if (redo):
-    if (contractType == 'put'):
-      snowPayoutSim = wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1/sweWtSynth.shape[0]}), contractType='put',
-                           lam=lambdaRisk, k=sweWtSynth.quantile(strikeQuantile), premOnly=False)
-      if (save):
-        save_location = dir_generated_inputs + 'payoutPut%sSim.pkl' % int(strikeQuantile*100)
-        snowPayoutSim.to_pickle(save_location)
-
-    if (contractType == 'shortcall'):
-      snowPayoutSim = wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1/sweWtSynth.shape[0]}), contractType='shortcall',
-                           lam=lambdaRisk, k=sweWtSynth.quantile(strikeQuantile),
-                           cap=sweWtSynth.quantile(capQuantile), premOnly=False)
-      if (save):
-        save_location = dir_generated_inputs + 'payoutShortCall%sSim.pkl' % int(strikeQuantile*100)
-        snowPayoutSim.to_pickle(save_location)
-
-    elif (contractType == 'cfd'):
-      snowPayoutSim = wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1/sweWtSynth.shape[0]}), contractType='put',
-                           lam=lambdaRisk, k=sweWtSynth.quantile(strikeQuantile), premOnly=False)
-      snowPayoutSim = snowPayoutSim + wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1 / sweWtSynth.shape[0]}),
-                                           contractType='shortcall', lam=0, k=sweWtSynth.quantile(strikeQuantile),
-                                           cap=sweWtSynth.quantile(capQuantile), premOnly=False)
-      if (save):
-        snowPayoutSim.to_pickle(dir_generated_inputs + 'payoutCfd%sSim.pkl' % label)
-
-  else:
-    if (contractType == 'put'):
-      save_location = dir_generated_inputs + 'payoutPut%sSim.pkl' % int(strikeQuantile * 100)
-      snowPayoutSim = pd.read_pickle(save_location)
-    if (contractType == 'shortcall'):
-      save_location = dir_generated_inputs + 'payoutShortCall%sSim.pkl' % int(strikeQuantile * 100)
-      snowPayoutSim = pd.read_pickle(save_location)
-    elif (contractType == 'cfd'):
-      snowPayoutSim = pd.read_pickle(dir_generated_inputs + 'payoutCfd%sSim.pkl' % label)
+                       capQuantile = 0.95, redo = False, save = True):
+  # results cached under dir_generated_inputs/cache, keyed by hash of sweWtSynth, all pricing params & this module's
+  #   source: only recomputed if these change (or redo), & only stored if save. label is kept for old callers, no
+  #   longer used.
+  def compute():
+    sample = wang_sample(sweWtSynth.values)  # sorted once, shared by all legs
+    snowPayoutSim = 0
+    for payoff, lam in SNOW_CONTRACT_LEGS[contractType]:
+      snowPayoutSim = snowPayoutSim + wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1/sweWtSynth.shape[0]}),
+                                           contractType=payoff, lam=lambdaRisk if lam is None else lam,
+                                           k=sweWtSynth.quantile(strikeQuantile), cap=sweWtSynth.quantile(capQuantile),
+                                           premOnly=False, sample=sample)
+    return (snowPayoutSim)
+
+  params = {'contractType': contractType, 'legs': SNOW_CONTRACT_LEGS[contractType], 'lambdaRisk': lambdaRisk,
+            'strikeQuantile': strikeQuantile, 'capQuantile': capQuantile}
+  snowPayoutSim = functions_cache.cached(dir_generated_inputs + 'cache/', 'snow_contract_payout', compute,
+                                         sweWtSynth, params, redo=redo, save=save, code=[sys.modules[__name__]])
 
   return (snowPayoutSim)
 
@@ -268,11 +536,12 @@ def snow_contract_payout(dir_generated_inputs, sweWtSynth, contractType = 'put',
 def snow_contract_params(dir_generated_inputs, sweWtSynth, contractType = 'put', label='Wt', lambdaRisk = 0.25, strikeQuantile = 0.5,
                        capQuantile = 0.95, redo = False, save = False):
   capX = sweWtSynth.quantile(capQuantile)
+  sample = wang_sample(sweWtSynth.values)
   snowPayoutSim = wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1/sweWtSynth.shape[0]}), contractType='put',
-                              lam=lambdaRisk, k=sweWtSynth.quantile(strikeQuantile), premOnly=False)
+                              lam=lambdaRisk, k=sweWtSynth.quantile(strikeQuantile), premOnly=False, sample=sample)
   snowPayoutSim = snowPayoutSim + wang(pd.DataFrame({'asset': sweWtSynth, 'prob': 1/sweWtSynth.shape[0]}),
                                       contractType='shortcall', lam=0, k=sweWtSynth.quantile(strikeQuantile),
-                                      cap=capX, premOnly=False)
+                                      cap=capX, premOnly=False, sample=sample)
   capY = np.min(snowPayoutSim)
 #     snowPayoutSim = [payout(x, capX, capY) for x in sweWtSynth]
   return (capX, capY)
@@ -286,48 +555,186 @@ def snow_contract_params(dir_generated_inputs, sweWtSynth, contractType = 'put',
 ############## Returns dataframe with premium shift for each lambda #########################################
 ##########################################################################
 
-def snow_contract_params_lambda(dir_generated_inputs, sweSynth, lamList, contractType, strikeQuantile, capQuantile):
+def snow_contract_params_lambda(dir_generated_inputs, sweSynth, lamList, contractType, strikeQuantile, capQuantile,
+                                surface = None):
+  # one sort per Feb/Apr weight, then put premiums for all lambdas at once. capY is the cfd net payout at the cap
+  #   (its minimum), i.e. the min of put + shortcall payouts, less both premiums. shortcall side has lambda=0.
+  #   if a pricing surface (get_pricing_surface) is given, capX & capY are looked up on it instead.
   if (contractType == 'cfd'):
-    params = np.empty((lamList.shape[0], 6))
     wts = np.arange(0, 11)/10
-    sweGrid = {}
-    for w in wts:
-      sweGrid[w] = w*sweSynth.danFeb + (1-w)*sweSynth.danApr 
-    for i,lam in enumerate(lamList):
-      capX, capY = [], []
-      for w in wts:
-        caps = snow_contract_params(dir_generated_inputs, sweGrid[w], contractType = 'cfd',lambdaRisk = lam, 
-                                        strikeQuantile = strikeQuantile,capQuantile = capQuantile, redo = True, save = False)
-        capX.append(caps[0])
-        capY.append(caps[1])
-      capXmod = np.poly1d(np.polyfit(wts, capX, 2))
-      capYmod = np.poly1d(np.polyfit(wts, capY, 2))
-      coefs = []
-      
-      params[i,:] = list(capXmod.coef) + list(capYmod.coef)
+    capX = np.empty(len(wts))
+    capY = np.empty((len(wts), lamList.shape[0]))
+    for j, w in enumerate(wts):
+      if (surface is not None):
+        capX[j] = query_pricing_surface(surface, 0., w, strikeQuantile, capQuantile, output='capX')
+        capY[j, :] = query_pricing_surface(surface, lamList, w, strikeQuantile, capQuantile, output='capY')
+        continue
+      sweGrid = w*sweSynth.danFeb + (1-w)*sweSynth.danApr
+      strike = sweGrid.quantile(strikeQuantile)
+      capX[j] = sweGrid.quantile(capQuantile)
+      sample = wang_sample(sweGrid.values)
+      premPut = wang_premium_lambdas(sample, 'put', lamList, strike)
+      premShortCall = wang_kernel(sample, 'shortcall', 0, strike, capX[j])[0]
+      payoutMin = np.min(wang_payout(sample['asset'], 'put', strike) +
+                         wang_payout(sample['asset'], 'shortcall', strike, capX[j]))
+      capY[j, :] = payoutMin - premPut - premShortCall
+    capXcoef = np.polyfit(wts, capX, 2)
+    capYcoef = np.polyfit(wts, capY, 2)
+    params = np.column_stack([np.tile(capXcoef, (lamList.shape[0], 1)), capYcoef.T])
   return (params)
 
 
 
+##########################################################################
+######### exact cfd pricing at one (lambda, Feb weight, strike quantile, cap quantile). shortcall side has lambda=0 ###########
+############## Returns dict with capX, capY, premPut, premShortCall, dPremPut (d premPut / d lambda) #########################################
+##########################################################################
+
+def cfd_price_point(sweSynth, lam, wtFeb, strikeQuantile, capQuantile):
+  sweWt = wtFeb * sweSynth.danFeb.values + (1 - wtFeb) * sweSynth.danApr.values
+  sample = wang_sample(sweWt)
+  strike, capX = np.quantile(sweWt, [strikeQuantile, capQuantile])
+  premPut, dPremPut = wang_premium_lambdas(sample, 'put', [lam], strike, derivative=True)
+  premShortCall = wang_kernel(sample, 'shortcall', 0, strike, capX)[0]
+  payoutMin = np.min(wang_payout(sweWt, 'put', strike) + wang_payout(sweWt, 'shortcall', strike, capX))
+  return ({'capX': capX, 'capY': payoutMin - premPut[0] - premShortCall, 'premPut': premPut[0],
+           'premShortCall': premShortCall, 'dPremPut': dPremPut[0]})
+
+
+
+##########################################################################
+######### tabulate cfd pricing on a grid of (lambda, Feb weight, strike quantile, cap quantile), with error estimates
+###   from exact pricing at random held-out points inside the grid ###########
+############## Returns dict with grids, outputs (each nLam x nWt x nStrike x nCap) & max abs interpolation errors #########################################
+##########################################################################
+
+def build_pricing_surface(sweSynth, lamGrid = None, wtGrid = None, strikeGrid = None, capGrid = None, nCheck = 20,
+                          seed = 1):
+  grids = pricing_surface_grids(lamGrid, wtGrid, strikeGrid, capGrid)
+  lamGrid, wtGrid, strikeGrid, capGrid = [grids[g] for g in ['lam', 'wtFeb', 'strikeQuantile', 'capQuantile']]
+  shape = (len(lamGrid), len(wtGrid), len(strikeGrid), len(capGrid))
+  surface = dict(grids, version=PRICING_SURFACE_VERSION, fingerprint=pricing_surface_fingerprint(sweSynth))
+  for output in PRICING_SURFACE_OUTPUTS:
+    surface[output] = np.empty(shape)
+
+  # one sort per weight, one batch of lambdas per strike, & lambda-free shortcall/cap terms per (strike, cap)
+  for j, w in enumerate(wtGrid):
+    sweWt = w * sweSynth.danFeb.values + (1 - w) * sweSynth.danApr.values
+    sample = wang_sample(sweWt)
+    strikes = np.quantile(sweWt, strikeGrid)
+    caps = np.quantile(sweWt, capGrid)
+    for s, strike in enumerate(strikes):
+      premPut, dPremPut = wang_premium_lambdas(sample, 'put', lamGrid, strike, derivative=True)
+      payoutPut = wang_payout(sweWt, 'put', strike)
+      for c, capX in enumerate(caps):
+        premShortCall = wang_kernel(sample, 'shortcall', 0, strike, capX)[0]
+        payoutMin = np.min(payoutPut + wang_payout(sweWt, 'shortcall', strike, capX))
+        surface['capX'][:, j, s, c] = capX
+        surface['capY'][:, j, s, c] = payoutMin - premPut - premShortCall
+        surface['premPut'][:, j, s, c] = premPut
+        surface['premShortCall'][:, j, s, c] = premShortCall
+        surface['dPremPut'][:, j, s, c] = dPremPut
+
+  # held-out error estimates
+  rng = np.random.default_rng(seed)
+  checkPoints = np.column_stack([rng.uniform(g[0], g[-1], nCheck) for g in [lamGrid, wtGrid, strikeGrid, capGrid]])
+  errors = {output: np.empty(nCheck) for output in PRICING_SURFACE_OUTPUTS}
+  for i, point in enumerate(checkPoints):
+    exact = cfd_price_point(sweSynth, *point)
+    for output in PRICING_SURFACE_OUTPUTS:
+      errors[output][i] = abs(query_pricing_surface(surface, *point, output=output) - exact[output])
+  surface['checkPoints'] = checkPoints
+  for output in PRICING_SURFACE_OUTPUTS:
+    surface['maxError_' + output] = errors[output].max()
+  return (surface)
+
+
+
+##########################################################################
+######### pricing surface grids (defaults for those not given), & hash of synthetic swe, so a saved pricing surface
+###   is only reused for the grids & sample it was built from ###########
+############## Returns dict of grid arrays / hex string #########################################
+##########################################################################
+
+def pricing_surface_grids(lamGrid = None, wtGrid = None, strikeGrid = None, capGrid = None):
+  # defaults cover LHC lambdas (0-0.5), all Feb/Apr weights, & strike/cap quantiles around the baseline (0.5, 0.95)
+  lamGrid = np.round(np.arange(0, 0.51, 0.02), 2) if lamGrid is None else np.asarray(lamGrid, dtype=float)
+  wtGrid = np.arange(0, 11) / 10 if wtGrid is None else np.asarray(wtGrid, dtype=float)
+  strikeGrid = np.round(np.arange(0.3, 0.71, 0.05), 2) if strikeGrid is None else np.asarray(strikeGrid, dtype=float)
+  capGrid = np.round(np.arange(0.85, 0.991, 0.01), 2) if capGrid is None else np.asarray(capGrid, dtype=float)
+  return ({'lam': lamGrid, 'wtFeb': wtGrid, 'strikeQuantile': strikeGrid, 'capQuantile': capGrid})
+
+def pricing_surface_fingerprint(sweSynth):
+  sha = hashlib.sha1()
+  for col in ['danFeb', 'danApr']:
+    sha.update(np.ascontiguousarray(sweSynth[col].values, dtype=float).tobytes())
+  return (sha.hexdigest())
+
+
+
+##########################################################################
+######### load cfd pricing surface if saved for same version, grids & swe sample, else build (and save) it ###########
+############## Returns pricing surface dict #########################################
+##########################################################################
+
+def get_pricing_surface(dir_generated_inputs, sweSynth, redo = False, save = True, **gridArgs):
+  save_location = dir_generated_inputs + 'cfdPricingSurface.npz'
+  if (not redo and os.path.exists(save_location)):
+    saved = np.load(save_location)
+    surface = {key: saved[key] for key in saved.files}
+    surface['version'] = int(surface['version'])
+    surface['fingerprint'] = str(surface['fingerprint'])
+    grids = pricing_surface_grids(*[gridArgs.get(g) for g in ['lamGrid', 'wtGrid', 'strikeGrid', 'capGrid']])
+    if (surface['version'] == PRICING_SURFACE_VERSION and
+        surface['fingerprint'] == pricing_surface_fingerprint(sweSynth) and
+        all(np.array_equal(surface[g], grid) for g, grid in grids.items())):
+      return (surface)
+  surface = build_pricing_surface(sweSynth, **gridArgs)
+  if (save):
+    np.savez(save_location, **{key: val for key, val in surface.items() if not key.startswith('_')})
+  return (surface)
+
+
+
+##########################################################################
+######### interpolated lookup on pricing surface. args broadcast against each other ###########
+############## Returns array (or float) of output #########################################
+##########################################################################
+
+def query_pricing_surface(surface, lam, wtFeb, strikeQuantile, capQuantile, output = 'capY'):
+  # linear interpolators are built on first use & cached on the surface (keys with '_' are not saved)
+  if ('_interp_' + output) not in surface:
+    grids = tuple(surface[g] for g in ['lam', 'wtFeb', 'strikeQuantile', 'capQuantile'])
+    surface['_interp_' + output] = RegularGridInterpolator(grids, surface[output], method='linear')
+  points = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in [lam, wtFeb, strikeQuantile, capQuantile]])
+  values = surface['_interp_' + output](np.stack(points, axis=-1)).reshape(points[0].shape)
+  return (values if values.ndim > 0 else float(values))
+
+
+
 ##########################################################################
 ######### get shift in cfd loading based on lambda, relative to baseline payouts with lambda = 0.25.
 # Note, we do put here, since sell_call side of swap uses lambda=0 and will just be a constant shift. ###########
 ############## Returns dataframe with premium shift for each lambda #########################################
 ##########################################################################
 
-def snow_contract_payout_shift_lambda(sweVal, lam_list, contractType, lambdaRisk, strikeQuantile):
-  if (contractType == 'cfd'):
+def snow_contract_payout_shift_lambda(sweVal, lam_list, contractType, lambdaRisk, strikeQuantile, surface = None,
+                                      wtFeb = None, derivative = False):
+  # sweVal = wtFeb * danFeb + (1 - wtFeb) * danApr. if pricing surface & wtFeb are given, premiums are looked up on it,
+  #   else all lambdas (& base case) are priced from one sort of sweVal. derivative=True also returns
+  #   d(premium)/d(lambda) at each lambda in lam_list (analytic, same pass).
+  lam_list = np.asarray(lam_list, dtype=float)
+  lams = np.append(lambdaRisk, lam_list)
+  if (contractType == 'cfd' and surface is not None):
+    prem = query_pricing_surface(surface, lams, wtFeb, strikeQuantile, surface['capQuantile'][0], output='premPut')
+    dPrem = query_pricing_surface(surface, lams, wtFeb, strikeQuantile, surface['capQuantile'][0], output='dPremPut')
+  elif (contractType == 'cfd'):
     strike = sweVal.quantile(strikeQuantile)
-    prob = 1/sweVal.shape[0]
-    # first get prem for base case
-    prem_base = wang(pd.DataFrame({'asset': sweVal, 'prob': prob}), contractType='put',
-                     lam=lambdaRisk, k=strike, premOnly=True)
-    # now get shift for every lambda in dataset
-    lam_prem_shift = np.empty(lam_list.shape[0])
-    for i in range(lam_list.shape[0]):
-      lam_prem_shift[i] = wang(pd.DataFrame({'asset': sweVal, 'prob': prob}), contractType='put',
-                               lam=lam_list[i], k=strike, premOnly=True, count=i) - prem_base
+    prem, dPrem = wang_premium_lambdas(wang_sample(sweVal.values), 'put', lams, strike, derivative=True)
+  lam_prem_shift = prem[1:] - prem[0]
 
+  if (derivative):
+    return (lam_prem_shift, dPrem[1:])
   return (lam_prem_shift)
 
 
@@ -338,15 +745,12 @@ def snow_contract_payout_shift_lambda(sweVal, lam_list, contractType, lambdaRisk
 ######### plot snow contract types (fig 5/S3) ###########
 ############## Returns figure #########################################
 ##########################################################################
-def plot_contract(dir_figs, sweVal, payoutPutSim, payoutShortCallSim, payoutCfdSim, lambda_shifts, plot_type):
+def plot_contract(dir_figs, sweVal, payoutPutSim, payoutShortCallSim, payoutCfdSim, lambda_shifts, plot_type,
+                  surface = None, wtFeb = None):
 
-  strike = sweVal.quantile(0.5)
-  prob = 1 / sweVal.shape[0]
-  # first get prem for base case
-  prem_base = wang(pd.DataFrame({'asset': sweVal, 'prob': prob}), contractType='put', lam=0.25, k=strike, premOnly=True)
-  for i in range(len(lambda_shifts)):
-    lambda_shifts[i] = prem_base - wang(pd.DataFrame({'asset': sweVal, 'prob': prob}), contractType='put',
-                                        lam=lambda_shifts[i], k=strike, premOnly=True)
+  # premium shifts relative to base case (lambda=0.25), looked up on pricing surface if given
+  lambda_shifts = list(-snow_contract_payout_shift_lambda(sweVal, np.array(lambda_shifts), 'cfd', 0.25, 0.5,
+                                                          surface=surface, wtFeb=wtFeb))
 
   ### plot regime as function of debt and uncertain params
   fig = plt.figure()
@@ -367,7 +771,9 @@ def plot_contract(dir_figs, sweVal, payoutPutSim, payoutShortCallSim, payoutCfdS
   ax.tick_params(axis='y', which='both', labelleft=False,labelright=False)
   # ax.xaxis.set_label_position('top')
 
-  sns.kdeplot(sweVal, ax=ax, c='k', lw=2)
+  # binned fft kde, same bandwidth & grid as sns.kdeplot, fast on 1M samples
+  kdeGrid, kdeDensity = functions_density.kde_fft(sweVal.values)
+  ax.plot(kdeGrid, kdeDensity, c='k', lw=2)
 
   ax2.set_xlabel('SWE Index (inch)')
   ax2.set_ylabel('Net Payout ($M)')
@@ -407,17 +813,156 @@ def plot_contract(dir_figs, sweVal, payoutPutSim, payoutShortCallSim, payoutCfdS
 ######### Get maximally-hedging contract value, based on risk quantile ####
 ### returns value ####
 # ##########################################################################
-def get_max_hedge(revSimWyr, payoutCfdSim, riskQuantile = 0.05, nSamplesOptimization = 10000):
-  sample_years = np.random.choice(range(1, revSimWyr.shape[0]), size = nSamplesOptimization)
-  revSimWyr_sample = revSimWyr.iloc[sample_years]
-  payoutCfdSim_sample = payoutCfdSim.iloc[sample_years]
+def get_max_hedge(revSimWyr, payoutCfdSim, riskQuantile = 0.05, nSamplesOptimization = 10000, slopeBounds = (0., 3.),
+                  nGrid = 16, xtol = 1e-5, maxWiden = 4):
+  # riskQuantile can be a float or list. the quantile of hedged revenue is piecewise linear in slope, so rather than
+  #   nelder-mead: scan a coarse grid of slopes, then golden-section search in the bracket around the best grid point.
+  #   each evaluation is O(n) partial selection on a preallocated buffer, not a full sort, & once the bracket is set,
+  #   only years that can be at the risk quantile for some slope in it are kept (see hedged_quantile_candidates).
+  # slopeBounds is only the initial grid, as the search is unbounded like nelder-mead: while the best grid point is at
+  #   an end, the grid is extended past it by its width, up to maxWiden times (then a warning is given).
+  # same draws as np.random.choice(range(1, nYears), size), without building the range
+  sample_years = 1 + np.random.randint(0, revSimWyr.shape[0] - 1, size = nSamplesOptimization)
+  revSimWyr_sample = np.asarray(revSimWyr, dtype=float)[sample_years]
+  payoutCfdSim_sample = np.asarray(payoutCfdSim, dtype=float)[sample_years]
+  riskQuantiles = np.atleast_1d(np.asarray(riskQuantile, dtype=float))
+  buffer = np.empty(nSamplesOptimization)
+
+  lo, hi = slopeBounds
+  for widen in range(maxWiden + 1):
+    slopeGrid = np.linspace(lo, hi, nGrid)
+    gridQuantiles = np.array([hedged_quantiles(revSimWyr_sample, payoutCfdSim_sample, x, riskQuantiles, buffer)
+                              for x in slopeGrid])
+    bestGrid = np.argmax(gridQuantiles, axis=0)
+    atLo, atHi = np.any(bestGrid == 0), np.any(bestGrid == nGrid - 1)
+    if (not (atLo or atHi) or widen == maxWiden):
+      break
+    lo, hi = lo - atLo * (hi - lo), hi + atHi * (hi - lo)
+  if (atLo or atHi):
+    warnings.warn('get_max_hedge: best slope at end of search grid [%g, %g], may be outside it' % (lo, hi))
+  slopes = np.empty(len(riskQuantiles))
+  values = np.empty(len(riskQuantiles))
+  invPhi = (np.sqrt(5) - 1) / 2
+  for i, q in enumerate(riskQuantiles):
+    best = np.argmax(gridQuantiles[:, i])
+    a, b = slopeGrid[max(best - 1, 0)], slopeGrid[min(best + 1, nGrid - 1)]
+    rank = int(np.floor((nSamplesOptimization - 1) * q))
+    keep, below = hedged_quantile_candidates(revSimWyr_sample, payoutCfdSim_sample, a, b, rank,
+                                             min(rank + 1, nSamplesOptimization - 1), buffer)
+    revCand, payoutCand, nBelow = revSimWyr_sample[keep], payoutCfdSim_sample[keep], int(below.sum())
+    bufferCand = np.empty(len(revCand))
+    def get_risk_quantile(x):
+      return (hedged_quantiles(revCand, payoutCand, x, [q], bufferCand, nSamplesOptimization, nBelow)[0])
+    c, d = b - invPhi * (b - a), a + invPhi * (b - a)
+    fc, fd = get_risk_quantile(c), get_risk_quantile(d)
+    while (b - a) > xtol:
+      if (fc >= fd):
+        b, d, fd = d, c, fc
+        c = b - invPhi * (b - a)
+        fc = get_risk_quantile(c)
+      else:
+        a, c, fc = c, d, fd
+        d = a + invPhi * (b - a)
+        fd = get_risk_quantile(d)
+    slopes[i] = (a + b) / 2
+    values[i] = get_risk_quantile(slopes[i])
+    # keep grid point if it beats the bracket (search only finds a local max of a piecewise linear fn)
+    if (gridQuantiles[best, i] > values[i]):
+      slopes[i], values[i] = slopeGrid[best], gridQuantiles[best, i]
+
+  if (np.ndim(riskQuantile) == 0):
+    return (slopes[0], values[0])
+  return (slopes, values)
+
+
+
+##########################################################################
+######### quantiles of hedged revenue, rev + slope * payout, by partial selection into buffer (same interpolation
+###   as pandas/np quantile, 'linear') ###########
+############## Returns array of quantiles #########################################
+##########################################################################
+def hedged_quantiles(rev, payout, slope, quantiles, buffer, nTotal = None, nBelow = 0):
+  # rev & payout may be a subset of nTotal years, of which nBelow are known to be below all of them
+  nTotal = len(rev) if nTotal is None else nTotal
+  np.multiply(payout, slope, out=buffer)
+  buffer += rev
+  h = (nTotal - 1) * np.asarray(quantiles, dtype=float)
+  lo = np.floor(h).astype(int)
+  hi = np.minimum(lo + 1, nTotal - 1)
+  lo, hi = lo - nBelow, hi - nBelow
+  buffer.partition(np.unique(np.concatenate([lo, hi])))
+  return (buffer[lo] + (h - lo - nBelow) * (buffer[hi] - buffer[lo]))
 
-  def get_risk_quantile(x):
-    return (-((revSimWyr_sample + x * payoutCfdSim_sample).quantile(riskQuantile)))
 
-  value_contract = minimize(get_risk_quantile, x0 = 1., method = 'nelder-mead', options = {'xtol': 1e-5, 'disp': True})
 
-  return (value_contract.x[0])
+##########################################################################
+######### years that can be at order statistics rankLo..rankHi (0-based) of rev + slope * payout, for any slope in
+###   [a, b]. each year's hedged revenue is linear in slope, so lies between its values at a & b. ###########
+############## Returns tuple of boolean masks: candidate years, and years always below them #########################################
+##########################################################################
+def hedged_quantile_candidates(rev, payout, a, b, rankLo, rankHi, buffer):
+  valA, valB = rev + a * payout, rev + b * payout
+  valMin, valMax = np.minimum(valA, valB), np.maximum(valA, valB)
+  # order stats for any slope in bracket are between these order stats of pointwise min & max
+  buffer[:] = valMin
+  buffer.partition(rankLo)
+  lowBound = buffer[rankLo]
+  buffer[:] = valMax
+  buffer.partition(rankHi)
+  highBound = buffer[rankHi]
+  below = valMax < lowBound
+  keep = ~below & (valMin <= highBound)
+  return (keep, below)
+
+
+##########################################################################
+######### mean, lower quantiles & cvar of hedged net revenue (rev + slope * payout) over a grid of slopes ###########
+############## Returns dict with slope, mean (nSlope), quantile & cvar (nSlope x nQuantile) #########################################
+##########################################################################
+def hedge_slope_stats(revSimWyr, payoutCfdSim, slopes, quantiles = (0.05,), blockSize = 32, nThreads = 1):
+  # mean is linear in slope, so no pass over the data. quantiles (np/pandas 'linear') & cvar (mean of lowest
+  #   ceil(q*n) years) come from partial selection per slope, over only the years that can be in the lower tail for
+  #   some slope in the block (hedged_quantile_candidates). years always below them add a sum that is linear in slope.
+  #   blocks of slopes can be run on nThreads threads (np.partition releases the gil).
+  rev = np.asarray(revSimWyr, dtype=float)
+  payout = np.asarray(payoutCfdSim, dtype=float)
+  slopes = np.asarray(slopes, dtype=float)
+  quantiles = np.asarray(quantiles, dtype=float)
+  n = len(rev)
+  h = (n - 1) * quantiles
+  lo = np.floor(h).astype(int)
+  hi = np.minimum(lo + 1, n - 1)
+  nTail = np.maximum(np.ceil(quantiles * n).astype(int), 1)
+  ranks = np.unique(np.concatenate([lo, hi, nTail - 1]))
+  stats = {'slope': slopes, 'mean': np.mean(rev) + slopes * np.mean(payout),
+           'quantile': np.empty((len(slopes), len(quantiles))), 'cvar': np.empty((len(slopes), len(quantiles)))}
+
+  def sweep_block(start):
+    block = np.arange(start, min(start + blockSize, len(slopes)))
+    keep, below = hedged_quantile_candidates(rev, payout, slopes[block].min(), slopes[block].max(), 0, ranks.max(),
+                                             np.empty(n))
+    revCand, payoutCand = rev[keep], payout[keep]
+    revBelow, payoutBelow, nBelow = rev[below].sum(), payout[below].sum(), int(below.sum())
+    kth = ranks - nBelow
+    buffer = np.empty(len(revCand))
+    for i in block:
+      np.multiply(payoutCand, slopes[i], out=buffer)
+      buffer += revCand
+      buffer.partition(kth)
+      stats['quantile'][i, :] = buffer[lo - nBelow] + (h - lo) * (buffer[hi - nBelow] - buffer[lo - nBelow])
+      # lowest years are in first positions after partition; cumsum over largest tail covers all quantiles
+      tailSum = np.cumsum(buffer[:(nTail.max() - nBelow)])
+      stats['cvar'][i, :] = (revBelow + slopes[i] * payoutBelow + tailSum[nTail - nBelow - 1]) / nTail
+
+  starts = range(0, len(slopes), blockSize)
+  if (nThreads > 1):
+    with ThreadPoolExecutor(nThreads) as executor:
+      list(executor.map(sweep_block, starts))
+  else:
+    for start in starts:
+      sweep_block(start)
+  return (stats)
+
 
 
 ##########################################################################
@@ -428,40 +973,28 @@ def plot_swe_hedged_revenue(dir_figs, sweWtSynth, revSimWyr, payoutCfdSim, meanR
 
   netRevSimWyr = revSimWyr - meanRevenue * fixedCostFraction
   # get contract weights by optimizing for VAR95
-  slope_cfd = get_max_hedge(netRevSimWyr, payoutCfdSim, 0.05, 1000000)
+  slope_cfd = get_max_hedge(netRevSimWyr, payoutCfdSim, 0.05, 1000000)[0]
   # slope_cfd =  0.9873901367187501
 
   plt_ylim = [-28,55]
 
-  # plot as errorbars for bins
-  def get_quantiles(rev, swe, sweBinSize):
-    revQuants = pd.DataFrame({'sweBound': [1, 2, 3, 4, 5, 6, 7, 8, 9, 12],
-                              'meanRev': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 12]})['dum'].apply(
-                                lambda x: np.where(x < 9, rev.loc[
-                                  (swe >= (x-1)*sweBinSize) & (swe < x*sweBinSize)].mean(),
-                                                   np.where(x < 10, rev.loc[
-                                                     (swe >= (x-1)*sweBinSize)].mean(),
-                                                            rev.mean()))),
-                              'q5': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 12]})['dum'].apply(
-                                lambda x: np.where(x < 9, rev.loc[
-                                  (swe >= (x - 1) * sweBinSize) & (swe < x * sweBinSize)].quantile(0.05),
-                                                   np.where(x < 10, rev.loc[
-                                                     (swe >= (x-1)*sweBinSize)].quantile(0.05),
-                                                            rev.quantile(0.05)))),
-                              'q95': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 12]})['dum'].apply(
-                                lambda x: np.where(x < 9, rev.loc[
-                                  (swe >= (x - 1) * sweBinSize) & (swe < x * sweBinSize)].quantile(0.95),
-                                                   np.where(x < 10, rev.loc[
-                                                     (swe >= (x - 1) * sweBinSize)].quantile(0.95),
-                                                            rev.quantile(0.95))))
-                              })
-    revQuants.sweBound = revQuants.sweBound * sweBinSize
+  # plot as errorbars for bins: 8 bins of sweBinSize, one for swe above that, & one for all years (plotted at 12).
+  #   one sort of the swe bins serves both hedged & unhedged revenue.
+  sweBinSize = 8
+  binStats = functions_binned_stats.binned_stats(sweWtSynth.values,
+                                                 {'unhedged': netRevSimWyr.values,
+                                                  'hedged': (netRevSimWyr + slope_cfd * payoutCfdSim).values},
+                                                 bins=np.arange(1, 9) * sweBinSize, quantiles=[0.05, 0.95], total=True)
+
+  def get_quantiles(name):
+    revQuants = pd.DataFrame({'sweBound': np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 12]) * sweBinSize,
+                              'meanRev': binStats[name]['mean'],
+                              'q5': binStats[name]['quantile'][:, 0],
+                              'q95': binStats[name]['quantile'][:, 1]})
     return revQuants
 
-
-  sweBinSize = 8
-  netRevSimWyrQuants = get_quantiles(netRevSimWyr, sweWtSynth, sweBinSize)
-  netRevSimCfdQuants = get_quantiles(netRevSimWyr + slope_cfd * payoutCfdSim, sweWtSynth, sweBinSize)
+  netRevSimWyrQuants = get_quantiles('unhedged')
+  netRevSimCfdQuants = get_quantiles('hedged')
   plotSpacers = [1.3, 0.7]
 
   plt.figure()
@@ -511,16 +1044,11 @@ def plot_swe_hedged_revenue(dir_figs, sweWtSynth, revSimWyr, payoutCfdSim, meanR
 def plot_cfd_slope_effect(dir_figs, sweWtSynth, revSimWyr, payoutCfdSim, meanRevenue, fixedCostFraction):
   netRevSimWyr = revSimWyr - meanRevenue * fixedCostFraction
 
-  prob = 1 / sweWtSynth.shape[0]
   v_list = np.arange(0,151,2)/100
 
-  hedgeStats = np.empty([len(v_list), 3])
-  count = 0
-
-  for v in v_list:  # swap stats as function of slope v
-    adj_rev = netRevSimWyr + v * payoutCfdSim
-    hedgeStats[count, :] = [v, np.mean(adj_rev), np.quantile(adj_rev, 0.05)]
-    count += 1
+  # swap stats as function of slope v
+  slopeStats = hedge_slope_stats(netRevSimWyr, payoutCfdSim, v_list, quantiles = [0.05])
+  hedgeStats = np.column_stack([v_list, slopeStats['mean'], slopeStats['quantile'][:, 0]])
 
   plt.figure()
   cmap = cm.get_cmap('viridis_r')
@@ -544,10 +1072,15 @@ def plot_cfd_slope_effect(dir_figs, sweWtSynth, revSimWyr, payoutCfdSim, meanRev
 ######### save synthetic data needed for moea ###########
 ############## Saves csv, no return #########################################
 ##########################################################################
-def save_synthetic_data_moea(dir_generated_inputs, sweSynth, revSimWyr):
-  synthetic_data = pd.DataFrame({'sweFeb': sweSynth.danFeb.values, 'sweApr': sweSynth.danApr.values, 'revenue': revSimWyr.values,
-                                }).iloc[1:, :].reset_index(drop=True)[['sweFeb', 'sweApr', 'revenue']]
-  synthetic_data.to_csv(dir_generated_inputs + 'synthetic_data.txt',sep=' ', index=False)
+def save_synthetic_data_moea(dir_generated_inputs, sweSynth, revSimWyr, meta = None):
+  # text file is read by the c++ moea. binary table (synthetic_data.npy/.json) for python readers, with header
+  #   recording N_SAMPLES & MEAN_REVENUE of the saved rows (first synthetic year is dropped), plus meta (e.g. seeds)
+  synthetic_data = {'sweFeb': sweSynth.danFeb.values[1:], 'sweApr': sweSynth.danApr.values[1:],
+                    'revenue': np.asarray(revSimWyr)[1:]}
+  pd.DataFrame(synthetic_data).to_csv(dir_generated_inputs + 'synthetic_data.txt',sep=' ', index=False)
+  meta = dict({} if meta is None else meta, N_SAMPLES=len(synthetic_data['revenue']),
+              MEAN_REVENUE=float(np.mean(synthetic_data['revenue'])))
+  functions_binary_data.save_binary_table(dir_generated_inputs + 'synthetic_data', synthetic_data, meta)
 
 
 
@@ -0,0 +1,162 @@
+##############################################################################################################
+### functions_stages.py - python functions for running a pipeline as a graph of stages, each cached on disk under
+###     a fingerprint of its code, parameters & upstream stages, so only invalidated stages re-run
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import os
+import hashlib
+import inspect
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import functions_cache
+
+
+
+##########################################################################
+######### define a stage: func(*results of deps, **params), plus modules whose source it depends on ###########
+############## Returns dict describing stage #########################################
+##########################################################################
+def stage(name, func, deps = (), params = None, code = (), cache = True, shared = (), inputs = None, outputs = ()):
+  # stage code fingerprint covers func's own source & the source files of modules in code. inputs (e.g. fingerprints
+  #   of input files) are part of the stage fingerprint but not passed to func. outputs are files the stage writes:
+  #   a cached stage is re-run if any of them is missing or changed since it ran. cache=False stages always run when
+  #   needed (e.g. cheap, or results not picklable). shared names global state the stage uses (e.g. 'pyplot',
+  #   'random' for np.random), & stages sharing any of it never run at the same time.
+  return ({'name': name, 'func': func, 'deps': list(deps), 'params': {} if params is None else params,
+           'inputs': inputs, 'code': list(code), 'cache': cache, 'shared': sorted(shared), 'outputs': list(outputs)})
+
+
+
+##########################################################################
+######### fingerprint of stage code: func source & module source files ###########
+############## Returns hex string #########################################
+##########################################################################
+def code_fingerprint(s):
+  sha = hashlib.sha1()
+  sha.update(inspect.getsource(s['func']).encode())
+  sha.update(functions_cache.source_fingerprint(s['code']).encode())
+  return (sha.hexdigest())
+
+
+
+##########################################################################
+######### fingerprint of input files by content: a file, or all files under a directory ###########
+############## Returns hex string #########################################
+##########################################################################
+def files_fingerprint(path):
+  sha = hashlib.sha1()
+  if (os.path.isdir(path)):
+    files = sorted(os.path.join(root, f) for root, dirs, fs in os.walk(path) for f in fs)
+  else:
+    files = [path]
+  for f in files:
+    sha.update(os.path.relpath(f, path).encode())
+    with open(f, 'rb') as fh:
+      sha.update(fh.read())
+  return (sha.hexdigest())
+
+
+
+##########################################################################
+######### fingerprints of stage output files, None for those missing ###########
+############## Returns dict of path -> hex string or None #########################################
+##########################################################################
+def outputs_fingerprint(s):
+  return ({path: files_fingerprint(path) if os.path.exists(path) else None for path in s['outputs']})
+
+
+
+##########################################################################
+######### fingerprint of each stage: code, params, inputs & fingerprints of upstream stages ###########
+############## Returns dict of stage name -> hex string #########################################
+##########################################################################
+def stage_fingerprints(stages):
+  stages = {s['name']: s for s in stages}
+  fingerprints = {}
+  def fingerprint(name, path = ()):
+    if (name in path):
+      raise ValueError('stage dependency cycle: ' + ' -> '.join(path + (name,)))
+    if (name not in fingerprints):
+      s = stages[name]
+      # same key run_stages caches the stage result under
+      upstream = {d: fingerprint(d, path + (name,)) for d in s['deps']}
+      fingerprints[name] = functions_cache.cache_key('stage_' + name, upstream, stage_key_params(s))
+    return (fingerprints[name])
+  for name in stages:
+    fingerprint(name)
+  return (fingerprints)
+
+def stage_key_params(s):
+  return ([s['params'], s['inputs'], code_fingerprint(s), s['outputs']])
+
+
+
+##########################################################################
+######### run stages needed for targets (default all), loading unchanged stages from cache ###########
+############## Returns dict of stage name -> result, for stages loaded or run #########################################
+##########################################################################
+def run_stages(dir_cache, stages, targets = None, redo = (), save = True, nThreads = 4, startTime = None):
+  # stages are resolved on demand from the targets back: a stage found in cache is loaded without touching its
+  #   upstream stages, else its deps are resolved (concurrently) & it is run. at most nThreads stages compute at once.
+  #   redo is a list of stage names to re-run regardless of cache. fingerprints depend on code, params, inputs &
+  #   upstream fingerprints, not on results, so cached downstream stages are not re-run after a redo. stages with
+  #   outputs are cached with fingerprints of those files, & re-run if they no longer match.
+  startTime = datetime.now() if startTime is None else startTime
+  fingerprints = stage_fingerprints(stages)
+  stages = {s['name']: s for s in stages}
+  targets = list(stages) if targets is None else list(targets) + [name for name in redo if name not in targets]
+  futures = {}
+  futuresLock = threading.Lock()
+  computeSlots = threading.Semaphore(nThreads)
+  sharedLocks = {name: threading.Lock() for s in stages.values() for name in s['shared']}
+  # one thread per stage, since stages block waiting on their deps. nThreads limits those computing
+  executor = ThreadPoolExecutor(max_workers=len(stages))
+
+  def schedule(name):
+    with futuresLock:
+      if (name not in futures):
+        futures[name] = executor.submit(resolve, name)
+      return (futures[name])
+
+  def resolve(name):
+    s = stages[name]
+    def compute():
+      upstream = [schedule(d) for d in s['deps']]
+      args = [f.result() for f in upstream]
+      # shared locks taken in name order, so stages holding some never wait on each other in a cycle
+      locks = [sharedLocks[shared] for shared in s['shared']]
+      for lock in locks:
+        lock.acquire()
+      try:
+        with computeSlots:
+          print('Running stage ' + name + '..., ', datetime.now() - startTime)
+          return (s['func'](*args, **s['params']))
+      finally:
+        for lock in locks:
+          lock.release()
+    if (not s['cache']):
+      return (compute())
+    upstream = {d: fingerprints[d] for d in s['deps']}
+    if (not s['outputs']):
+      return (functions_cache.cached(dir_cache, 'stage_' + name, compute, upstream, stage_key_params(s),
+                                     redo=name in redo, save=save))
+    def compute_outputs():
+      return ({'result': compute(), 'outputs': outputs_fingerprint(s)})
+    entry = functions_cache.cached(dir_cache, 'stage_' + name, compute_outputs, upstream, stage_key_params(s),
+                                   redo=name in redo, save=save)
+    if (entry['outputs'] != outputs_fingerprint(s)):
+      print('Outputs of stage ' + name + ' missing or changed since cached, re-running')
+      entry = functions_cache.cached(dir_cache, 'stage_' + name, compute_outputs, upstream, stage_key_params(s),
+                                     redo=True, save=save)
+    return (entry['result'])
+
+  try:
+    targetFutures = [schedule(name) for name in targets]
+    for f in targetFutures:
+      f.result()
+  finally:
+    executor.shutdown(wait=True)
+  return ({name: f.result() for name, f in futures.items()})
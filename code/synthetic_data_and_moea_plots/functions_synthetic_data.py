@@ -16,11 +16,18 @@ import seaborn as sns
 import scipy as sp
 from scipy import stats as st
 from scipy.stats import gamma, lognorm, multivariate_normal, norm, t
+from scipy.signal import lfilter
 from datetime import datetime
 import sys
+import os
+import hashlib
+import multiprocessing
 import itertools
 import pycwt as wavelet
 
+import functions_binned_stats
+import functions_data_store
+
 
 sns.set_style('white')
 sns.set_context('paper', font_scale=1.55)
@@ -29,33 +36,151 @@ cmap = cm.get_cmap('viridis')
 col = [cmap(0.1),cmap(0.3),cmap(0.6),cmap(0.8)]
 
 N_SAMPLES = 1000000
+SEEDS = {'swe': 1, 'generation': 2, 'power': 3}   # global np.random seeds for each synthetic series
+MAX_COPULA_PROCESSES = 4   # default cap on copula replicate workers
 eps = 1e-13
 
 ##########################################################################
-######### synthetic Feb & Apr SWE, with correlation preserved via copula ###########
-############## Returns dataframe of Feb & Apr SWE (inch) #########################################
+######### fit gamma marginals for Feb & Apr SWE, plus normal copula correlation from kendall's tau ###########
+############## Returns dict of fitted SWE model, with cache for copula draws #########################################
 ##########################################################################
-def synthetic_swe(dir_generated_inputs, swe, redo = False, save = False):
-  np.random.seed(1)
+def fit_swe_model(swe):
   shp_g_danFeb, dum, scl_g_danFeb = gamma.fit(swe.danFeb, floc=0)
   shp_g_danApr, dum, scl_g_danApr = gamma.fit(swe.danApr, floc=0)
-  if (redo):
-    ### sample from gammas using copulas
-    kendallsTau = st.kendalltau(swe.danFeb, swe.danApr).correlation
-    corr_norm_equiv = math.sin(kendallsTau * math.pi / 2)
+  kendallsTau = st.kendalltau(swe.danFeb, swe.danApr).correlation
+  corr_norm_equiv = math.sin(kendallsTau * math.pi / 2)
+  sweModel = {'shp_g_danFeb': shp_g_danFeb, 'scl_g_danFeb': scl_g_danFeb,
+              'shp_g_danApr': shp_g_danApr, 'scl_g_danApr': scl_g_danApr,
+              'corr_norm_equiv': corr_norm_equiv, 'samples': {}}
+  return (sweModel)
+
 
-    samp_fitted = multivariate_normal.rvs(mean=np.array([0, 0]), size=N_SAMPLES,
+
+##########################################################################
+######### tabulated inverse cdf for fitted gamma marginal, in normal-score space ###########
+############## Returns dict with table & its max abs interpolation error (inch) #########################################
+##########################################################################
+def gamma_ppf_table(shp, scl, nTable = 2 ** 14, pLow = 1e-6, pHigh = 1 - 1e-6):
+  # x(z) = gamma.ppf(norm.cdf(z)) on a uniform grid in z between the normal quantiles of pLow & pHigh. x(z) is smooth &
+  #   increasing there, so linear interpolation is monotone with error ~ h^2/8 * max|x''|. the max error is measured at
+  #   all interval midpoints (where linear interpolation error peaks) & stored with the table.
+  zLow, zHigh = norm.ppf(pLow), norm.ppf(pHigh)
+  zGrid = np.linspace(zLow, zHigh, nTable)
+  xGrid = gamma.ppf(norm.cdf(zGrid), a=shp, loc=0, scale=scl)
+  table = {'shp': shp, 'scl': scl, 'pLow': pLow, 'pHigh': pHigh, 'zLow': zLow, 'dz': zGrid[1] - zGrid[0],
+           'xGrid': xGrid}
+  zMid = (zGrid[:-1] + zGrid[1:]) / 2
+  table['maxError'] = np.max(np.abs(gamma_ppf_tabulated(table, zMid) - gamma.ppf(norm.cdf(zMid), a=shp, loc=0, scale=scl)))
+  return (table)
+
+def gamma_ppf_tabulated(table, z, u = None):
+  # gamma quantiles for normal scores z (u = norm.cdf(z), computed only in the tails if not given). interpolated within
+  #   [pLow, pHigh], exact gamma.ppf below & above.
+  z = np.asarray(z, dtype=float)
+  xGrid = table['xGrid']
+  pos = (z - table['zLow']) / table['dz']
+  i = np.clip(np.floor(pos), 0, len(xGrid) - 2).astype(np.int64)
+  frac = pos - i
+  x = xGrid[i] + frac * (xGrid[i + 1] - xGrid[i])
+  tail = (pos < 0) | (pos > len(xGrid) - 1)
+  if tail.any():
+    uTail = norm.cdf(z[tail]) if u is None else np.asarray(u)[tail]
+    x[tail] = gamma.ppf(uTail, a=table['shp'], loc=0, scale=table['scl'])
+  return (x)
+
+
+
+##########################################################################
+######### sample Feb & Apr SWE from fitted gamma marginals & normal copula, drawn once per (nSamples, seed) ###########
+############## Returns dict with copula uniforms u & dataframe sweSynth #########################################
+##########################################################################
+def swe_model_sample(sweModel, nSamples = N_SAMPLES, seed = 1, tabulated = False):
+  # draws are cached on the model, along with the global RNG state just after drawing. a repeat call restores that
+  #   state, so any draws that follow are the same as after a fresh seed & draw. tabulated=True uses the gamma inverse
+  #   cdf tables (gamma_ppf_table, cached on the model) instead of gamma.ppf, for several times faster sampling with
+  #   error bounded by the tables' maxError.
+  key = (nSamples, seed, tabulated)
+  if key not in sweModel['samples']:
+    np.random.seed(seed)
+    corr_norm_equiv = sweModel['corr_norm_equiv']
+    samp_fitted = multivariate_normal.rvs(mean=np.array([0, 0]), size=nSamples,
                                           cov=[[1, corr_norm_equiv],
                                                [corr_norm_equiv, 1]])
     u = norm.cdf(samp_fitted)
 
-    sweSynth = pd.DataFrame({'danFeb': gamma.ppf(u[:, 0], a=shp_g_danFeb, loc=0, scale=scl_g_danFeb), \
-                             'danApr': gamma.ppf(u[:, 1], a=shp_g_danApr, loc=0, scale=scl_g_danApr)})
+    if (tabulated):
+      tables = swe_model_ppf_tables(sweModel)
+      sweSynth = pd.DataFrame({'danFeb': gamma_ppf_tabulated(tables['danFeb'], samp_fitted[:, 0], u[:, 0]),
+                               'danApr': gamma_ppf_tabulated(tables['danApr'], samp_fitted[:, 1], u[:, 1])})
+    else:
+      sweSynth = pd.DataFrame({'danFeb': gamma.ppf(u[:, 0], a=sweModel['shp_g_danFeb'], loc=0, scale=sweModel['scl_g_danFeb']), \
+                               'danApr': gamma.ppf(u[:, 1], a=sweModel['shp_g_danApr'], loc=0, scale=sweModel['scl_g_danApr'])})
+    sweModel['samples'][key] = {'u': u, 'sweSynth': sweSynth, 'rngState': np.random.get_state()}
+  else:
+    np.random.set_state(sweModel['samples'][key]['rngState'])
+  return (sweModel['samples'][key])
+
+
+
+def swe_model_ppf_tables(sweModel, nTable = 2 ** 14, pLow = 1e-6, pHigh = 1 - 1e-6):
+  # gamma inverse cdf tables for Feb & Apr, built once per model (for given table settings)
+  key = (nTable, pLow, pHigh)
+  if key not in sweModel.setdefault('ppfTables', {}):
+    sweModel['ppfTables'][key] = {'danFeb': gamma_ppf_table(sweModel['shp_g_danFeb'], sweModel['scl_g_danFeb'], nTable, pLow, pHigh),
+                                  'danApr': gamma_ppf_table(sweModel['shp_g_danApr'], sweModel['scl_g_danApr'], nTable, pLow, pHigh)}
+  return (sweModel['ppfTables'][key])
+
+
+
+##########################################################################
+######### normal scores of Feb & Apr SWE (normal quantile of fitted gamma cdf) ###########
+############## Returns arrays normFeb, normApr #########################################
+##########################################################################
+def swe_normal_scores(sweModel, sweDat):
+  # computed once for a cached model sample, otherwise computed for sweDat (e.g. historical swe)
+  sample = [samp for samp in sweModel['samples'].values() if samp['sweSynth'] is sweDat]
+  if (len(sample) > 0) and ('normFeb' in sample[0]):
+    return (sample[0]['normFeb'], sample[0]['normApr'])
+  normFeb = norm.ppf(gamma.cdf(sweDat.danFeb, a=sweModel['shp_g_danFeb'], loc=0, scale=sweModel['scl_g_danFeb']))
+  normApr = norm.ppf(gamma.cdf(sweDat.danApr, a=sweModel['shp_g_danApr'], loc=0, scale=sweModel['scl_g_danApr']))
+  if (len(sample) > 0):
+    sample[0]['normFeb'], sample[0]['normApr'] = normFeb, normApr
+  return (normFeb, normApr)
+
+
+
+##########################################################################
+######### read saved synthetic series from the data store, or the whole .pkl saved by older versions ###########
+############## Returns data as saved, restricted to columns (keys/column names) & rows [start, stop) of years #########################################
+##########################################################################
+def read_synthetic(dir_generated_inputs, name, columns = None, rows = None):
+  # only the chunks of the columns & rows asked for are read from the store. older .pkl files are read whole.
+  if (functions_data_store.dataset_header(dir_generated_inputs + 'store/', name) is not None):
+    return (functions_data_store.read_dataset(dir_generated_inputs + 'store/', name, columns, rows))
+  return (pd.read_pickle(dir_generated_inputs + name + '.pkl'))
+
+
+
+##########################################################################
+######### synthetic Feb & Apr SWE, with correlation preserved via copula ###########
+############## Returns dataframe of Feb & Apr SWE (inch) #########################################
+##########################################################################
+def synthetic_swe(dir_generated_inputs, swe, redo = False, save = False, sweModel = None, tabulated = False,
+                  columns = None, rows = None):
+  # saved to/read from the data store (columns & rows select part of it when read, see read_synthetic)
+  np.random.seed(SEEDS['swe'])
+  if sweModel is None:
+    sweModel = fit_swe_model(swe)
+  if (redo):
+    ### sample from gammas using copulas
+    sweSynth = swe_model_sample(sweModel, N_SAMPLES, seed=SEEDS['swe'], tabulated=tabulated)['sweSynth']
     if (save):
-      sweSynth.to_pickle(dir_generated_inputs + 'sweSynth.pkl')
+      functions_data_store.write_dataset(dir_generated_inputs + 'store/', 'sweSynth', sweSynth,
+                                         meta={'seed': SEEDS['swe'], 'nSamples': N_SAMPLES, 'tabulated': tabulated,
+                                               'model': functions_data_store.model_meta(sweModel)})
 
   else:
-    sweSynth = pd.read_pickle(dir_generated_inputs + 'sweSynth.pkl')
+    sweSynth = read_synthetic(dir_generated_inputs, 'sweSynth', columns, rows)
 
   ### check stats
   # # Kolmogorov-Smirnov test goodness of fit (if p<0.05, reject fit)
@@ -152,7 +277,7 @@ def get_wavelet(dat, time, normalized=False, noise='white'):
 ######### plot of empirical vs synthetic copula for swe ###########
 ############## Returns figure #########################################
 ##########################################################################
-def plot_swe_trends(swe, sweSynth, dir_figs):
+def plot_swe_trends(swe, sweSynth, dir_figs, sweModel = None):
   ####################
   # regressions for feb & apr swe
 
@@ -175,13 +300,10 @@ def plot_swe_trends(swe, sweSynth, dir_figs):
 
   ###############
   # get swe values normalized based on gamma quantile
-  shp_g_danFeb, dum, scl_g_danFeb = gamma.fit(swe.danFeb, floc=0)
-  shp_g_danApr, dum, scl_g_danApr = gamma.fit(swe.danApr, floc=0)
-
-  swe['normFeb'] = norm.ppf(gamma.cdf(swe.danFeb, a=shp_g_danFeb, loc=0, scale=scl_g_danFeb))
-  swe['normApr'] = norm.ppf(gamma.cdf(swe.danApr, a=shp_g_danApr, loc=0, scale=scl_g_danApr))
-  sweSynth['normFeb'] = norm.ppf(gamma.cdf(sweSynth.danFeb, a=shp_g_danFeb, loc=0, scale=scl_g_danFeb))
-  sweSynth['normApr'] = norm.ppf(gamma.cdf(sweSynth.danApr, a=shp_g_danApr, loc=0, scale=scl_g_danApr))
+  if sweModel is None:
+    sweModel = fit_swe_model(swe)
+  swe['normFeb'], swe['normApr'] = swe_normal_scores(sweModel, swe)
+  sweSynth['normFeb'], sweSynth['normApr'] = swe_normal_scores(sweModel, sweSynth)
   
   ####################
   # normalized wavelet power spectrum and significance
@@ -356,68 +478,68 @@ def plot_swe_trends(swe, sweSynth, dir_figs):
 
 
 ##########################################################################
-######### function for plotting swe multi-year exceedence probabilities ###########
-############## Returns values #########################################
+######### moving averages along last axis, from cumulative sums ###########
+############## Returns array with last axis shortened by window - 1 #########################################
 ##########################################################################
 
-def plot_swe_exceedence(swe, sweSynth, dir_figs):
-  ### Exceedence curves for snowfall, with different moving avg windows
-  obsF = np.array(swe.danFeb.values)
-  obsA = np.array(swe.danApr.values)
-  syn = np.array([sweSynth.danFeb.values,sweSynth.danApr.values])
-  nyr = len(obsF)
-  nsyn = syn.shape[1]
-  nsamp = 10000
-
-  probs = {1: [n/(nyr+1) for n in range(nyr, 0, -1)],
-            2: [n/(nyr) for n in range(nyr-1, 0, -1)],
-            4: [n/(nyr-2) for n in range(nyr-3, 0, -1)],
-            8: [n/(nyr-6) for n in range(nyr-7, 0, -1)],
-            16: [n/(nyr-14) for n in range(nyr-15, 0, -1)]}
+def rolling_means(x, window):
+  # center before cumsum to limit roundoff over long (e.g. 1M yr) records
+  x = np.asarray(x, dtype=float)
+  mu = x.mean(axis=-1, keepdims=True)
+  cs = np.concatenate([np.zeros(x.shape[:-1] + (1,)), np.cumsum(x - mu, axis=-1)], axis=-1)
+  return ((cs[..., window:] - cs[..., :-window]) / window + mu)
 
-  exceedence = {}
-  exceedence[1]  = {'obsF': [np.sort(obsF)], 'obsA': [np.sort(obsA)], 'synF':[], 'synA':[]}
-  exceedence[2]  = {'obsF': [np.sort((obsF[:-1] + obsF[1:])/2)], 'obsA': [np.sort((obsA[:-1] + obsA[1:])/2)], 'synF':[], 'synA':[]}
-  exceedence[4]  = {'obsF': [np.sort((obsF[:-3] + obsF[1:-2] + obsF[2:-1] + obsF[3:])/4)], 'synF':[], 'synA':[]}
-  exceedence[4]['obsA']  = [np.sort((obsA[:-3] + obsA[1:-2] + obsA[2:-1] + obsA[3:])/4)]
-  exceedence[8]  = {'obsF': [np.sort((obsF[:-7] + obsF[1:-6] + obsF[2:-5] + obsF[3:-4] + obsF[4:-3] + obsF[5:-2] + obsF[6:-1] + obsF[7:])/8)], 'synF':[], 'synA':[]}
-  exceedence[8]['obsA']  = [np.sort((obsA[:-7] + obsA[1:-6] + obsA[2:-5] + obsA[3:-4] + obsA[4:-3] + obsA[5:-2] + obsA[6:-1] + obsA[7:])/8)]
-  exceedence[16]  = {'obsF': [np.sort((obsF[:-15] + obsF[1:-14] + obsF[2:-13] + obsF[3:-12] + obsF[4:-11] + obsF[5:-10] + obsF[6:-9] + obsF[7:-8] + obsF[8:-7] + obsF[9:-6] + obsF[10:-5] + obsF[11:-4] + obsF[12:-3] + obsF[13:-2] + obsF[14:-1] + obsF[15:])/16)], 'synF':[], 'synA':[]}
-  exceedence[16]['obsA'] = [np.sort((obsA[:-15] + obsA[1:-14] + obsA[2:-13] + obsA[3:-12] + obsA[4:-11] + obsA[5:-10] + obsA[6:-9] + obsA[7:-8] + obsA[8:-7] + obsA[9:-6] + obsA[10:-5] + obsA[11:-4] + obsA[12:-3] + obsA[13:-2] + obsA[14:-1] + obsA[15:])/16)]
 
-  for i in range(nsamp):
-    choice = np.random.choice(range(nsyn-nyr))
-    dum = syn[:,choice:choice+nyr]
-    exceedence[1]['synF'].append(np.sort(dum[0,:]))
-    exceedence[1]['synA'].append(np.sort(dum[1,:]))
 
-    exceedence[2]['synF'].append(np.sort((dum[0,:nyr-1] + dum[0,1:nyr])/2))
-    exceedence[2]['synA'].append(np.sort((dum[1,:nyr-1] + dum[1,1:nyr])/2))
+##########################################################################
+######### multi-year exceedence curves for observed record & quantile bands over random synthetic windows ###########
+############## Returns dict (by moving avg window) of exceedence probs, sorted obs, & synthetic quantiles #########################################
+##########################################################################
+
+def exceedence_quantiles(obs, syn, windows = [1, 2, 4, 8, 16], nsamp = 10000, quantiles = [0.001, 0.05, 0.95, 0.999]):
+  # obs is (nvar, nyr) & syn is (nvar, nsyn). each sample is a random nyr-long window of syn, all drawn up front
+  #   (same draws as one np.random.choice per sample). synthetic moving avgs are built once over the whole record,
+  #   then gathered for all samples with an (nsamp, nwindow) index matrix.
+  obs = np.atleast_2d(obs)
+  syn = np.atleast_2d(syn)
+  nyr = obs.shape[1]
+  choice = np.random.choice(syn.shape[1] - nyr, size=nsamp)
+
+  exceedence = {}
+  for w in windows:
+    m = nyr - w + 1
+    idx = choice[:, np.newaxis] + np.arange(m)
+    synSorted = np.sort(rolling_means(syn, w)[:, idx], axis=2)   # (nvar, nsamp, m)
+    exceedence[w] = {'probs': np.arange(m, 0, -1) / (m + 1),
+                     'obs': np.sort(rolling_means(obs, w), axis=1),   # (nvar, m)
+                     'synQ': np.quantile(synSorted, quantiles, axis=1)}   # (nquantile, nvar, m)
+  return (exceedence)
 
-    exceedence[4]['synF'].append(np.sort((dum[0,:nyr-3] + dum[0,1:nyr-2] + dum[0,2:nyr-1] + dum[0,3:nyr])/4))
-    exceedence[4]['synA'].append(np.sort((dum[1,:nyr-3] + dum[1,1:nyr-2] + dum[1,2:nyr-1] + dum[1,3:nyr])/4))
 
-    exceedence[8]['synF'].append(np.sort((dum[0,:nyr-7] + dum[0,1:nyr-6] + dum[0,2:nyr-5] + dum[0,3:nyr-4] + dum[0,4:nyr-3] + dum[0,5:nyr-2] + dum[0,6:nyr-1] + dum[0,7:nyr])/8))
-    exceedence[8]['synA'].append(np.sort((dum[1,:nyr-7] + dum[1,1:nyr-6] + dum[1,2:nyr-5] + dum[1,3:nyr-4] + dum[1,4:nyr-3] + dum[1,5:nyr-2] + dum[1,6:nyr-1] + dum[1,7:nyr])/8))
 
-    exceedence[16]['synF'].append(np.sort((dum[0,:nyr-15] + dum[0,1:nyr-14] + dum[0,2:nyr-13] + dum[0,3:nyr-12] + dum[0,4:nyr-11] + dum[0,5:nyr-10] + dum[0,6:nyr-9] + dum[0,7:nyr-8] + dum[0,8:nyr-7] + dum[0,9:nyr-6] + dum[0,10:nyr-5] + dum[0,11:nyr-4] + dum[0,12:nyr-3] + dum[0,13:nyr-2] + dum[0,14:nyr-1] + dum[0,15:nyr])/16))
-    exceedence[16]['synA'].append(np.sort((dum[1,:nyr-15] + dum[1,1:nyr-14] + dum[1,2:nyr-13] + dum[1,3:nyr-12] + dum[1,4:nyr-11] + dum[1,5:nyr-10] + dum[1,6:nyr-9] + dum[1,7:nyr-8] + dum[1,8:nyr-7] + dum[1,9:nyr-6] + dum[1,10:nyr-5] + dum[1,11:nyr-4] + dum[1,12:nyr-3] + dum[1,13:nyr-2] + dum[1,14:nyr-1] + dum[1,15:nyr])/16))
+##########################################################################
+######### function for plotting swe multi-year exceedence probabilities ###########
+############## Returns values #########################################
+##########################################################################
+
+def plot_swe_exceedence(swe, sweSynth, dir_figs):
+  ### Exceedence curves for snowfall, with different moving avg windows
+  obs = np.array([swe.danFeb.values, swe.danApr.values])
+  syn = np.array([sweSynth.danFeb.values, sweSynth.danApr.values])
+  exceedence = exceedence_quantiles(obs, syn, windows=[1, 2, 4, 8, 16], nsamp=10000,
+                                    quantiles=[0.001, 0.05, 0.95, 0.999])
 
   # now plot exceedence curves for 1,2,4,8,16 year droughts
   fig = plt.figure(figsize=(10,8))
   labels = [['a)','b)','c)','d)','e)'],['f)','g)','h)','i)','j)']]
   for mi, ma in enumerate([1,2,4,8,16]):
-    for i,k in enumerate(['F', 'A']):
-      q01, q05, q95, q99 = [], [], [], []
-      for q in range(len(probs[ma])):
-        q01.append(np.quantile([exceedence[ma]['syn'+k][i][q] for i in range(nsamp)], 0.001))
-        q05.append(np.quantile([exceedence[ma]['syn'+k][i][q] for i in range(nsamp)], 0.05))
-        q95.append(np.quantile([exceedence[ma]['syn'+k][i][q] for i in range(nsamp)], 0.95))
-        q99.append(np.quantile([exceedence[ma]['syn'+k][i][q] for i in range(nsamp)], 0.999))
+    for i in range(2):   # Feb, Apr
+      q01, q05, q95, q99 = exceedence[ma]['synQ'][:, i, :]
+      probs = exceedence[ma]['probs']
       ax = plt.subplot2grid((2,5), (i, mi))
-      ax.fill_between(probs[ma], q99, q01, color='indianred', alpha=0.3)
-      ax.fill_between(probs[ma], q95, q05, color='indianred', alpha=0.5)        
-      ax.plot(probs[ma], exceedence[ma]['obs'+k][0], c='k', alpha=1)
+      ax.fill_between(probs, q99, q01, color='indianred', alpha=0.3)
+      ax.fill_between(probs, q95, q05, color='indianred', alpha=0.5)
+      ax.plot(probs, exceedence[ma]['obs'][i], c='k', alpha=1)
       ax.set_xlim([0,1])
       ax.set_ylim([0,80])
       ax.set_xticks([0,1])
@@ -452,27 +574,130 @@ def empirical_copula_point(point, empirical_ranks):
   w_i = np.sum(w_i) / n
   return(w_i)
 
-def empirical_copula_many(many, empirical_ranks):
-  w = many[0] * 0.
-  for i in range(len(w)):
-    w[i] = empirical_copula_point([many[0][i], many[1][i]], empirical_ranks)
+def empirical_copula_reference(empirical_ranks):
+  # pre-sort bivariate reference set for dominance counting (merge sort tree). reference points are ordered by
+  #   first coord, and each level L holds second-coord rank keys sorted within aligned blocks of 2**L points, stored
+  #   as block * keyMult + key so each level is one globally sorted array for np.searchsorted.
+  x = np.asarray(empirical_ranks[0], dtype=float)
+  y = np.asarray(empirical_ranks[1], dtype=float)
+  n = len(x)
+  order = np.argsort(x, kind='stable')
+  xSorted = x[order]
+  ySorted = np.sort(y)
+  # integer key = # of reference y <= y, so y_ref <= y_query iff key_ref <= key_query (ties included)
+  nLevels = int(np.ceil(np.log2(max(n, 2))))
+  keys = np.full(2 ** nLevels, n + 1, dtype=np.int64)   # pad to power of 2 with keys above any query
+  keys[:n] = np.searchsorted(ySorted, y[order], side='right')
+  keyMult = n + 2
+  levels = []
+  for L in range(nLevels + 1):
+    blocks = np.sort(keys.reshape(-1, 2 ** L), axis=1)
+    levels.append((blocks + np.arange(blocks.shape[0], dtype=np.int64)[:, np.newaxis] * keyMult).ravel())
+  reference = {'n': n, 'xSorted': xSorted, 'ySorted': ySorted, 'keyMult': keyMult, 'levels': levels}
+  return(reference)
+
+def empirical_copula_query(many, reference):
+  # for each query point, count reference points dominated in both coords, in O(log^2 n). reference points with
+  #   x_ref <= x_query are a prefix (length k) of the x ordering, split into aligned blocks by the bits of k.
+  k = np.searchsorted(reference['xSorted'], np.asarray(many[0], dtype=float), side='right')
+  q = np.searchsorted(reference['ySorted'], np.asarray(many[1], dtype=float), side='right')
+  count = np.zeros(len(k), dtype=np.int64)
+  for L, levelKeys in enumerate(reference['levels']):
+    inPrefix = ((k >> L) & 1) == 1
+    block = (k[inPrefix] >> (L + 1)) << 1
+    count[inPrefix] += np.searchsorted(levelKeys, block * reference['keyMult'] + q[inPrefix], side='right') - \
+                       block * 2 ** L
+  w = count / reference['n']
   return(w)
 
-def plot_empirical_synthetic_copula_swe(dir_figs, swe, startTime):
-  np.random.seed(1)
-  shp_g_danFeb, dum, scl_g_danFeb = gamma.fit(swe.danFeb, floc=0)
-  shp_g_danApr, dum, scl_g_danApr = gamma.fit(swe.danApr, floc=0)
-  # sample from gammas using copulas
-  kendallsTau = st.kendalltau(swe.danFeb, swe.danApr).correlation
-  corr_norm_equiv = math.sin(kendallsTau * math.pi / 2)
-
-  samp_fitted = multivariate_normal.rvs(mean=np.array([0, 0]), size=N_SAMPLES,
-                                        cov=[[1, corr_norm_equiv],
-                                             [corr_norm_equiv, 1]])
-  u = norm.cdf(samp_fitted)
+def empirical_copula_many(many, empirical_ranks, reference=None):
+  # same w_i as empirical_copula_point for each point. pass reference from empirical_copula_reference to reuse one
+  #   pre-sorted reference set across many query blocks.
+  if reference is None:
+    reference = empirical_copula_reference(empirical_ranks)
+  w = empirical_copula_query(many, reference)
+  return(w)
 
-  sweSynth = pd.DataFrame({'danFeb': gamma.ppf(u[:, 0], a=shp_g_danFeb, loc=0, scale=scl_g_danFeb), \
-                           'danApr': gamma.ppf(u[:, 1], a=shp_g_danApr, loc=0, scale=scl_g_danApr)})
+# samples & pre-sorted references for copula replicate workers, set once per process by _init_copula_worker
+_copula_worker_data = {}
+
+def _init_copula_worker(samples):
+  _copula_worker_data['samples'] = samples
+  _copula_worker_data['references'] = [empirical_copula_reference(samp) for samp in samples]
+
+def _copula_replicate_chunk(chunk):
+  # sorted w_i for replicates [start, stop) of each sample, each replicate block of nw queried against full sample
+  start, stop, nw = chunk
+  samples = _copula_worker_data['samples']
+  out = np.zeros([len(samples), stop - start, nw])
+  for j, samp in enumerate(samples):
+    w = empirical_copula_query([samp[0][(start * nw):(stop * nw)], samp[1][(start * nw):(stop * nw)]],
+                               _copula_worker_data['references'][j])
+    out[j] = np.sort(w.reshape(stop - start, nw), axis=1)
+  return(start, out)
+
+def simulate_copula_replicates(samples, nw, ncop, nProcesses = None, chunkSize = 100, checkpointFile = None,
+                               checkpointEvery = 10, startTime = None):
+  # samples are drawn up front by the caller (from its seeded stream), & replicate computations are deterministic given
+  #   them, so pool & serial runs give identical results. nProcesses=1 runs serially in this process, None uses up to
+  #   MAX_COPULA_PROCESSES cores (each worker holds its own sorted references, several times the samples' size). with
+  #   checkpointFile, finished chunks are saved every checkpointEvery chunks, & a rerun with the same samples resumes.
+  # workers are started by a forkserver where available (spawn on windows), never forked from this process, which may
+  #   be running other threads (e.g. pipeline stages). scripts calling this need an if __name__ == '__main__' guard.
+  if (nProcesses is None):
+    nProcesses = min(os.cpu_count() or 1, MAX_COPULA_PROCESSES)
+  copulas = np.zeros([len(samples), ncop, nw])
+  done = np.zeros(-(-ncop // chunkSize), dtype=bool)
+  fingerprint = hashlib.sha1(np.ascontiguousarray(samples).tobytes()).hexdigest()
+  if checkpointFile is not None and os.path.exists(checkpointFile):
+    checkpoint = np.load(checkpointFile)
+    if (str(checkpoint['fingerprint']) == fingerprint and int(checkpoint['chunkSize']) == chunkSize and
+        checkpoint['copulas'].shape == copulas.shape):
+      copulas = checkpoint['copulas']
+      done = checkpoint['done']
+      print('Resuming copula comparison from checkpoint, ', done.sum() * chunkSize, ' replicates done')
+
+  def save_checkpoint():
+    np.savez(checkpointFile + '.tmp.npz', copulas=copulas, done=done, fingerprint=fingerprint, chunkSize=chunkSize)
+    os.replace(checkpointFile + '.tmp.npz', checkpointFile)
+
+  chunks = [(c * chunkSize, min((c + 1) * chunkSize, ncop), nw) for c in np.where(~done)[0]]
+  if (nProcesses == 1):
+    _init_copula_worker(samples)
+    results = map(_copula_replicate_chunk, chunks)
+    pool = None
+  else:
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                          else 'spawn')
+    pool = context.Pool(nProcesses, initializer=_init_copula_worker, initargs=(samples,))
+    results = pool.imap_unordered(_copula_replicate_chunk, chunks)
+  finished = False
+  try:
+    for nFinished, (start, out) in enumerate(results, 1):
+      copulas[:, start:(start + out.shape[1]), :] = out
+      done[start // chunkSize] = True
+      if checkpointFile is not None and nFinished % checkpointEvery == 0:
+        save_checkpoint()
+      print('Finished copula comparison ', min(done.sum() * chunkSize, ncop), ' out of ', ncop, ', ',
+            datetime.now() - startTime if startTime is not None else '')
+      sys.stdout.flush()
+    finished = True
+  finally:
+    if pool is not None and finished:
+      pool.close()
+      pool.join()
+    elif pool is not None:
+      pool.terminate()
+  if checkpointFile is not None:
+    save_checkpoint()
+  return(copulas)
+
+def plot_empirical_synthetic_copula_swe(dir_figs, swe, startTime, nProcesses = None, checkpointFile = None, sweModel = None):
+  if sweModel is None:
+    sweModel = fit_swe_model(swe)
+  corr_norm_equiv = sweModel['corr_norm_equiv']
+  # sample from gammas using copulas (reused if already drawn, e.g. by synthetic_swe)
+  sweSynth = swe_model_sample(sweModel, N_SAMPLES, seed=SEEDS['swe'])['sweSynth']
   # transform swe to empircal ranks
   RFeb = swe.danFeb * 0.
   RApr = swe.danFeb * 0.
@@ -508,23 +733,11 @@ def plot_empirical_synthetic_copula_swe(dir_figs, swe, startTime):
   samp_corr = [pd.Series(u[:, 0]).values, pd.Series(u[:, 1]).values]
 
   copula_data_fitted = np.sort(empirical_copula_many([RFeb.values, RApr.values], samp_fitted))
-  copula_fitted_fitted = np.zeros([ncop, nw])
-  copula_uncorr_uncorr = np.zeros([ncop, nw])
-  copula_corr_corr = np.zeros([ncop, nw])
-
-  for i in range(ncop):
-    copula_fitted_fitted[i, :] = np.sort(empirical_copula_many([samp_fitted[0][(i * nw):((i + 1) * nw)],
-                                                         samp_fitted[1][(i * nw):((i + 1) * nw)]],
-                                                        samp_fitted))
-    copula_uncorr_uncorr[i, :] = np.sort(empirical_copula_many([samp_uncorr[0][(i * nw):((i + 1) * nw)],
-                                                         samp_uncorr[1][(i * nw):((i + 1) * nw)]],
-                                                        samp_uncorr))
-    copula_corr_corr[i, :] = np.sort(empirical_copula_many([samp_corr[0][(i * nw):((i + 1) * nw)],
-                                                     samp_corr[1][(i * nw):((i + 1) * nw)]],
-                                                    samp_corr))
-    if (i % 100 == 0):
-      print('Finished copula comparison ', i+1, ' out of 10,000, ', datetime.now() - startTime)
-      sys.stdout.flush()
+
+  # replicate blocks of each sample vs the full sample, in parallel & checkpointed (same result as serial loop)
+  copula_fitted_fitted, copula_uncorr_uncorr, copula_corr_corr = \
+    simulate_copula_replicates([samp_fitted, samp_uncorr, samp_corr], nw, ncop, nProcesses=nProcesses,
+                               checkpointFile=checkpointFile, startTime=startTime)
   copula_uncorr_uncorr_avg = np.mean(copula_uncorr_uncorr, axis=0)
   copula_corr_corr_avg = np.mean(copula_corr_corr, axis=0)
   copula_fitted_fitted_avg = np.mean(copula_fitted_fitted, axis=0)
@@ -560,312 +773,255 @@ def plot_empirical_synthetic_copula_swe(dir_figs, swe, startTime):
 
 
 ##########################################################################
-######### synthetic generation, based on regressions with sweFeb and sweApr ###########
-############## Returns dataframe monthly gen (GWh/mnth) #########################################
+######### AR(1,3) recursion for deseasonalized generation residuals, run as linear filter ###########
+############## Returns array of residuals, plus filter state for continuing in next chunk #########################################
 ##########################################################################
+def ar13_filter(innovations, residAR1_wt, residAR3_wt, initial=None, zi=None):
+  # y[i] = residAR1_wt * y[i-1] + residAR3_wt * y[i-3] + innovations[i]. lfilter (direct form II transposed) forms
+  # the same products & sums as the python loop it replaces, so output is bit-for-bit identical.
+  # start from 3 initial values y[0:3] (output then starts at y[3]), or continue from state zi returned by previous chunk.
+  b = np.array([1., 0., 0., 0.])
+  a = np.array([1., -residAR1_wt, 0., -residAR3_wt])
+  if zi is None:
+    zi = np.array([residAR1_wt * initial[2] + residAR3_wt * initial[0],
+                   residAR3_wt * initial[1],
+                   residAR3_wt * initial[2]])
+  resid, zf = lfilter(b, a, innovations, zi=zi)
+  return (resid, zf)
 
-def synthetic_generation(dir_generated_inputs, dir_figs, gen, sweSynth, redo = False, save = False, plot = True):
-  np.random.seed(2)
-  if (redo):
-    # dum = 6
-    # plt.scatter(gen.sweApr.loc[gen.wmnth == dum], gen.tot.loc[gen.wmnth == dum])
-
-    # try linear peicewise fit, with sloped segment then flat segment
-    def linear_w_max(x, intercept, slope, upperbound):
-      return (np.minimum(intercept + slope * x, upperbound * np.ones(len(x))))
-
-    # p0 = [60, 3.8, 200]
-    # popt, pcov = sp.optimize.curve_fit(linear_w_max, gen.sweApr.loc[gen.wmnth == dum].values,
-    #                                    gen.tot.loc[gen.wmnth == dum].values, p0)
-    #
-    # plt.plot(np.arange(90), linear_w_max(np.arange(90), popt[0], popt[1], popt[2]))
-    # plt.scatter(gen.sweApr.loc[gen.wmnth == dum], linear_w_max(gen.sweApr.loc[gen.wmnth == dum], popt[0], popt[1], popt[2]) - gen.tot.loc[gen.wmnth == dum])
-
-
-
-    # Store regression params and calculate predicted generation in each month
-    lmGenWmnthParams = pd.DataFrame({'wmnth': [], 'int': [], 'sweFebSlp': [], 'sweAprSlp': [],
-                                     'thres':[], 'residStd': []})
-    gen['genPredS'] = np.nan
-
-
-    # # months with significant february threshold
-    # for i in [5]:
-    #   # fig, [[ax1, ax2], [ax3, ax4]] = plt.subplots(2,2)
-    #   p0 = [92, 3.8, 226]
-    #   popt, pcov = sp.optimize.curve_fit(linear_w_max, gen.sweFeb.loc[gen.wmnth == i].values,
-    #                                      gen.tot.loc[gen.wmnth == i].values, p0)
-    #   gen.genPredS.loc[gen.wmnth == i] = linear_w_max(gen.sweFeb.loc[gen.wmnth == i], popt[0], popt[1],
-    #                                                   popt[2])
-    #   # ax2.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
-    #   # ax2.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
-    #   # plt.scatter(gen.sweFeb.loc[gen.wmnth == i],
-    #   #             gen.tot.loc[gen.wmnth == i] - gen.genPredS.loc[gen.wmnth == i])
-    #   # plt.plot([(popt[2]-popt[0])/popt[1],(popt[2]-popt[0])/popt[1]],[-100,100])
-    #   lmGenWmnthParams = lmGenWmnthParams.append(pd.DataFrame({'wmnth': [i], 'int': [popt[0]],
-    #                                                            'sweFebSlp': [popt[1]], 'sweAprSlp': [0],
-    #                                                            'thres': [popt[2]],
-    #                                                            'residStd': [(gen.tot.loc[gen.wmnth == i] -
-    #                                                                          gen.genPredS.loc[
-    #                                                                            gen.wmnth == i]).std()]
-    #                                                            })).reset_index(drop=True)
-
-    # months with significant april threshold
-    for i in [6,7,8,9]:
-      # fig, [[ax1, ax2], [ax3, ax4]] = plt.subplots(2,2)
-      p0 = [92, 3.8, 226]
-      popt, pcov = sp.optimize.curve_fit(linear_w_max, gen.sweApr.loc[gen.wmnth == i].values,
-                                         gen.tot.loc[gen.wmnth == i].values, p0)
-      gen.genPredS.loc[gen.wmnth == i] = linear_w_max(gen.sweApr.loc[gen.wmnth == i], popt[0], popt[1],
-                                                      popt[2])
-      # ax2.scatter(gen.sweApr.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
-      # ax2.scatter(gen.sweApr.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
-      # plt.scatter(gen.sweApr.loc[gen.wmnth == i],
-      #             gen.tot.loc[gen.wmnth == i] - gen.genPredS.loc[gen.wmnth == i])
-      # plt.plot([(popt[2]-popt[0])/popt[1],(popt[2]-popt[0])/popt[1]],[-100,100])
-      lmGenWmnthParams = lmGenWmnthParams.append(pd.DataFrame({'wmnth': [i], 'int': [popt[0]],
-                                                               'sweAprSlp': [popt[1]], 'sweFebSlp': [0],
-                                                               'thres': [popt[2]],
-                                                               'residStd': [(gen.tot.loc[gen.wmnth == i] -
-                                                                             gen.genPredS.loc[
-                                                                               gen.wmnth == i]).std()]
-                                                               })).reset_index(drop=True)
-
-    # months with no threshold & feb only
-    for i in [2,3,4]:
-      lmGenWmnth = sm.ols(formula='gen ~ swe',
-                          data=pd.DataFrame(
-                            {'gen': gen.tot.loc[gen.wmnth == i],
-                             'swe': gen.sweFeb.loc[gen.wmnth == i]}))
-      lmGenWmnth = lmGenWmnth.fit()
-      # print(lmGenWmnth.summary())
-      gen.genPredS.loc[gen.wmnth == i] = lmGenWmnth.params[0] + lmGenWmnth.params[1] * gen.sweFeb.loc[
-        gen.wmnth == i]
-      # plt.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
-      # plt.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
-      # plt.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i]-gen.genPredS.loc[gen.wmnth == i])
-      lmGenWmnthParams = lmGenWmnthParams.append(
-        pd.DataFrame({'wmnth': [i], 'int': [lmGenWmnth.params[0]],
-                      'sweFebSlp': [lmGenWmnth.params[1]],
-                      'sweAprSlp': [0],
-                      'thres': [1000],
-                      'residStd': [lmGenWmnth.resid.std()]})).reset_index(drop=True)
-
-    # months with no threshold & apr
-    for i in [5,10,11]:
-      lmGenWmnth = sm.ols(formula='gen ~ swe',
-                          data=pd.DataFrame(
-                            {'gen': gen.tot.loc[gen.wmnth == i],
-                             'swe': gen.sweApr.loc[gen.wmnth == i]}))
-      lmGenWmnth = lmGenWmnth.fit()
-      # print(lmGenWmnth.summary())
-      gen.genPredS.loc[gen.wmnth == i] = lmGenWmnth.params[0] + lmGenWmnth.params[1] * gen.sweApr.loc[
-        gen.wmnth == i]
-      # plt.scatter(gen.sweApr.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
-      # plt.scatter(gen.sweApr.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
-      # plt.scatter(gen.sweApr.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i] - gen.genPredS.loc[gen.wmnth == i])
-      lmGenWmnthParams = lmGenWmnthParams.append(
-        pd.DataFrame({'wmnth': [i], 'int': [lmGenWmnth.params[0]],
-                      'sweFebSlp': [0],
-                      'sweAprSlp': [lmGenWmnth.params[1]],
-                      'thres': [1000],
-                      'residStd': [lmGenWmnth.resid.std()]})).reset_index(drop=True)
-
-    # months with no threshold or swe
-    for i in [1,12]:
-      gen.genPredS.loc[gen.wmnth == i] = gen.tot.loc[gen.wmnth == i].mean()
-      lmGenWmnthParams = lmGenWmnthParams.append(
-        pd.DataFrame({'wmnth': [i], 'int': [gen.tot.loc[gen.wmnth == i].mean()],
-                      'sweFebSlp': [0],
-                      'sweAprSlp': [0],
-                      'thres': [1000],
-                      'residStd': [(gen.tot.loc[gen.wmnth == i] -
-                                    gen.tot.loc[gen.wmnth == i].mean()).std()]})).reset_index(drop=True)
-
-
-    if (plot):
-      ### plot 12 monthly models with data (Fig S2)
-      max_x = 60
-      wmnths = ['Oct','Nov','Dec','Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep']
-      plt.figure()
-      for i in range(3):
-        for j in range(4):
-          ax = plt.subplot2grid((3, 4), (i,j))
-          if (j != 0):
-            ax.tick_params(axis='y', which='both', labelleft=False)
-          if (i != 2):
-            ax.tick_params(axis='x', which='both', labelbottom=False)
-          if (i == 2) & (j == 1):
-            ax.set_xlabel('                        Predictor SWE (inches)')
-          elif (i == 1) & (j == 0):
-            ax.set_ylabel('Generation (GWh/month)')
-          # ax.xaxis.set_label_position('top')
-          # ax.set_xticks(np.arange(-2, 6, 7))
-          ax.set_xlim([0,max_x])
-          ax.set_ylim([0,280])
-          ax.set_xticks(np.arange(0, 51, 25))
-          ax.set_yticks(np.arange(0, 201, 100))
-          wmnth = 1 + 4*i + j
-          if (wmnth <= 4):
-            swetemp = gen.sweFeb.loc[gen.wmnth == wmnth]
-          else:
-            swetemp = gen.sweApr.loc[gen.wmnth == wmnth]
-          plt.scatter(swetemp, gen.tot.loc[gen.wmnth == wmnth], c=col[3])
-          x0 = 0
-          y0 = lmGenWmnthParams.int.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0]
-          y1 = lmGenWmnthParams.thres.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0]
-          slp = (lmGenWmnthParams.sweAprSlp.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0] +
-                                lmGenWmnthParams.sweFebSlp.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0])
-          x1 = (y1 - y0) / slp
-          if (slp == 0):
-            plt.axhline(y0, c=col[0])
-          else:
-            plt.plot([x0, x1], [y0, y1], c=col[0])
-          if (x1 < max_x):
-            plt.plot([x1, max_x], [y1, y1], c=col[0])
-          plt.annotate(wmnths[wmnth-1], xy=(35,6))
-      plot_name = dir_figs + 'fig_hydroRegressions.jpg'
-      plt.savefig(plot_name, dpi=1200)
-
-
-    gen['genResidS'] = gen.tot - gen.genPredS
-
-    # # plot hist and prediction
-    # plt.plot(gen.tot)
-    # plt.plot(gen.genPredS)
-    # plt.plot(gen.genResidS)
-    # pd.plotting.autocorrelation_plot(gen.genResidS)
-    # plt.hist(gen.genResidS)
-    # plt.scatter(gen.sweFeb,gen.genResidS)
-    # plt.scatter(gen.sweApr,gen.genResidS)
-    # plt.scatter(gen.wmnth,gen.genResidS)
-
-    # check autocorrelation -> highly autocorr
-    # print(stm.stats.acorr_ljungbox(gen.genResidS, lags=60, boxpierce=True))
-
-    ### now deseasonalize, also accounting for lower residuals above threshold
-    gen['genResidSDe'] = np.nan
-    for i in range(1, 13):
-      if (lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] > 999):
-        gen.genResidSDe.loc[gen.wmnth == i] = (gen.genResidS.loc[gen.wmnth == i] - gen.genResidS.loc[gen.wmnth == i].mean()) / gen.genResidS.loc[gen.wmnth == i].std()
-      else:
-        gen.genResidSDe.loc[(gen.wmnth == i) & (
-                gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] \
-          = (gen.genResidS.loc[(gen.wmnth == i) & (
-                gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)]
-             - gen.genResidS.loc[(gen.wmnth == i) & (
-                        gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].mean()) \
-            / gen.genResidS.loc[(gen.wmnth == i) & (
-                gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].std()
-
-        gen.genResidSDe.loc[(gen.wmnth == i) & (
-                gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] \
-          = (gen.genResidS.loc[(gen.wmnth == i) & (
-                gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)]
-             - gen.genResidS.loc[(gen.wmnth == i) & (
-                        gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].mean()) \
-            / gen.genResidS.loc[(gen.wmnth == i) & (
-                gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].std()
-
-    # plt.plot(gen.genResidSDe)
-    # plt.scatter(gen.wmnth, gen.genResidSDe)
-    # plt.scatter(gen.sweApr, gen.genResidSDe)
-    # plt.scatter(gen.sweApr, gen.genResidS)
-    #
-    # sp.stats.shapiro(gen.genResidSDe)
-    # stt.durbin_watson(gen.genResidSDe)
-    # plt.hist(gen.genResidSDe)
-    # pd.plotting.autocorrelation_plot(gen.genResidSDe)
-    # print(stm.stats.acorr_ljungbox(gen.genResidSDe, lags=60, boxpierce=True))
-
-
-    ## now fit AR model to deseasonalized resids
-    # lmGenAR = sm.ols(formula='dat ~ dat_1 +  dat_3+ dat_6-1', data = pd.DataFrame({'dat': gen.genResidSDe.iloc[12:].reset_index(drop=True),
-    #                                                                          'dat_1': gen.genResidSDe.iloc[11:-1].reset_index(drop=True),
-    #                                                                          'dat_2': gen.genResidSDe.iloc[10:-2].reset_index(drop=True),
-    #                                                                          'dat_3': gen.genResidSDe.iloc[9:-3].reset_index(drop=True),
-    #                                                                          'dat_4': gen.genResidSDe.iloc[8:-4].reset_index(drop=True),
-    #                                                                          'dat_6': gen.genResidSDe.iloc[6:-6].reset_index(drop=True),
-    #                                                                          'dat_12': gen.genResidSDe.iloc[:-12].reset_index(drop=True)}))
-    # lmGenAR = sm.ols(formula='dat ~ dat_1 +dat_3 + dat_4 -1', data = pd.DataFrame({'dat': gen.genResidSDe.iloc[4:].reset_index(drop=True),
-    #                                                                          'dat_1': gen.genResidSDe.iloc[3:-1].reset_index(drop=True),
-    #                                                                          'dat_2': gen.genResidSDe.iloc[2:-2].reset_index(drop=True),
-    #                                                                          'dat_3': gen.genResidSDe.iloc[1:-3].reset_index(drop=True),
-    #                                                                          'dat_4': gen.genResidSDe.iloc[:-4].reset_index(drop=True)}))
-    lmGenAR = sm.ols(formula='dat ~ dat_1 +dat_3 -1',
-                     data=pd.DataFrame({'dat': gen.genResidSDe.iloc[3:].reset_index(drop=True),
-                                        'dat_1': gen.genResidSDe.iloc[2:-1].reset_index(drop=True),
-                                        'dat_2': gen.genResidSDe.iloc[1:-2].reset_index(drop=True),
-                                        'dat_3': gen.genResidSDe.iloc[:-3].reset_index(drop=True)}))
-    lmGenAR = lmGenAR.fit()
-    # print(lmGenAR.summary())
-
-    ## resids from AR(1,3) model
-    gen['genResidSDeAR'] = np.nan
-    for i in range(3, gen.shape[0]):
-      gen.genResidSDeAR.iloc[i] = gen.genResidSDe.iloc[i] - lmGenAR.params[0] * gen.genResidSDe.iloc[i - 1] - \
-                                  lmGenAR.params[1] * gen.genResidSDe.iloc[i - 3]
-
-    # sp.stats.shapiro(gen.genResidSDeAR.iloc[3:])
-    # stt.durbin_watson(gen.genResidSDeAR.iloc[3:])
-    # stm.stats.acorr_ljungbox(gen.genResidSDeAR.iloc[3:], boxpierce=True, lags=36)
-    # plt.hist(gen.genResidSDeAR.iloc[3:])
-    # pd.plotting.autocorrelation_plot(gen.genResidSDeAR.iloc[4:])
-    # st.probplot(gen.genResidSDeAR.iloc[3:].loc[gen.wmnth == 12], plot=plt)
-    # plt.scatter( gen.wmnth.iloc[4:],gen.genResidSDeAR.iloc[4:])
-
-    # # test for normality of each month's residuals
-    # i = 12
-    # print(st.normaltest(gen.genResidSDeAR.iloc[3:].loc[gen.wmnth == i]))
 
 
+##########################################################################
+######### month-indexed params of monthly gen~snow models, for broadcasting over (years, 12) layout ###########
+############## Returns array (12 x 8) #########################################
+##########################################################################
+# columns of generation params array. residual mean/std are split at threshold (same values in both for no-threshold months)
+GEN_PARAMS_COLS = ['int', 'sweFebSlp', 'sweAprSlp', 'thres', 'residMeanAbove', 'residStdAbove', 'residMeanBelow', 'residStdBelow']
+
+def get_generation_params_array(gen, lmGenWmnthParams):
+  genParams = np.empty((12, len(GEN_PARAMS_COLS)))
+  for i in range(1, 13):
+    params = lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].iloc[0]
+    if (params.thres > 999):
+      residAbove = gen.genResidS.loc[gen.wmnth == i]
+      residBelow = residAbove
+    else:
+      residAbove = gen.genResidS.loc[(gen.wmnth == i) & (gen.genPredS > params.thres - eps)]
+      residBelow = gen.genResidS.loc[(gen.wmnth == i) & (gen.genPredS < params.thres - eps)]
+    genParams[i - 1, :] = [params.int, params.sweFebSlp, params.sweAprSlp, params.thres,
+                           residAbove.mean(), residAbove.std(), residBelow.mean(), residBelow.std()]
+  return (genParams)
 
 
-    ### Simulate new hydro gen
-    AR_mean = 0  # lmGenAR.resid.mean()
-    AR_std = lmGenAR.resid.std()
-    residAR1_wt = lmGenAR.params[0]
-    residAR3_wt = lmGenAR.params[1]
 
-    # do iterative parts in numpy for speed
-    dum = np.full(((N_SAMPLES + 1) * 12, 6), -100.0)
-    dum[:, 0] = norm.rvs(AR_mean, AR_std, (N_SAMPLES + 1) * 12)  # col 0 = residSDeAR (normal residuals from AR process)
-    dum[:3, 1] = norm.rvs(AR_mean, AR_std, 3)  # col 1 = residSDe (deseas resids from snow reg, after applying AR)(start with random b4 burn in)
-    for i in range(3, dum.shape[0]):
-      dum[i, 1] = residAR1_wt * dum[i - 1, 1] + residAR3_wt * dum[i - 3, 1] + dum[i, 0]
-    dum = dum[12:, :]   # get rid of burn-in
-    snowFeb = sweSynth.danFeb
-    snowApr = sweSynth.danApr  # from correlated gammas, see below
-
-    for i in range(0, N_SAMPLES):
-      dum[(12 * i):(12 * (i + 1)), 2] = i  # col 2 = wyr
-      dum[(12 * i):(12 * (i + 1)), 3] = range(1, 13)  # col 3 = wmnth
-      dum[(12 * i):(12 * (i + 1)), 4] = snowFeb[i]  # col 4 = Feb snow val
-      dum[(12 * i):(12 * (i + 1)), 5] = snowApr[i]  # col 5 = Apr snow val
-
-    # now get dataframe and calc rest of sim vars
-    genSynth = pd.DataFrame(
-      {'wyr': dum[:, 2], 'wmnth': dum[:, 3], 'sweFeb': dum[:, 4], 'sweApr': dum[:, 5], 'residSDe': dum[:, 1],
-       'residS': np.nan, 'genPred': np.nan, 'gen': np.nan})
-    genSynth.wmnth = genSynth.wmnth.apply(int)
-    genSynth.wyr = genSynth.wyr.apply(int)
-
-    # get prediction from monthly gen~snow regressions, and synthetic gen by adding residS.
-    for i in range(1, 13):
-      genSynth.genPred.loc[genSynth.wmnth == i] = np.minimum((lmGenWmnthParams.int.loc[lmGenWmnthParams.wmnth == i].iloc[0] +
-                                                              lmGenWmnthParams.sweFebSlp.loc[
-                                                                lmGenWmnthParams.wmnth == i].iloc[
-                                                                0] * genSynth.sweFeb.loc[genSynth.wmnth == i] +
-                                                              lmGenWmnthParams.sweAprSlp.loc[
-                                                                lmGenWmnthParams.wmnth == i].iloc[
-                                                                0] * genSynth.sweApr.loc[genSynth.wmnth == i]).values,
-                                                             lmGenWmnthParams.thres.loc[lmGenWmnthParams.wmnth == i].iloc[0])
-
-    # now reseasonalize autocorrelated residual variance. result is residual from monthly gen~snow regressions,
-    #  accounting for lower residuals above thresholds
+##########################################################################
+######### predicted & synthetic generation from deseasonalized residuals, broadcast over (years, 12) ###########
+############## Returns arrays (years x 12) of predicted gen and gen (GWh/mnth) #########################################
+##########################################################################
+def get_generation_prediction(sweFeb, sweApr, genParams):
+  # prediction from monthly gen~snow regressions, capped at threshold
+  genPred = np.minimum(genParams[:, 0] + genParams[:, 1] * sweFeb[:, np.newaxis] + genParams[:, 2] * sweApr[:, np.newaxis],
+                       genParams[:, 3])
+  return (genPred)
+
+def get_generation_from_residuals(residSDe, sweFeb, sweApr, genParams, genMin, genMax):
+  genPred = get_generation_prediction(sweFeb, sweApr, genParams)
+  # reseasonalize autocorrelated residual variance, using residual stats above/below threshold
+  above = genPred > genParams[:, 3] - eps
+  residS = np.where(above, residSDe * genParams[:, 5] + genParams[:, 4], residSDe * genParams[:, 7] + genParams[:, 6])
+  # make sure synthetic between historical limits, reflecting minimum releases & max turbine capacity
+  genS = np.clip(genPred + residS, genMin, genMax)
+  return (genPred, genS)
+
+
+
+##########################################################################
+######### fit monthly gen~snow regressions (with fig S2 of fitted models) & AR(1,3) model for deseasonalized resids ###########
+############## Returns dict of fitted generation model #########################################
+##########################################################################
+
+def fit_generation_model(dir_figs, gen, plot = True):
+  # dum = 6
+  # plt.scatter(gen.sweApr.loc[gen.wmnth == dum], gen.tot.loc[gen.wmnth == dum])
+
+  # try linear peicewise fit, with sloped segment then flat segment
+  def linear_w_max(x, intercept, slope, upperbound):
+    return (np.minimum(intercept + slope * x, upperbound * np.ones(len(x))))
+
+  # p0 = [60, 3.8, 200]
+  # popt, pcov = sp.optimize.curve_fit(linear_w_max, gen.sweApr.loc[gen.wmnth == dum].values,
+  #                                    gen.tot.loc[gen.wmnth == dum].values, p0)
+  #
+  # plt.plot(np.arange(90), linear_w_max(np.arange(90), popt[0], popt[1], popt[2]))
+  # plt.scatter(gen.sweApr.loc[gen.wmnth == dum], linear_w_max(gen.sweApr.loc[gen.wmnth == dum], popt[0], popt[1], popt[2]) - gen.tot.loc[gen.wmnth == dum])
+
+
+
+  # Store regression params and calculate predicted generation in each month
+  lmGenWmnthParams = pd.DataFrame({'wmnth': [], 'int': [], 'sweFebSlp': [], 'sweAprSlp': [],
+                                   'thres':[], 'residStd': []})
+  gen['genPredS'] = np.nan
+
+
+  # # months with significant february threshold
+  # for i in [5]:
+  #   # fig, [[ax1, ax2], [ax3, ax4]] = plt.subplots(2,2)
+  #   p0 = [92, 3.8, 226]
+  #   popt, pcov = sp.optimize.curve_fit(linear_w_max, gen.sweFeb.loc[gen.wmnth == i].values,
+  #                                      gen.tot.loc[gen.wmnth == i].values, p0)
+  #   gen.genPredS.loc[gen.wmnth == i] = linear_w_max(gen.sweFeb.loc[gen.wmnth == i], popt[0], popt[1],
+  #                                                   popt[2])
+  #   # ax2.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
+  #   # ax2.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
+  #   # plt.scatter(gen.sweFeb.loc[gen.wmnth == i],
+  #   #             gen.tot.loc[gen.wmnth == i] - gen.genPredS.loc[gen.wmnth == i])
+  #   # plt.plot([(popt[2]-popt[0])/popt[1],(popt[2]-popt[0])/popt[1]],[-100,100])
+  #   lmGenWmnthParams = lmGenWmnthParams.append(pd.DataFrame({'wmnth': [i], 'int': [popt[0]],
+  #                                                            'sweFebSlp': [popt[1]], 'sweAprSlp': [0],
+  #                                                            'thres': [popt[2]],
+  #                                                            'residStd': [(gen.tot.loc[gen.wmnth == i] -
+  #                                                                          gen.genPredS.loc[
+  #                                                                            gen.wmnth == i]).std()]
+  #                                                            })).reset_index(drop=True)
+
+  # months with significant april threshold
+  for i in [6,7,8,9]:
+    # fig, [[ax1, ax2], [ax3, ax4]] = plt.subplots(2,2)
+    p0 = [92, 3.8, 226]
+    popt, pcov = sp.optimize.curve_fit(linear_w_max, gen.sweApr.loc[gen.wmnth == i].values,
+                                       gen.tot.loc[gen.wmnth == i].values, p0)
+    gen.genPredS.loc[gen.wmnth == i] = linear_w_max(gen.sweApr.loc[gen.wmnth == i], popt[0], popt[1],
+                                                    popt[2])
+    # ax2.scatter(gen.sweApr.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
+    # ax2.scatter(gen.sweApr.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
+    # plt.scatter(gen.sweApr.loc[gen.wmnth == i],
+    #             gen.tot.loc[gen.wmnth == i] - gen.genPredS.loc[gen.wmnth == i])
+    # plt.plot([(popt[2]-popt[0])/popt[1],(popt[2]-popt[0])/popt[1]],[-100,100])
+    lmGenWmnthParams = lmGenWmnthParams.append(pd.DataFrame({'wmnth': [i], 'int': [popt[0]],
+                                                             'sweAprSlp': [popt[1]], 'sweFebSlp': [0],
+                                                             'thres': [popt[2]],
+                                                             'residStd': [(gen.tot.loc[gen.wmnth == i] -
+                                                                           gen.genPredS.loc[
+                                                                             gen.wmnth == i]).std()]
+                                                             })).reset_index(drop=True)
+
+  # months with no threshold & feb only
+  for i in [2,3,4]:
+    lmGenWmnth = sm.ols(formula='gen ~ swe',
+                        data=pd.DataFrame(
+                          {'gen': gen.tot.loc[gen.wmnth == i],
+                           'swe': gen.sweFeb.loc[gen.wmnth == i]}))
+    lmGenWmnth = lmGenWmnth.fit()
+    # print(lmGenWmnth.summary())
+    gen.genPredS.loc[gen.wmnth == i] = lmGenWmnth.params[0] + lmGenWmnth.params[1] * gen.sweFeb.loc[
+      gen.wmnth == i]
+    # plt.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
+    # plt.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
+    # plt.scatter(gen.sweFeb.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i]-gen.genPredS.loc[gen.wmnth == i])
+    lmGenWmnthParams = lmGenWmnthParams.append(
+      pd.DataFrame({'wmnth': [i], 'int': [lmGenWmnth.params[0]],
+                    'sweFebSlp': [lmGenWmnth.params[1]],
+                    'sweAprSlp': [0],
+                    'thres': [1000],
+                    'residStd': [lmGenWmnth.resid.std()]})).reset_index(drop=True)
+
+  # months with no threshold & apr
+  for i in [5,10,11]:
+    lmGenWmnth = sm.ols(formula='gen ~ swe',
+                        data=pd.DataFrame(
+                          {'gen': gen.tot.loc[gen.wmnth == i],
+                           'swe': gen.sweApr.loc[gen.wmnth == i]}))
+    lmGenWmnth = lmGenWmnth.fit()
+    # print(lmGenWmnth.summary())
+    gen.genPredS.loc[gen.wmnth == i] = lmGenWmnth.params[0] + lmGenWmnth.params[1] * gen.sweApr.loc[
+      gen.wmnth == i]
+    # plt.scatter(gen.sweApr.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i])
+    # plt.scatter(gen.sweApr.loc[gen.wmnth == i], gen.genPredS.loc[gen.wmnth == i])
+    # plt.scatter(gen.sweApr.loc[gen.wmnth == i], gen.tot.loc[gen.wmnth == i] - gen.genPredS.loc[gen.wmnth == i])
+    lmGenWmnthParams = lmGenWmnthParams.append(
+      pd.DataFrame({'wmnth': [i], 'int': [lmGenWmnth.params[0]],
+                    'sweFebSlp': [0],
+                    'sweAprSlp': [lmGenWmnth.params[1]],
+                    'thres': [1000],
+                    'residStd': [lmGenWmnth.resid.std()]})).reset_index(drop=True)
+
+  # months with no threshold or swe
+  for i in [1,12]:
+    gen.genPredS.loc[gen.wmnth == i] = gen.tot.loc[gen.wmnth == i].mean()
+    lmGenWmnthParams = lmGenWmnthParams.append(
+      pd.DataFrame({'wmnth': [i], 'int': [gen.tot.loc[gen.wmnth == i].mean()],
+                    'sweFebSlp': [0],
+                    'sweAprSlp': [0],
+                    'thres': [1000],
+                    'residStd': [(gen.tot.loc[gen.wmnth == i] -
+                                  gen.tot.loc[gen.wmnth == i].mean()).std()]})).reset_index(drop=True)
+
+
+  if (plot):
+    ### plot 12 monthly models with data (Fig S2)
+    max_x = 60
+    wmnths = ['Oct','Nov','Dec','Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep']
+    plt.figure()
+    for i in range(3):
+      for j in range(4):
+        ax = plt.subplot2grid((3, 4), (i,j))
+        if (j != 0):
+          ax.tick_params(axis='y', which='both', labelleft=False)
+        if (i != 2):
+          ax.tick_params(axis='x', which='both', labelbottom=False)
+        if (i == 2) & (j == 1):
+          ax.set_xlabel('                        Predictor SWE (inches)')
+        elif (i == 1) & (j == 0):
+          ax.set_ylabel('Generation (GWh/month)')
+        # ax.xaxis.set_label_position('top')
+        # ax.set_xticks(np.arange(-2, 6, 7))
+        ax.set_xlim([0,max_x])
+        ax.set_ylim([0,280])
+        ax.set_xticks(np.arange(0, 51, 25))
+        ax.set_yticks(np.arange(0, 201, 100))
+        wmnth = 1 + 4*i + j
+        if (wmnth <= 4):
+          swetemp = gen.sweFeb.loc[gen.wmnth == wmnth]
+        else:
+          swetemp = gen.sweApr.loc[gen.wmnth == wmnth]
+        plt.scatter(swetemp, gen.tot.loc[gen.wmnth == wmnth], c=col[3])
+        x0 = 0
+        y0 = lmGenWmnthParams.int.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0]
+        y1 = lmGenWmnthParams.thres.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0]
+        slp = (lmGenWmnthParams.sweAprSlp.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0] +
+                              lmGenWmnthParams.sweFebSlp.loc[lmGenWmnthParams.wmnth==wmnth].iloc[0])
+        x1 = (y1 - y0) / slp
+        if (slp == 0):
+          plt.axhline(y0, c=col[0])
+        else:
+          plt.plot([x0, x1], [y0, y1], c=col[0])
+        if (x1 < max_x):
+          plt.plot([x1, max_x], [y1, y1], c=col[0])
+        plt.annotate(wmnths[wmnth-1], xy=(35,6))
+    plot_name = dir_figs + 'fig_hydroRegressions.jpg'
+    plt.savefig(plot_name, dpi=1200)
+
+
+  gen['genResidS'] = gen.tot - gen.genPredS
+
+  # # plot hist and prediction
+  # plt.plot(gen.tot)
+  # plt.plot(gen.genPredS)
+  # plt.plot(gen.genResidS)
+  # pd.plotting.autocorrelation_plot(gen.genResidS)
+  # plt.hist(gen.genResidS)
+  # plt.scatter(gen.sweFeb,gen.genResidS)
+  # plt.scatter(gen.sweApr,gen.genResidS)
+  # plt.scatter(gen.wmnth,gen.genResidS)
+
+  # check autocorrelation -> highly autocorr
+  # print(stm.stats.acorr_ljungbox(gen.genResidS, lags=60, boxpierce=True))
+
+  ### now deseasonalize, also accounting for lower residuals above threshold
+  gen['genResidSDe'] = np.nan
+  for i in range(1, 13):
     if (lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] > 999):
-      gen.genResidSDe.loc[gen.wmnth == i] = (gen.genResidS.loc[gen.wmnth == i] - gen.genResidS.loc[
-        gen.wmnth == i].mean()) / gen.genResidS.loc[gen.wmnth == i].std()
+      gen.genResidSDe.loc[gen.wmnth == i] = (gen.genResidS.loc[gen.wmnth == i] - gen.genResidS.loc[gen.wmnth == i].mean()) / gen.genResidS.loc[gen.wmnth == i].std()
     else:
       gen.genResidSDe.loc[(gen.wmnth == i) & (
               gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] \
@@ -876,45 +1032,121 @@ def synthetic_generation(dir_generated_inputs, dir_figs, gen, sweSynth, redo = F
           / gen.genResidS.loc[(gen.wmnth == i) & (
               gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].std()
 
-    for i in range(1, 13):
-      if (lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] > 999):
-        genSynth.residS.loc[genSynth.wmnth == i] = genSynth.residSDe.loc[genSynth.wmnth == i] * \
-                                                   gen.genResidS.loc[gen.wmnth == i].std() + \
-                                                   gen.genResidS.loc[gen.wmnth == i].mean()
-      else:
-        genSynth.residS.loc[(genSynth.wmnth == i) & (
-                genSynth.genPred > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] \
-          = genSynth.residSDe.loc[(genSynth.wmnth == i) & (
-                genSynth.genPred > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] * \
-            gen.genResidS.loc[(gen.wmnth == i) & (
-                    gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].std() + \
-            gen.genResidS.loc[(gen.wmnth == i) & (
-                    gen.genPredS > lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[
-              0] - eps)].mean()
-        genSynth.residS.loc[(genSynth.wmnth == i) & (
-                genSynth.genPred < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] \
-          = genSynth.residSDe.loc[(genSynth.wmnth == i) & (
-                genSynth.genPred < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] * \
-            gen.genResidS.loc[(gen.wmnth == i) & (
-                    gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].std() + \
-            gen.genResidS.loc[(gen.wmnth == i) & (
-                    gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[
-              0] - eps)].mean()
-
-    genSynth['gen'] = genSynth.genPred + genSynth.residS
-
-    # make sure synthetic between historical limits, reflecting minimum releases & max turbine capacity
-    genSynth['gen'].loc[genSynth.gen < gen.tot.min()] = gen.tot.min()
-    genSynth['gen'].loc[genSynth.gen > gen.tot.max()] = gen.tot.max()
-
-    genSynth = genSynth.loc[:,['wyr','wmnth','sweFeb','sweApr','gen','genPred']]
+      gen.genResidSDe.loc[(gen.wmnth == i) & (
+              gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)] \
+        = (gen.genResidS.loc[(gen.wmnth == i) & (
+              gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)]
+           - gen.genResidS.loc[(gen.wmnth == i) & (
+                      gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].mean()) \
+          / gen.genResidS.loc[(gen.wmnth == i) & (
+              gen.genPredS < lmGenWmnthParams.loc[lmGenWmnthParams.wmnth == i].thres.values[0] - eps)].std()
+
+  # plt.plot(gen.genResidSDe)
+  # plt.scatter(gen.wmnth, gen.genResidSDe)
+  # plt.scatter(gen.sweApr, gen.genResidSDe)
+  # plt.scatter(gen.sweApr, gen.genResidS)
+  #
+  # sp.stats.shapiro(gen.genResidSDe)
+  # stt.durbin_watson(gen.genResidSDe)
+  # plt.hist(gen.genResidSDe)
+  # pd.plotting.autocorrelation_plot(gen.genResidSDe)
+  # print(stm.stats.acorr_ljungbox(gen.genResidSDe, lags=60, boxpierce=True))
+
+
+  ## now fit AR model to deseasonalized resids
+  # lmGenAR = sm.ols(formula='dat ~ dat_1 +  dat_3+ dat_6-1', data = pd.DataFrame({'dat': gen.genResidSDe.iloc[12:].reset_index(drop=True),
+  #                                                                          'dat_1': gen.genResidSDe.iloc[11:-1].reset_index(drop=True),
+  #                                                                          'dat_2': gen.genResidSDe.iloc[10:-2].reset_index(drop=True),
+  #                                                                          'dat_3': gen.genResidSDe.iloc[9:-3].reset_index(drop=True),
+  #                                                                          'dat_4': gen.genResidSDe.iloc[8:-4].reset_index(drop=True),
+  #                                                                          'dat_6': gen.genResidSDe.iloc[6:-6].reset_index(drop=True),
+  #                                                                          'dat_12': gen.genResidSDe.iloc[:-12].reset_index(drop=True)}))
+  # lmGenAR = sm.ols(formula='dat ~ dat_1 +dat_3 + dat_4 -1', data = pd.DataFrame({'dat': gen.genResidSDe.iloc[4:].reset_index(drop=True),
+  #                                                                          'dat_1': gen.genResidSDe.iloc[3:-1].reset_index(drop=True),
+  #                                                                          'dat_2': gen.genResidSDe.iloc[2:-2].reset_index(drop=True),
+  #                                                                          'dat_3': gen.genResidSDe.iloc[1:-3].reset_index(drop=True),
+  #                                                                          'dat_4': gen.genResidSDe.iloc[:-4].reset_index(drop=True)}))
+  lmGenAR = sm.ols(formula='dat ~ dat_1 +dat_3 -1',
+                   data=pd.DataFrame({'dat': gen.genResidSDe.iloc[3:].reset_index(drop=True),
+                                      'dat_1': gen.genResidSDe.iloc[2:-1].reset_index(drop=True),
+                                      'dat_2': gen.genResidSDe.iloc[1:-2].reset_index(drop=True),
+                                      'dat_3': gen.genResidSDe.iloc[:-3].reset_index(drop=True)}))
+  lmGenAR = lmGenAR.fit()
+  # print(lmGenAR.summary())
+
+  ## resids from AR(1,3) model
+  gen['genResidSDeAR'] = np.nan
+  for i in range(3, gen.shape[0]):
+    gen.genResidSDeAR.iloc[i] = gen.genResidSDe.iloc[i] - lmGenAR.params[0] * gen.genResidSDe.iloc[i - 1] - \
+                                lmGenAR.params[1] * gen.genResidSDe.iloc[i - 3]
+
+  # sp.stats.shapiro(gen.genResidSDeAR.iloc[3:])
+  # stt.durbin_watson(gen.genResidSDeAR.iloc[3:])
+  # stm.stats.acorr_ljungbox(gen.genResidSDeAR.iloc[3:], boxpierce=True, lags=36)
+  # plt.hist(gen.genResidSDeAR.iloc[3:])
+  # pd.plotting.autocorrelation_plot(gen.genResidSDeAR.iloc[4:])
+  # st.probplot(gen.genResidSDeAR.iloc[3:].loc[gen.wmnth == 12], plot=plt)
+  # plt.scatter( gen.wmnth.iloc[4:],gen.genResidSDeAR.iloc[4:])
+
+  # # test for normality of each month's residuals
+  # i = 12
+  # print(st.normaltest(gen.genResidSDeAR.iloc[3:].loc[gen.wmnth == i]))
+
+  genModel = {'lmGenWmnthParams': lmGenWmnthParams,
+              'genParams': get_generation_params_array(gen, lmGenWmnthParams),
+              'residAR1_wt': lmGenAR.params[0], 'residAR3_wt': lmGenAR.params[1],
+              'AR_std': lmGenAR.resid.std(), 'genMin': gen.tot.min(), 'genMax': gen.tot.max()}
+  return (genModel)
+
+
+
+##########################################################################
+######### synthetic generation, based on regressions with sweFeb and sweApr ###########
+############## Returns dataframe monthly gen (GWh/mnth) #########################################
+##########################################################################
+
+def synthetic_generation(dir_generated_inputs, dir_figs, gen, sweSynth, redo = False, save = False, plot = True,
+                         columns = None, rows = None):
+  # saved to/read from the data store (columns & rows select part of it when read, see read_synthetic)
+  np.random.seed(SEEDS['generation'])
+  if (redo):
+    genModel = fit_generation_model(dir_figs, gen, plot)
+
+    ### Simulate new hydro gen
+    AR_mean = 0  # lmGenAR.resid.mean()
+    AR_std = genModel['AR_std']
+    residAR1_wt = genModel['residAR1_wt']
+    residAR3_wt = genModel['residAR3_wt']
+
+    # do iterative parts in numpy for speed
+    dum = np.full(((N_SAMPLES + 1) * 12, 2), -100.0)
+    dum[:, 0] = norm.rvs(AR_mean, AR_std, (N_SAMPLES + 1) * 12)  # col 0 = residSDeAR (normal residuals from AR process)
+    dum[:3, 1] = norm.rvs(AR_mean, AR_std, 3)  # col 1 = residSDe (deseas resids from snow reg, after applying AR)(start with random b4 burn in)
+    dum[3:, 1] = ar13_filter(dum[3:, 0], residAR1_wt, residAR3_wt, initial=dum[:3, 1])[0]
+    residSDe = dum[12:, 1].reshape(N_SAMPLES, 12)   # get rid of burn-in, (years x months) layout
+    snowFeb = sweSynth.danFeb.values[:N_SAMPLES]
+    snowApr = sweSynth.danApr.values[:N_SAMPLES]  # from correlated gammas, see below
+
+    # get prediction from monthly gen~snow regressions, then reseasonalize autocorrelated residual variance
+    #  (accounting for lower residuals above thresholds), and add to get synthetic gen. broadcast over (years, 12).
+    genPred, genS = get_generation_from_residuals(residSDe, snowFeb, snowApr, genModel['genParams'],
+                                                  genModel['genMin'], genModel['genMax'])
+
+    # compact container: year-level swe (views of sweSynth), (years, 12) gen. genPred is recomputed from swe &
+    #   params when needed (get_generation_prediction), so not stored.
+    genSynth = {'sweFeb': snowFeb, 'sweApr': snowApr, 'gen': genS, 'genParams': genModel['genParams']}
 
     if (save):
-      genSynth.to_pickle(dir_generated_inputs + 'genSynth.pkl')
+      functions_data_store.write_dataset(dir_generated_inputs + 'store/', 'genSynth', genSynth,
+                                         meta={'seed': SEEDS['generation'], 'nSamples': N_SAMPLES,
+                                               'model': functions_data_store.model_meta(genModel)})
 
 
   else:
-    genSynth = pd.read_pickle(dir_generated_inputs + 'genSynth.pkl')
+    genSynth = read_synthetic(dir_generated_inputs, 'genSynth', columns, rows)
+    if isinstance(genSynth, pd.DataFrame):   # saved by older version as monthly dataframe
+      genSynth = {'sweFeb': genSynth.sweFeb.values[::12], 'sweApr': genSynth.sweApr.values[::12],
+                  'gen': genSynth.gen.values.reshape(-1, 12), 'genPred': genSynth.genPred.values.reshape(-1, 12)}
 
 
   ### check stats, compare synthetic to historical
@@ -963,146 +1195,179 @@ def synthetic_generation(dir_generated_inputs, dir_figs, gen, sweSynth, redo = F
 
 
 ##########################################################################
-######### synthetic power price, based on synth gas price ###########
-############## Returns dataframe monthly power price ($/MWh) #########################################
+######### seasonal ARMA (1,0,0)x(0,0,1,12) recursion for deseasonalized log power price, run as linear filter ###########
+############## Returns array of deseasonalized log price, plus filter state for continuing in next chunk #########################################
 ##########################################################################
+def sarma_filter(resid, logDeAR1coef, logDeMA12coef, initialLogDe=None, initialResid=None, zi=None):
+  # y[i] = logDeAR1coef * y[i-1] + logDeMA12coef * e[i-12] + e[i]. as with ar13_filter, lfilter forms the same products
+  # & sums as the python loop it replaces (bit-for-bit identical). start from the 12 months of log price & resids
+  # preceding resid, or continue from state zi returned by previous chunk.
+  b = np.zeros(13)
+  b[0] = 1.
+  b[12] = logDeMA12coef
+  a = np.array([1., -logDeAR1coef])
+  if zi is None:
+    zi = logDeMA12coef * np.asarray(initialResid, dtype=float)
+    zi[0] = logDeAR1coef * initialLogDe[-1] + zi[0]
+  logDe, zf = lfilter(b, a, resid, zi=zi)
+  return (logDe, zf)
 
-def synthetic_power(dir_generated_inputs, power, redo = False, save = False):
-  np.random.seed(3)
-  if (redo):
 
-    # log-transform and deseasonalize
-    power['logMean'] = np.log(power.priceMean)
-    power['logDe'] = np.nan
-    for i in range(1, 13):
-      power.logDe.loc[power.wmnth == i] = (power.logMean.loc[power.wmnth == i] -
-                                           power.logMean.loc[power.wmnth == i].mean()) / \
-                                          power.logMean.loc[power.wmnth == i].std()
-
-    # plt.plot(power.logMean)
-    # plt.plot(power.logDe)
-
-    # # # check for linear trend -> small significant negative trend. ignore since only 7 years of data.
-    # lmPowDeLin = sm.ols(formula='dat ~ ind ',
-    #                   data=pd.DataFrame({'dat': power.logDe, 'ind': range(0, power.shape[0])}))
-    # lmPowDeLin = lmPowDeLin.fit()
-    # print(lmPowDeLin.summary())
-
-    # ### SARIMAX model: iterate over parameters and choose lowest BIC
-    # # # (mod from https://stats.stackexchange.com/questions/328524/choose-seasonal-parameters-for-sarimax-model)
-    # p = d = q = P = D = Q = range(0,2)
-    # pdq = list(itertools.product(p,d,q))
-    # PDQ12 = [(x[0], x[1], x[2], 12) for x in list(itertools.product(P,D,Q))]
-    # BIC = 1000
-    # for param in pdq:
-    #     for paramSeas in PDQ12:
-    #         try:
-    #             sarimaxPower = SARIMAX(power.logDe, order=param, seasonal_order=paramSeas)
-    #             sarimaxPower = sarimaxPower.fit(disp=0)
-    #             if sarimaxPower.bic < 124:
-    #                 print('ARIMA{}x{} - BIC:{}'.format(param, paramSeas, sarimaxPower.bic))
-    #             if sarimaxPower.bic < BIC:
-    #                 BIC = sarimaxPower.bic
-    #                 best_param = param
-    #                 best_paramSeas = paramSeas
-    #         except Exception as e:
-    #             # print(e)
-    #             continue
-    # sarimaxPower = SARIMAX(power.logDe, order=(1,0,0), seasonal_order=(0,0,1,12))
-    # sarimaxPower = sarimaxPower.fit(disp=0)
-    # # print(sarimaxPower.summary())
-
-    # p = q = P = Q = range(0, 2)
-    # pdq = [(x[0], 0, x[1]) for x in list(itertools.product(p, q))]
-    # PDQ12 = [(x[0], 0, x[1], 12) for x in list(itertools.product(P, Q))]
-    # BIC = 1000
-    # for param in pdq:
-    #   for paramSeas in PDQ12:
-    #     try:
-    #       sarimaxPower = SARIMAX(power.logDe, order=param, seasonal_order=paramSeas)
-    #       sarimaxPower = sarimaxPower.fit(disp=0)
-    #       # if ((sarimaxPower.pvalues > 0.05).sum() == 0):
-    #         # if sarimaxPower.bic < 115:
-    #       print('ARIMA{}x{} - BIC:{}'.format(param, paramSeas, sarimaxPower.bic))
-    #       if sarimaxPower.bic < BIC:
-    #         BIC = sarimaxPower.bic
-    #         best_param = param
-    #         best_paramSeas = paramSeas
-    #     except Exception as e:
-    #       # print(e)
-    #       continue
-    sarimaxPower = SARIMAX(power.logDe, order=(1, 0, 0), seasonal_order=(0, 0, 1, 12))
-    sarimaxPower = sarimaxPower.fit(disp=0)
-    # print(sarimaxPower.summary())
-
-
-
-    # # try with sweApr as exogenous factor -> not sig
-    # power['wyr'] = power.index.year
-    # power.wyr.loc[power.wmnth < 4] = power.wyr.loc[power.wmnth < 4] + 1
-    # power['swe'] = np.nan
-    # for i in range(2010, 2018):
-    #     power.swe.loc[power.wyr == i] = swe.danApr[i]
-    # sarimaxPower = SARIMAX(power.logDe, exog=power.swe, order=(1,0,0), seasonal_order=(0,0,1,12))
-    # sarimaxPower = sarimaxPower.fit(disp=0)
-    # print(sarimaxPower.summary())
-    #
-    # # try with snow year type as exog -> not sig
-    # power['sweAprThirds'] = 1
-    # power.sweAprThirds.loc[power.swe > swe.danApr.quantile(0.67)] = 2
-    # power.sweAprThirds.loc[power.swe < swe.danApr.quantile(0.33)] = 0
-    # sarimaxPower = SARIMAX(power.logDe, exog=power.sweAprThirds, order=(1, 0, 0), seasonal_order=(0, 0, 1, 12))
-    # sarimaxPower = sarimaxPower.fit(disp=0)
-    # print(sarimaxPower.summary())
 
-    ### check stats, plots
-    # plt.plot(sarimaxPower.resid.iloc[12:])
-    # plt.hist(sarimaxPower.resid.iloc[12:])
-    # pd.plotting.autocorrelation_plot(sarimaxPower.resid.iloc[12:])
-    # plot_pacf(sarimaxPower.resid.iloc[12:])
-    # acorr_ljungbox(sarimaxPower.resid.iloc[12:], boxpierce=True, lags=36)
-    # sp.stats.shapiro(sarimaxPower.resid.iloc[12:])
-    # stt.durbin_watson(sarimaxPower.resid.iloc[12:])
-    # plt.plot(sarimaxPower.predict().iloc[12:])
-    # plt.plot(power.logDe.iloc[12:])
-    # plt.scatter(power.wmnth.iloc[12:], sarimaxPower.resid.iloc[12:])
-    # plt.scatter(power.wmnth.iloc[12:], power.logDe.iloc[12:])
+##########################################################################
+######### fit deseasonalized log power price to SARMA (1,0,0)x(0,0,1,12) model ###########
+############## Returns dict of fitted power price model #########################################
+##########################################################################
+
+def fit_power_model(power):
+  # log-transform and deseasonalize
+  power['logMean'] = np.log(power.priceMean)
+  power['logDe'] = np.nan
+  for i in range(1, 13):
+    power.logDe.loc[power.wmnth == i] = (power.logMean.loc[power.wmnth == i] -
+                                         power.logMean.loc[power.wmnth == i].mean()) / \
+                                        power.logMean.loc[power.wmnth == i].std()
+
+  # plt.plot(power.logMean)
+  # plt.plot(power.logDe)
+
+  # # # check for linear trend -> small significant negative trend. ignore since only 7 years of data.
+  # lmPowDeLin = sm.ols(formula='dat ~ ind ',
+  #                   data=pd.DataFrame({'dat': power.logDe, 'ind': range(0, power.shape[0])}))
+  # lmPowDeLin = lmPowDeLin.fit()
+  # print(lmPowDeLin.summary())
+
+  # ### SARIMAX model: iterate over parameters and choose lowest BIC
+  # # # (mod from https://stats.stackexchange.com/questions/328524/choose-seasonal-parameters-for-sarimax-model)
+  # p = d = q = P = D = Q = range(0,2)
+  # pdq = list(itertools.product(p,d,q))
+  # PDQ12 = [(x[0], x[1], x[2], 12) for x in list(itertools.product(P,D,Q))]
+  # BIC = 1000
+  # for param in pdq:
+  #     for paramSeas in PDQ12:
+  #         try:
+  #             sarimaxPower = SARIMAX(power.logDe, order=param, seasonal_order=paramSeas)
+  #             sarimaxPower = sarimaxPower.fit(disp=0)
+  #             if sarimaxPower.bic < 124:
+  #                 print('ARIMA{}x{} - BIC:{}'.format(param, paramSeas, sarimaxPower.bic))
+  #             if sarimaxPower.bic < BIC:
+  #                 BIC = sarimaxPower.bic
+  #                 best_param = param
+  #                 best_paramSeas = paramSeas
+  #         except Exception as e:
+  #             # print(e)
+  #             continue
+  # sarimaxPower = SARIMAX(power.logDe, order=(1,0,0), seasonal_order=(0,0,1,12))
+  # sarimaxPower = sarimaxPower.fit(disp=0)
+  # # print(sarimaxPower.summary())
+
+  # p = q = P = Q = range(0, 2)
+  # pdq = [(x[0], 0, x[1]) for x in list(itertools.product(p, q))]
+  # PDQ12 = [(x[0], 0, x[1], 12) for x in list(itertools.product(P, Q))]
+  # BIC = 1000
+  # for param in pdq:
+  #   for paramSeas in PDQ12:
+  #     try:
+  #       sarimaxPower = SARIMAX(power.logDe, order=param, seasonal_order=paramSeas)
+  #       sarimaxPower = sarimaxPower.fit(disp=0)
+  #       # if ((sarimaxPower.pvalues > 0.05).sum() == 0):
+  #         # if sarimaxPower.bic < 115:
+  #       print('ARIMA{}x{} - BIC:{}'.format(param, paramSeas, sarimaxPower.bic))
+  #       if sarimaxPower.bic < BIC:
+  #         BIC = sarimaxPower.bic
+  #         best_param = param
+  #         best_paramSeas = paramSeas
+  #     except Exception as e:
+  #       # print(e)
+  #       continue
+  sarimaxPower = SARIMAX(power.logDe, order=(1, 0, 0), seasonal_order=(0, 0, 1, 12))
+  sarimaxPower = sarimaxPower.fit(disp=0)
+  # print(sarimaxPower.summary())
+
+
+
+  # # try with sweApr as exogenous factor -> not sig
+  # power['wyr'] = power.index.year
+  # power.wyr.loc[power.wmnth < 4] = power.wyr.loc[power.wmnth < 4] + 1
+  # power['swe'] = np.nan
+  # for i in range(2010, 2018):
+  #     power.swe.loc[power.wyr == i] = swe.danApr[i]
+  # sarimaxPower = SARIMAX(power.logDe, exog=power.swe, order=(1,0,0), seasonal_order=(0,0,1,12))
+  # sarimaxPower = sarimaxPower.fit(disp=0)
+  # print(sarimaxPower.summary())
+  #
+  # # try with snow year type as exog -> not sig
+  # power['sweAprThirds'] = 1
+  # power.sweAprThirds.loc[power.swe > swe.danApr.quantile(0.67)] = 2
+  # power.sweAprThirds.loc[power.swe < swe.danApr.quantile(0.33)] = 0
+  # sarimaxPower = SARIMAX(power.logDe, exog=power.sweAprThirds, order=(1, 0, 0), seasonal_order=(0, 0, 1, 12))
+  # sarimaxPower = sarimaxPower.fit(disp=0)
+  # print(sarimaxPower.summary())
+
+  ### check stats, plots
+  # plt.plot(sarimaxPower.resid.iloc[12:])
+  # plt.hist(sarimaxPower.resid.iloc[12:])
+  # pd.plotting.autocorrelation_plot(sarimaxPower.resid.iloc[12:])
+  # plot_pacf(sarimaxPower.resid.iloc[12:])
+  # acorr_ljungbox(sarimaxPower.resid.iloc[12:], boxpierce=True, lags=36)
+  # sp.stats.shapiro(sarimaxPower.resid.iloc[12:])
+  # stt.durbin_watson(sarimaxPower.resid.iloc[12:])
+  # plt.plot(sarimaxPower.predict().iloc[12:])
+  # plt.plot(power.logDe.iloc[12:])
+  # plt.scatter(power.wmnth.iloc[12:], sarimaxPower.resid.iloc[12:])
+  # plt.scatter(power.wmnth.iloc[12:], power.logDe.iloc[12:])
+
+  # monthly mean & std of log price for reseasonalizing, and last 12 months of log price & resids to start simulation
+  powModel = {'logDeAR1coef': sarimaxPower.params[0], 'logDeMA12coef': sarimaxPower.params[1],
+              'logDeERRSTD': np.std(sarimaxPower.resid),  # np.sqrt(sarimaxPower.params[2])
+              'initialLogDe': power.logDe.iloc[-12:].values, 'initialResid': sarimaxPower.resid.iloc[-12:].values,
+              'logMeanMnth': np.array([power.logMean.loc[power.wmnth == i].mean() for i in range(1, 13)]),
+              'logStdMnth': np.array([power.logMean.loc[power.wmnth == i].std() for i in range(1, 13)])}
+  return (powModel)
 
 
+
+##########################################################################
+######### synthetic power price, based on synth gas price ###########
+############## Returns dataframe monthly power price ($/MWh) #########################################
+##########################################################################
+
+def synthetic_power(dir_generated_inputs, power, redo = False, save = False, chunkYears = None, columns = None,
+                    rows = None):
+  # saved to/read from the data store (columns & rows select part of it when read, see read_synthetic)
+  np.random.seed(SEEDS['power'])
+  if (redo):
+    powModel = fit_power_model(power)
+
     ### Simulate new power prices
-    logDeAR1coef = sarimaxPower.params[0]
-    logDeMA12coef = sarimaxPower.params[1]
-    logDeERRSTD = np.std(sarimaxPower.resid) # np.sqrt(sarimaxPower.params[2])
+    logDeAR1coef = powModel['logDeAR1coef']
+    logDeMA12coef = powModel['logDeMA12coef']
+    logDeERRSTD = powModel['logDeERRSTD']
 
 
-    # Calc random aspects of power sim. Serial calcs in numpy.
+    # Calc random aspects of power sim. SARMA recursion run as linear filter, optionally in chunks of years
+    # (same random stream & filter state carried between chunks, so same result) to bound memory of temporaries.
     burn=4
-    dum = np.full(((N_SAMPLES + burn) * 12, 4), -100.0)
-    dum[:12, 2] = power.logDe.iloc[-12:].values          ## start with oct2015-sep2016, and burn in 2 extra yrs (total 4).
-    dum[:12, 3] = sarimaxPower.resid.iloc[-12:].values
-    for i in range(0, N_SAMPLES + burn):
-      dum[(12 * i):(12 * (i + 1)), 0] = i - burn  # col 0 = wyr
-      dum[(12 * i):(12 * (i + 1)), 1] = [1,2,3,4,5,6,7,8,9,10,11,12]  # col 1 = wmnth
-    dum[12:, 3] = norm.rvs(0, logDeERRSTD, (N_SAMPLES + burn - 1) * 12)  # col 3 = resids from SARMA model -> normal
-    for i in range(12, (N_SAMPLES + burn) * 12):
-      dum[i, 2] = logDeAR1coef * dum[i - 1, 2] + \
-                  logDeMA12coef * dum[i - 12, 3] + \
-                  dum[i, 3]  # # col 2 = deseasonalized log power price
+    nMonths = (N_SAMPLES + burn - 1) * 12
+    chunkMonths = nMonths if chunkYears is None else chunkYears * 12
+    logDe = np.empty(nMonths)   # deseasonalized log power price, after 12 initial months
+    zi = None
+    for start in range(0, nMonths, chunkMonths):
+      stop = min(start + chunkMonths, nMonths)
+      resid = norm.rvs(0, logDeERRSTD, stop - start)  # resids from SARMA model -> normal
+      if (zi is None):
+        ## start with oct2015-sep2016, and burn in 2 extra yrs (total 4).
+        logDe[start:stop], zi = sarma_filter(resid, logDeAR1coef, logDeMA12coef, initialLogDe=powModel['initialLogDe'],
+                                             initialResid=powModel['initialResid'])
+      else:
+        logDe[start:stop], zi = sarma_filter(resid, logDeAR1coef, logDeMA12coef, zi=zi)
 
     # plt.plot(range(84,84+4800),dum[:4800,2])
     # plt.plot(power.logDe.values)
-    dum = dum[(12 * burn):, :]
+    logDe = logDe[(12 * (burn - 1)):].reshape(N_SAMPLES, 12)
 
-    # Set in dataframe and calc rest of sim variables
-    powSynth = pd.DataFrame({'wyr': dum[:, 0], 'wmnth': dum[:, 1], 'logDe': dum[:, 2]})
-
-    powSynth['logPrice'] = np.nan
-    for i in range(1, 13):
-      powSynth.logPrice.loc[powSynth.wmnth == i] = powSynth.logDe.loc[powSynth.wmnth == i] * \
-                                                   power.logMean.loc[power.wmnth == i].std() + \
-                                                   power.logMean.loc[power.wmnth == i].mean()
-
-    powSynth['powPrice'] = np.exp(powSynth.logPrice)
+    # reseasonalize, broadcast over (years, 12). compact container, year & month implicit in layout
+    powSynth = {'powPrice': np.exp(logDe * powModel['logStdMnth'] + powModel['logMeanMnth'])}
 
     ### check stats, plots
     # powSynth.powPrice.mean()
@@ -1126,19 +1391,48 @@ def synthetic_power(dir_generated_inputs, power, redo = False, save = False):
     # power.wyr.loc[power.wmnth < 4] = power.wyr.loc[power.wmnth < 4] + 1
     # print(st.ks_2samp(powSynth.groupby('wyr').mean().powPrice, power.groupby('wyr').mean().priceMean))
 
-    powSynth = powSynth.loc[:, ['wyr', 'wmnth', 'powPrice']]
-
     if (save):
-      powSynth.to_pickle(dir_generated_inputs + 'powSynth.pkl')
+      functions_data_store.write_dataset(dir_generated_inputs + 'store/', 'powSynth', powSynth,
+                                         meta={'seed': SEEDS['power'], 'nSamples': N_SAMPLES,
+                                               'model': functions_data_store.model_meta(powModel)})
 
   else:
-    powSynth = pd.read_pickle(dir_generated_inputs + 'powSynth.pkl')
+    powSynth = read_synthetic(dir_generated_inputs, 'powSynth', columns, rows)
+    if isinstance(powSynth, pd.DataFrame):   # saved by older version as monthly dataframe
+      powSynth = {'powPrice': powSynth.powPrice.values.reshape(-1, 12)}
 
 
   return powSynth
 
 
 
+##########################################################################
+######### monthly dataframe view of compact synthetic gen/power/revenue containers, for plotting & checks ###########
+############## Returns dataframe (years*12 rows) with int wyr & wmnth #########################################
+##########################################################################
+def synthetic_monthly_frame(genSynth = None, powSynth = None, revSim = None, nYears = None):
+  # nYears limits to first years of record, so a view for plotting doesn't need full 12M rows
+  if nYears is None:
+    nYears = min([len(dat[var]) for dat, var in [(genSynth, 'gen'), (powSynth, 'powPrice'), (revSim, 'rev')]
+                  if dat is not None])
+  synthFrame = pd.DataFrame({'wyr': np.repeat(np.arange(nYears), 12), 'wmnth': np.tile(np.arange(1, 13), nYears)})
+  if genSynth is not None:
+    synthFrame['sweFeb'] = np.repeat(genSynth['sweFeb'][:nYears], 12)
+    synthFrame['sweApr'] = np.repeat(genSynth['sweApr'][:nYears], 12)
+    synthFrame['gen'] = genSynth['gen'][:nYears].ravel()
+    if 'genPred' in genSynth:
+      synthFrame['genPred'] = genSynth['genPred'][:nYears].ravel()
+    else:
+      synthFrame['genPred'] = get_generation_prediction(genSynth['sweFeb'][:nYears], genSynth['sweApr'][:nYears],
+                                                        genSynth['genParams']).ravel()
+  if powSynth is not None:
+    synthFrame['powPrice'] = powSynth['powPrice'][:nYears].ravel()
+  if revSim is not None:
+    synthFrame['rev'] = revSim['rev'][:nYears].ravel()
+  return (synthFrame)
+
+
+
 ##########################################################################
 ######### plot historical vs synthetic hydro generation and power prices (fig 4)###########
 ############## Returns figure #########################################
@@ -1148,45 +1442,27 @@ def plot_historical_synthetic_generation_power(dir_figs, gen, genSynth, power, p
   plt.figure()
     
   # plot boxplot of generation for each wmnth
-  gen['sweAprThirds'] = 'average'
-  gen.sweAprThirds.loc[gen.sweApr > gen.sweWt.quantile(0.67)] = 'wet'
-  gen.sweAprThirds.loc[gen.sweApr < gen.sweWt.quantile(0.33)] = 'dry'
   my_palette = {'wet': col[0], 'average': col[2], 'dry': col[3]}
 
-  genSynth['sweAprThirds'] = 'average'
-  genSynth.sweAprThirds.loc[genSynth.sweApr > gen.sweWt.quantile(0.67)] = 'wet'
-  genSynth.sweAprThirds.loc[genSynth.sweApr < gen.sweWt.quantile(0.33)] = 'dry'
-
-  genMonthsDry = pd.DataFrame({'wmnth': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
-                                'meanHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: gen['tot'].loc[(gen['wmnth'] == x) & (gen.sweAprThirds == 'dry')].mean())/1000,
-                                'stdHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: gen['tot'].loc[(gen['wmnth'] == x) & (gen.sweAprThirds == 'dry')].std())/1000,
-                                'meanSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: genSynth['gen'].loc[(genSynth['wmnth'] == x) & (genSynth.sweAprThirds == 'dry')].mean())/1000,
-                                'stdSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: genSynth['gen'].loc[(genSynth['wmnth'] == x) & (genSynth.sweAprThirds == 'dry')].std())/1000,
-                                })
-  genMonthsWet = pd.DataFrame({'wmnth': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
-                                'meanHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: gen['tot'].loc[(gen['wmnth'] == x) & (gen.sweAprThirds == 'wet')].mean())/1000,
-                                'stdHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: gen['tot'].loc[(gen['wmnth'] == x) & (gen.sweAprThirds == 'wet')].std())/1000,
-                                'meanSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: genSynth['gen'].loc[(genSynth['wmnth'] == x) & (genSynth.sweAprThirds == 'wet')].mean())/1000,
-                                'stdSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                  lambda x: genSynth['gen'].loc[(genSynth['wmnth'] == x) & (genSynth.sweAprThirds == 'wet')].std())/1000,
-                                })
-  genMonthsAverage = pd.DataFrame({'wmnth': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
-                                    'meanHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                      lambda x: gen['tot'].loc[(gen['wmnth'] == x) & (gen.sweAprThirds == 'average')].mean())/1000,
-                                    'stdHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                      lambda x: gen['tot'].loc[(gen['wmnth'] == x) & (gen.sweAprThirds == 'average')].std())/1000,
-                                    'meanSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                      lambda x: genSynth['gen'].loc[(genSynth['wmnth'] == x) & (genSynth.sweAprThirds == 'average')].mean())/1000,
-                                    'stdSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                                      lambda x: genSynth['gen'].loc[(genSynth['wmnth'] == x) & (genSynth.sweAprThirds == 'average')].std())/1000,
-                                    })
+  # synthetic wet/avg/dry by year (same thresholds as historical), then monthly stats over (years, 12) arrays.
+  #   historical binned by (third, month), synthetic by third, each from one sort of the bin codes.
+  thirds = ['dry', 'average', 'wet']
+  thirdCodes = lambda sweApr: np.where(sweApr < gen.sweWt.quantile(0.33), 0,
+                                       np.where(sweApr > gen.sweWt.quantile(0.67), 2, 1))
+  genHistStats = functions_binned_stats.binned_stats(
+    thirdCodes(gen.sweApr.values) * 12 + gen.wmnth.values - 1, {'gen': gen['tot'].values}, nBins=36)['gen']
+  genSynthStats = functions_binned_stats.binned_stats(thirdCodes(genSynth['sweApr']), {'gen': genSynth['gen']},
+                                                      nBins=3)['gen']
+
+  genMonths = {}
+  for i, third in enumerate(thirds):
+    genMonths[third] = pd.DataFrame({'wmnth': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
+                                     'meanHist': genHistStats['mean'][(i * 12):((i + 1) * 12)]/1000,
+                                     'stdHist': genHistStats['std'][(i * 12):((i + 1) * 12)]/1000,
+                                     'meanSynth': genSynthStats['mean'][i]/1000,
+                                     'stdSynth': genSynthStats['std'][i]/1000,
+                                     })
+  genMonthsDry, genMonthsWet, genMonthsAverage = genMonths['dry'], genMonths['wet'], genMonths['average']
 
   #  plot monthly ranges with wet-avg-dry separated, std as error bars
   ax = plt.subplot2grid((2,1), (0, 0))
@@ -1231,15 +1507,13 @@ def plot_historical_synthetic_generation_power(dir_figs, gen, genSynth, power, p
             bbox_to_anchor=(1.43, 0.5), loc='right', ncol=1, borderaxespad=0.)
       
   # now plot historical vs synthetic power prices
+  powHistStats = functions_binned_stats.binned_stats(power['wmnth'].values - 1, {'pow': power['priceMean'].values},
+                                                     nBins=12)['pow']
   powMonths = pd.DataFrame({'wmnth': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
-                            'meanHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                              lambda x: power['priceMean'].loc[power['wmnth'] == x].mean()),
-                            'stdHist': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                              lambda x: power['priceMean'].loc[power['wmnth'] == x].std()),
-                            'meanSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                              lambda x: powSynth['powPrice'].loc[powSynth['wmnth'] == x].mean()),
-                            'stdSynth': pd.DataFrame({'dum': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]})['dum'].apply(
-                              lambda x: powSynth['powPrice'].loc[powSynth['wmnth'] == x].std()),
+                            'meanHist': powHistStats['mean'],
+                            'stdHist': powHistStats['std'],
+                            'meanSynth': powSynth['powPrice'].mean(axis=0),
+                            'stdSynth': powSynth['powPrice'].std(axis=0, ddof=1),
                             })
 
   ax = plt.subplot2grid((2,1), (1,0))
@@ -0,0 +1,137 @@
+##############################################################################################################
+### functions_synthetic_stream.py - python functions for generating the synthetic SWE, hydropower generation,
+###     power price, and revenue record in fixed-size blocks of water years, written straight to disk
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import numpy as np
+import json
+from scipy.stats import gamma
+from scipy.special import ndtr, ndtri
+
+import functions_synthetic_data
+import functions_revenues_contracts
+
+
+STREAM_VARIABLES = ['sweFeb', 'sweApr', 'gen', 'genPred', 'pow', 'rev']
+
+# uniforms used per water year by each random stream. multiple of 4, since each philox counter step gives 4 draws,
+#   so that the stream for year i always starts at counter i * UNIFORMS_PER_YEAR / 4, whatever the block size.
+UNIFORMS_PER_YEAR = {'swe': 4, 'gen': 12, 'pow': 12}
+
+GEN_BURN_YEARS = 1    # first 3 months are random initial values, rest of year is burn-in for AR(1,3)
+POW_BURN_YEARS = 3    # starts from last 12 historical months, 3 yrs burn in (as in synthetic_power)
+
+
+
+##########################################################################
+######### deterministic standard normals for water years [startYear, startYear + nYears) of one random stream ###########
+############## Returns array (nYears x nPerYear) #########################################
+##########################################################################
+def block_normals(seedSeq, startYear, nYears, nPerYear):
+  # counter-based philox generator, advanced to the first draw of startYear. so each block of years can be derived
+  #   independently of all others, & a year gets the same draws whether it is simulated in a block of 10 or 10M years.
+  bitGen = np.random.Philox(seedSeq)
+  bitGen.advance(startYear * nPerYear // 4)
+  u = np.random.Generator(bitGen).random((nYears, nPerYear))
+  # shift off zero so u is in the open interval (0,1), then inverse transform to normal
+  return (ndtri(u + 2. ** -54))
+
+
+
+##########################################################################
+######### open .npy file with header for full record, so blocks can be appended as raw data ###########
+############## Returns open file handle #########################################
+##########################################################################
+def open_npy_stream(filename, shape, dtype=np.float64):
+  f = open(filename, 'wb')
+  np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                           'fortran_order': False, 'shape': shape})
+  return (f)
+
+
+
+##########################################################################
+######### stream synthetic swe, gen, power price & revenue in blocks of water years ###########
+############## Writes one .npy file per variable (years, or years x 12 months) plus stream_metadata.json #########################################
+##########################################################################
+def stream_synthetic_data(dir_out, sweModel, genModel, powModel, revParams, nYears, blockYears = 100000, seed = 1,
+                          tabulated = False):
+  # tabulated=True samples swe marginals from the gamma inverse cdf tables (see gamma_ppf_table) instead of gamma.ppf
+  # independent random streams for swe, gen resids & power resids, each from its own child of the seed
+  seedSwe, seedGen, seedPow = np.random.SeedSequence(seed).spawn(3)
+
+  files = {}
+  for var in STREAM_VARIABLES:
+    shape = (nYears,) if var in ['sweFeb', 'sweApr'] else (nYears, 12)
+    files[var] = open_npy_stream(dir_out + var + 'Stream.npy', shape)
+
+  try:
+    ### burn in gen & power filters, stream years -burn..-1, to get filter states going into year 0
+    genInit = block_normals(seedGen, 0, GEN_BURN_YEARS, UNIFORMS_PER_YEAR['gen']).ravel() * genModel['AR_std']
+    genZi = functions_synthetic_data.ar13_filter(genInit[3:], genModel['residAR1_wt'], genModel['residAR3_wt'],
+                                                 initial=genInit[:3])[1]
+    powInit = block_normals(seedPow, 0, POW_BURN_YEARS, UNIFORMS_PER_YEAR['pow']).ravel() * powModel['logDeERRSTD']
+    powZi = functions_synthetic_data.sarma_filter(powInit, powModel['logDeAR1coef'], powModel['logDeMA12coef'],
+                                                  initialLogDe=powModel['initialLogDe'],
+                                                  initialResid=powModel['initialResid'])[1]
+
+    for start in range(0, nYears, blockYears):
+      nBlock = min(blockYears, nYears - start)
+
+      ### swe, from normal copula with gamma marginals
+      z = block_normals(seedSwe, start, nBlock, UNIFORMS_PER_YEAR['swe'])
+      rho = sweModel['corr_norm_equiv']
+      zFeb = z[:, 0]
+      zApr = rho * z[:, 0] + np.sqrt(1 - rho ** 2) * z[:, 1]
+      if (tabulated):
+        tables = functions_synthetic_data.swe_model_ppf_tables(sweModel)
+        sweFeb = functions_synthetic_data.gamma_ppf_tabulated(tables['danFeb'], zFeb)
+        sweApr = functions_synthetic_data.gamma_ppf_tabulated(tables['danApr'], zApr)
+      else:
+        sweFeb = gamma.ppf(ndtr(zFeb), a=sweModel['shp_g_danFeb'], loc=0, scale=sweModel['scl_g_danFeb'])
+        sweApr = gamma.ppf(ndtr(zApr), a=sweModel['shp_g_danApr'], loc=0, scale=sweModel['scl_g_danApr'])
+
+      ### gen, AR(1,3) resids with filter state carried over from previous block
+      innov = block_normals(seedGen, start + GEN_BURN_YEARS, nBlock, UNIFORMS_PER_YEAR['gen']).ravel() * genModel['AR_std']
+      residSDe, genZi = functions_synthetic_data.ar13_filter(innov, genModel['residAR1_wt'], genModel['residAR3_wt'],
+                                                             zi=genZi)
+      genPred, genS = functions_synthetic_data.get_generation_from_residuals(residSDe.reshape(nBlock, 12), sweFeb,
+                                                                             sweApr, genModel['genParams'],
+                                                                             genModel['genMin'], genModel['genMax'])
+
+      ### power price, SARMA with filter state carried over from previous block, then reseasonalize
+      resid = block_normals(seedPow, start + POW_BURN_YEARS, nBlock, UNIFORMS_PER_YEAR['pow']).ravel() * powModel['logDeERRSTD']
+      logDe, powZi = functions_synthetic_data.sarma_filter(resid, powModel['logDeAR1coef'], powModel['logDeMA12coef'],
+                                                           zi=powZi)
+      powPrice = np.exp(logDe.reshape(nBlock, 12) * powModel['logStdMnth'] + powModel['logMeanMnth'])
+
+      ### revenue ($M/mnth)
+      rev = functions_revenues_contracts.revenue_model_milDollars(genS, powPrice / 1000, **revParams)
+
+      block = {'sweFeb': sweFeb, 'sweApr': sweApr, 'gen': genS, 'genPred': genPred, 'pow': powPrice, 'rev': rev}
+      for var in STREAM_VARIABLES:
+        np.ascontiguousarray(block[var], dtype=np.float64).tofile(files[var])
+
+  finally:
+    for var in STREAM_VARIABLES:
+      files[var].close()
+
+  metadata = {'nYears': nYears, 'blockYears': blockYears, 'seed': seed, 'tabulated': tabulated, 'genBurnYears': GEN_BURN_YEARS,
+              'powBurnYears': POW_BURN_YEARS, 'files': {var: var + 'Stream.npy' for var in STREAM_VARIABLES}}
+  with open(dir_out + 'stream_metadata.json', 'w') as f:
+    json.dump(metadata, f, indent=2)
+
+  return (metadata)
+
+
+
+##########################################################################
+######### read streamed synthetic record, memory-mapped by default so nothing is loaded until used ###########
+############## Returns dict of arrays #########################################
+##########################################################################
+def load_streamed_synthetic_data(dir_out, mmap_mode = 'r'):
+  with open(dir_out + 'stream_metadata.json') as f:
+    metadata = json.load(f)
+  synth = {var: np.load(dir_out + fname, mmap_mode=mmap_mode) for var, fname in metadata['files'].items()}
+  return (synth)
@@ -0,0 +1,85 @@
+##############################################################################################################
+### functions_water_year.py - python functions for water-year aggregation of monthly series, as (years x 12)
+###     views rather than loops or groupby over monthly rows
+### Project started May 2017, last update Jan 2020
+##############################################################################################################
+
+import numpy as np
+
+
+
+##########################################################################
+######### monthly series (n,) or (n x k) as (years x 12) or (years x 12 x k). zero-copy reshape if series starts in
+###   water month 1 & has whole years, else a copy with partial years padded by nan ###########
+############## Returns array #########################################
+##########################################################################
+def water_year_view(x, firstMonth = 1):
+  # firstMonth is water month (1 = Oct) of first value. 2-d arrays with 12 columns are taken as (years x 12) already.
+  x = np.asarray(x)
+  if (x.ndim == 2 and x.shape[1] == 12 and firstMonth == 1):
+    return (x)
+  nLead = int(firstMonth) - 1
+  nYears = -(-(nLead + x.shape[0]) // 12)
+  if (nLead == 0 and x.shape[0] == nYears * 12):
+    return (x.reshape((nYears, 12) + x.shape[1:]))
+  padded = np.full((nYears * 12,) + x.shape[1:], np.nan)
+  padded[nLead:(nLead + x.shape[0])] = x
+  return (padded.reshape((nYears, 12) + x.shape[1:]))
+
+
+
+##########################################################################
+######### water-year sums, skipping missing months of partial years ###########
+############## Returns array (years) or (years x k) #########################################
+##########################################################################
+def annual_sum(x, firstMonth = 1):
+  return (month_sum(water_year_view(x, firstMonth)))
+
+
+
+##########################################################################
+######### sum over months (axis 1) of an array already laid out as (years x 12) or (years x 12 x k) ###########
+############## Returns array (years) or (years x k) #########################################
+##########################################################################
+def month_sum(view):
+  # kahan-compensated sum over months, in order & skipping nan, as in pandas groupby sum, so values match it exactly
+  view = view.astype(float, copy=False)
+  total = np.zeros(view.shape[:1] + view.shape[2:])
+  compensation = np.zeros(total.shape)
+  if (not np.isnan(view).any()):
+    # no missing months (synthetic series): same steps in place, without the nan masks
+    y, t = np.empty(total.shape), np.empty(total.shape)
+    for m in range(12):
+      np.subtract(view[:, m], compensation, out=y)
+      np.add(total, y, out=t)
+      np.subtract(t, total, out=compensation)
+      np.subtract(compensation, y, out=compensation)
+      total, t = t, total
+    return (total)
+  for m in range(12):
+    val = view[:, m]
+    y = val - compensation
+    t = total + y
+    compensation = np.where(np.isnan(val), compensation, (t - total) - y)
+    total = np.where(np.isnan(val), total, t)
+  return (total)
+
+
+
+##########################################################################
+######### water-year means over months present ###########
+############## Returns array (years) or (years x k) #########################################
+##########################################################################
+def annual_mean(x, firstMonth = 1):
+  view = water_year_view(x, firstMonth)
+  return (month_sum(view) / np.sum(~np.isnan(view), axis=1))
+
+
+
+##########################################################################
+######### any reduction over months of each water year (e.g. np.nanmax), or over years of each month (monthly=True,
+###   e.g. np.nanstd for monthly variability) ###########
+############## Returns array #########################################
+##########################################################################
+def water_year_reduce(x, func, firstMonth = 1, monthly = False, **kwargs):
+  return (func(water_year_view(x, firstMonth), axis=0 if monthly else 1, **kwargs))
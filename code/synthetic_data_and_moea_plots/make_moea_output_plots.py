@@ -15,6 +15,7 @@ warnings.filterwarnings('ignore')
 
 ### Project functions ###
 import functions_moea_output_plots
+import functions_binary_data
 
 
 
@@ -33,15 +34,18 @@ dir_figs = './figures/'
 
 
 
-# ### get stochastic data
+# ### get stochastic data. memory-mapped binary table if present, else text
 print('Reading in stochastic data..., ', datetime.now() - startTime)
-synthetic_data = pd.read_csv(dir_generated_inputs + 'synthetic_data.txt', sep=' ')
+synthetic_data, synthetic_header = functions_binary_data.load_table(dir_generated_inputs + 'synthetic_data',
+                                                                    dir_generated_inputs + 'synthetic_data.txt', sep=' ')
 
 ### get historical simulation data
-historical_data = pd.read_csv(dir_generated_inputs + 'historical_data.csv', index_col=0, sep=' ')
+historical_data, historical_header = functions_binary_data.load_table(dir_generated_inputs + 'historical_data',
+                                                                      dir_generated_inputs + 'historical_data.csv',
+                                                                      index_col=0, sep=' ')
 
 # ### constants
-meanRevenue = np.mean(synthetic_data.revenue)
+meanRevenue = synthetic_header['MEAN_REVENUE'] if 'MEAN_REVENUE' in synthetic_header else np.mean(synthetic_data.revenue)
 minSnowContract = 0.05
 minMaxFund = 0.05
 nYears=20
@@ -7,7 +7,6 @@ import numpy as np
 import pandas as pd
 import statsmodels.formula.api as sm
 import seaborn as sbn
-import importlib
 from datetime import datetime
 import matplotlib.pyplot as plt
 import warnings
@@ -17,6 +16,14 @@ warnings.filterwarnings('ignore')
 import functions_clean_data
 import functions_synthetic_data
 import functions_revenues_contracts
+import functions_synthetic_stream
+import functions_cache
+import functions_stages
+import functions_water_year
+import functions_binary_data
+import functions_data_store
+import functions_binned_stats
+import functions_density
 
 sbn.set_style('white')
 sbn.set_context('paper', font_scale=1.55)
@@ -27,187 +34,304 @@ startTime = datetime.now()
 dir_downloaded_inputs = './data/downloaded_inputs/'
 dir_generated_inputs = './data/generated_inputs/'
 dir_figs = './figures/'
+dir_cache = dir_generated_inputs + 'cache/'
 
+### pipeline as a graph of stages (run_stages below), each cached under a fingerprint of its code, parameters &
+###   upstream stages: changing a parameter re-runs only the stages that use it & those downstream of them.
+fixedCostFraction = 0.914
+contractParams = {'lambdaRisk': 0.25, 'strikeQuantile': 0.5, 'capQuantile': 0.95}
+TARGETS = None       # stage names to bring up to date, or None for all
+REDO_STAGES = []     # stage names to re-run even if cached
+N_THREADS = 4        # stages computing at once. stages sharing global state (pyplot, np.random) never overlap
+REVENUE_SCENARIOS = False   # add optional stage revenue_scenarios (revenues under each historical year's tariffs)
 
 
-### Get and clean data
-print('Reading in data..., ', datetime.now() - startTime)
-# SWE
-importlib.reload(functions_clean_data)
-swe = functions_clean_data.get_clean_swe(dir_downloaded_inputs)
-
-# hydro generation (GWh/mnth)
-gen = functions_clean_data.get_historical_generation(dir_downloaded_inputs, swe).reset_index()
 
-# wholesale power price ($/MWh), inflation adjusted
-power = functions_clean_data.get_historical_power(dir_downloaded_inputs)
-
-# SFPUC fin year sales and rates
-hp_GWh, hp_dolPerKwh, hp_dolM = functions_clean_data.get_historical_SFPUC_sales()
+### Get and clean data
+def stage_clean_data():
+  # SWE
+  swe = functions_clean_data.get_clean_swe(dir_downloaded_inputs)
+  # hydro generation (GWh/mnth)
+  gen = functions_clean_data.get_historical_generation(dir_downloaded_inputs, swe).reset_index()
+  # wholesale power price ($/MWh), inflation adjusted
+  power = functions_clean_data.get_historical_power(dir_downloaded_inputs)
+  # SFPUC fin year sales and rates
+  hp_GWh, hp_dolPerKwh, hp_dolM = functions_clean_data.get_historical_SFPUC_sales()
+  return ({'swe': swe, 'gen': gen, 'power': power, 'hp_GWh': hp_GWh, 'hp_dolPerKwh': hp_dolPerKwh})
 
 
 
 
 ### Generate synthetic time series
-print('Generating synthetic swe..., ', datetime.now() - startTime)
-importlib.reload(functions_synthetic_data)
-
-# # generate synthetic swe
-sweSynth = functions_synthetic_data.synthetic_swe(dir_generated_inputs, swe, redo = True, save = False)
-
-# # plot historical trends & low-frequency variability for swe/sweSynth (fig S3)
-print('Plotting SWE trends... (fig S3), ', datetime.now() - startTime)
-functions_synthetic_data.plot_swe_trends(swe, sweSynth, dir_figs)
-
-# plot multi-year drought exceedences for swe/sweSynth (fig S4) (note this plot takes about 45 minutes)
-print('Plotting swe multi-year exceedance curves... (fig S4), ', datetime.now() - startTime)
-functions_synthetic_data.plot_swe_exceedence(swe, sweSynth, dir_figs)
-
-### Plot empirical vs synthetic swe copula (Fig S5) - (note this plot takes about 2 hours)
-print('Plotting empirical vs synthetic swe copula (Fig S1)..., ', datetime.now() - startTime)
-functions_synthetic_data.plot_empirical_synthetic_copula_swe(dir_figs, swe, startTime)
+# # fit gamma marginals & copula for swe once, shared (with its cached draws) by swe functions below. generate synthetic swe
+def stage_swe(clean):
+  sweModel = functions_synthetic_data.fit_swe_model(clean['swe'])
+  sweSynth = functions_synthetic_data.synthetic_swe(dir_generated_inputs, clean['swe'], redo = True, save = False,
+                                                    sweModel = sweModel)
+  return ({'sweModel': sweModel, 'sweSynth': sweSynth})
+
+def stage_swe_figures(clean, swe):
+  # # plot historical trends & low-frequency variability for swe/sweSynth (fig S3)
+  print('Plotting SWE trends... (fig S3), ', datetime.now() - startTime)
+  functions_synthetic_data.plot_swe_trends(clean['swe'], swe['sweSynth'], dir_figs, sweModel = swe['sweModel'])
+
+  # plot multi-year drought exceedences for swe/sweSynth (fig S4)
+  print('Plotting swe multi-year exceedance curves... (fig S4), ', datetime.now() - startTime)
+  functions_synthetic_data.plot_swe_exceedence(clean['swe'], swe['sweSynth'], dir_figs)
+
+  ### Plot empirical vs synthetic swe copula (Fig S5)
+  print('Plotting empirical vs synthetic swe copula (Fig S1)..., ', datetime.now() - startTime)
+  # replicates run on a process pool (up to MAX_COPULA_PROCESSES cores), checkpointed so an interrupted run resumes
+  #   where it stopped
+  functions_synthetic_data.plot_empirical_synthetic_copula_swe(dir_figs, clean['swe'], startTime, nProcesses = None,
+                                                               checkpointFile = dir_generated_inputs + 'sweCopulaCheckpoint.npz',
+                                                               sweModel = swe['sweModel'])
 
 
 # # monthly generation, dependent on swe. Will also create fig S2, showing fitted models (gen as fn of swe) for each month.
-print('Generating synthetic hydropower generation..., ', datetime.now() - startTime)
-genSynth = functions_synthetic_data.synthetic_generation(dir_generated_inputs, dir_figs, gen, sweSynth,
-                                                         redo = True, save = False, plot = True)
+def stage_generation(clean, swe):
+  return (functions_synthetic_data.synthetic_generation(dir_generated_inputs, dir_figs, clean['gen'].copy(),
+                                                        swe['sweSynth'], redo = True, save = False, plot = True))
 
 
 # # monthly power price
-print('Generating synthetic power prices..., ', datetime.now() - startTime)
-importlib.reload(functions_synthetic_data)
-powSynth = functions_synthetic_data.synthetic_power(dir_generated_inputs, power, redo = True, save = False)
+def stage_power(clean):
+  return (functions_synthetic_data.synthetic_power(dir_generated_inputs, clean['power'].copy(), redo = True, save = False))
 
 
 
 
 ### Simulate revenues and hedge payouts
 # # monthly revenues for SFPUC model
-print('Generating simulated revenues..., ', datetime.now() - startTime)
-importlib.reload(functions_revenues_contracts)
-revHist, powHistSample, revSim = functions_revenues_contracts.simulate_revenue(dir_generated_inputs, gen, hp_GWh,
-                                                                           hp_dolPerKwh, genSynth, powSynth,
-                                                                           redo = True, save = False)
+def stage_revenue(clean, genSynth, powSynth):
+  gen, hp_GWh = clean['gen'].copy(), clean['hp_GWh'].copy()
+  revHist, powHistSample, revSim = functions_revenues_contracts.simulate_revenue(dir_generated_inputs, gen, hp_GWh,
+                                                                             clean['hp_dolPerKwh'], genSynth, powSynth,
+                                                                             redo = False, save = True)
+  # water-year sums/means as (years x 12) views. historical series start in water month gen.wmnth[0]
+  revenue = {'revHist': revHist, 'revSim': revSim, 'revSimWyr': pd.Series(revSim['revWyr']),
+             'revHistWyr': pd.Series(functions_water_year.annual_sum(revHist.rev.values, revHist.wmnth.iloc[0]),
+                                     index=np.unique(revHist.wyear), name='rev'),
+             'genHistWyr': functions_water_year.annual_sum(gen.tot.values, gen.wmnth.iloc[0]),
+             'powHistWyr': functions_water_year.annual_mean(powHistSample.values, gen.wmnth.iloc[0])}
+  return (revenue)
+
+
+# # optional: rate-structure risk, mean & 5th percentile annual revenue under each historical year's tariffs & demand,
+# #   on the same synthetic draws
+def stage_revenue_scenarios(clean, genSynth, powSynth):
+  revScenarios = functions_revenues_contracts.get_revenue_scenarios(clean['gen'].copy(), clean['hp_GWh'].copy(),
+                                                                    clean['hp_dolPerKwh'])
+  revWyrScenarios = functions_revenues_contracts.revenue_scenario_sweep(genSynth['gen'], powSynth['powPrice'] / 1000,
+                                                                        revScenarios)
+  return (pd.DataFrame({'mean': revWyrScenarios.mean(axis=1), 'q05': np.quantile(revWyrScenarios, 0.05, axis=1)},
+                       index=revScenarios.index))
 
 
 # get index from swe/revenue relationship.
-nYr = int(len(revSim) / 12)
-yrSim = np.full((1, nYr * 12), 0)
-for i in range(1, nYr):
-  yrSim[0, (12 * i):(12 * (i + 1))] = i
-revSimWyr = revSim.groupby(yrSim[0, :(nYr * 12)]).sum()
-revHistWyr = revHist.groupby('wyear').sum()
-genSynthWyr = genSynth.groupby(yrSim[0, :(nYr * 12)]).sum()
-genHistWyr = gen.groupby(yrSim[0, :len(powHistSample)]).sum()
-powSynthWyr = powSynth.groupby(yrSim[0, :(nYr * 12)]).mean()
-powHistWyr = powHistSample.groupby(yrSim[0, :len(powHistSample)]).mean()
-
-lmRevSWE = sm.ols(formula='rev ~ sweFeb + sweApr', data=pd.DataFrame(
-  {'rev': revSimWyr.values, 'sweFeb': sweSynth.danFeb.values,
-   'sweApr': sweSynth.danApr.values}))
-lmRevSWE = lmRevSWE.fit()
-# print(lmRevSWE.summary())
+def stage_swe_index(clean, swe, revenue):
+  sweSynth = swe['sweSynth']
+  lmRevSWE = sm.ols(formula='rev ~ sweFeb + sweApr', data=pd.DataFrame(
+    {'rev': revenue['revSimWyr'].values, 'sweFeb': sweSynth.danFeb.values,
+     'sweApr': sweSynth.danApr.values}))
+  lmRevSWE = lmRevSWE.fit()
+  # print(lmRevSWE.summary())
 
-sweWtParams = [lmRevSWE.params[1]/(lmRevSWE.params[1]+lmRevSWE.params[2]), lmRevSWE.params[2]/(lmRevSWE.params[1]+lmRevSWE.params[2])]
-sweWtSynth = (sweWtParams[0] * sweSynth.danFeb + sweWtParams[1] * sweSynth.danApr)
+  sweWtParams = [lmRevSWE.params[1]/(lmRevSWE.params[1]+lmRevSWE.params[2]), lmRevSWE.params[2]/(lmRevSWE.params[1]+lmRevSWE.params[2])]
+  sweWtSynth = (sweWtParams[0] * sweSynth.danFeb + sweWtParams[1] * sweSynth.danApr)
 
-genSynth['sweWt'] = (sweWtParams[0] * genSynth.sweFeb + sweWtParams[1] * genSynth.sweApr)
-gen['sweWt'] = (sweWtParams[0] * gen.sweFeb + sweWtParams[1] * gen.sweApr)
+  gen = clean['gen'].copy()
+  gen['sweWt'] = (sweWtParams[0] * gen.sweFeb + sweWtParams[1] * gen.sweApr)
 
-
-### fixed cost parameters
-meanRevenue = np.mean(revSimWyr)
-fixedCostFraction =  0.914
+  ### fixed cost parameters
+  meanRevenue = np.mean(revenue['revSimWyr'])
+  return ({'sweWtParams': sweWtParams, 'sweWtSynth': sweWtSynth, 'gen': gen, 'meanRevenue': meanRevenue})
 
 
 ### plots for SWE Feb vs Apr, Swe index vs Generation, & Swe index vs revenues
-importlib.reload(functions_revenues_contracts)
-print('Plotting validation for SWE Feb vs Apr, Swe index vs Generation, & Swe index vs revenues (fig 2)..., ', datetime.now() - startTime)
-functions_revenues_contracts.plot_SweFebApr_SweGen_SweRev(dir_figs, swe, gen, revHist, sweSynth, genSynth, revSim,
-                                                          sweWtParams, meanRevenue, fixedCostFraction, histRev = True)
+def stage_fig2(clean, swe, genSynth, revenue, sweIndex, fixedCostFraction):
+  print('Plotting validation for SWE Feb vs Apr, Swe index vs Generation, & Swe index vs revenues (fig 2)..., ', datetime.now() - startTime)
+  functions_revenues_contracts.plot_SweFebApr_SweGen_SweRev(dir_figs, clean['swe'], sweIndex['gen'], revenue['revHist'],
+                                                            swe['sweSynth'], genSynth, revenue['revSim'],
+                                                            sweIndex['sweWtParams'], sweIndex['meanRevenue'],
+                                                            fixedCostFraction, histRev = True)
 
 
 ### plot comparing historical vs synthetic for hydro generation (as function of wetness) and for power prices
-print('Plotting validation for hydropower generation and power price (fig 3)..., ', datetime.now() - startTime)
-functions_synthetic_data.plot_historical_synthetic_generation_power(dir_figs, gen, genSynth, power, powSynth)
+def stage_fig3(clean, genSynth, powSynth, sweIndex):
+  print('Plotting validation for hydropower generation and power price (fig 3)..., ', datetime.now() - startTime)
+  # wet/avg/dry thresholds from the swe index, added to gen (copy) in stage swe_index
+  functions_synthetic_data.plot_historical_synthetic_generation_power(dir_figs, sweIndex['gen'], genSynth,
+                                                                      clean['power'], powSynth)
 
 
 # payout for swe-based capped contract for differences (cfd), centered around 50th percentile
-# importlib.reload(functions_revenues_contracts)
-print('Generating simulated CFD net payouts..., ', datetime.now() - startTime)
-payoutPutSim = functions_revenues_contracts.snow_contract_payout(dir_generated_inputs, sweWtSynth, contractType='put',
-                                                               lambdaRisk=0.25, strikeQuantile=0.5,
-                                                               redo=False, save = False)
+def stage_payouts(sweIndex, lambdaRisk, strikeQuantile, capQuantile):
+  sweWtSynth = sweIndex['sweWtSynth']
+  payoutPutSim = functions_revenues_contracts.snow_contract_payout(dir_generated_inputs, sweWtSynth, contractType='put',
+                                                                 lambdaRisk=lambdaRisk, strikeQuantile=strikeQuantile,
+                                                                 redo=False, save = True)
+
+  payoutShortCallSim = functions_revenues_contracts.snow_contract_payout(dir_generated_inputs, sweWtSynth,
+                                                                       contractType='shortcall', lambdaRisk=lambdaRisk,
+                                                                       strikeQuantile=strikeQuantile, redo=False, save = True)
 
-payoutShortCallSim = functions_revenues_contracts.snow_contract_payout(dir_generated_inputs, sweWtSynth,
-                                                                     contractType='shortcall', lambdaRisk=0.25,
-                                                                     strikeQuantile=0.5, redo=False, save = False)
+  payoutCfdSim = functions_revenues_contracts.snow_contract_payout(dir_generated_inputs, sweWtSynth, contractType = 'cfd',
+                                                                 lambdaRisk = lambdaRisk, strikeQuantile = strikeQuantile,
+                                                                 capQuantile = capQuantile, redo = False, save = True)
+  return ({'put': payoutPutSim, 'shortcall': payoutShortCallSim, 'cfd': payoutCfdSim})
 
-payoutCfdSim = functions_revenues_contracts.snow_contract_payout(dir_generated_inputs, sweWtSynth, contractType = 'cfd',
-                                                               lambdaRisk = 0.25, strikeQuantile = 0.5,
-                                                               capQuantile = 0.95, redo = False, save = False)
+
+### cfd pricing surface over (lambda, Feb weight, strike quantile, cap quantile), saved & reused while sweSynth unchanged
+def stage_pricing_surface(swe):
+  pricingSurface = functions_revenues_contracts.get_pricing_surface(dir_generated_inputs, swe['sweSynth'], redo = False,
+                                                                   save = True)
+  print('Max held-out interpolation error (capX, capY): ', pricingSurface['maxError_capX'], pricingSurface['maxError_capY'])
+  return (pricingSurface)
 
 
 ### get shift in cfd net payout function based on lambda, relative to baseline payouts with lambda = 0.25. Note, we do put here, since sell_call side of swap uses lambda=0 and will just be a constant shift.
-# read in lambdas from LHC sample
-print('Generating CFD loading shifts for different lambda values in sensitivity analysis..., ', datetime.now() - startTime)
-# read in lambdas from LHC sample
-importlib.reload(functions_revenues_contracts)
-param_list = pd.read_csv(dir_generated_inputs + 'param_LHC_sample.txt', sep=' ',
-                         header=None, names=['c','delta','Delta_fund','Delta_debt','lam'])
-# get premium shift for each lambda in dataset
-lam_params = functions_revenues_contracts.snow_contract_params_lambda(dir_generated_inputs, sweSynth, param_list.lam.values, contractType = 'cfd',
-                                                                      strikeQuantile = 0.5, capQuantile=0.95)
-param_list['lam_capX_2'] = lam_params[:,0]
-param_list['lam_capX_1'] = lam_params[:,1]
-param_list['lam_capX_0'] = lam_params[:,2]
-param_list['lam_capY_2'] = lam_params[:,3]
-param_list['lam_capY_1'] = lam_params[:,4]
-param_list['lam_capY_0'] = lam_params[:,5]
-
-param_list.to_csv(dir_generated_inputs + 'param_LHC_sample_withLamPricing.txt', sep=' ', header=True, index=False)
+def stage_lambda_pricing(swe, pricingSurface, strikeQuantile, capQuantile):
+  # read in lambdas from LHC sample
+  param_list = pd.read_csv(dir_generated_inputs + 'param_LHC_sample.txt', sep=' ',
+                           header=None, names=['c','delta','Delta_fund','Delta_debt','lam'])
+  # get premium shift for each lambda in dataset
+  lam_params = functions_revenues_contracts.snow_contract_params_lambda(dir_generated_inputs, swe['sweSynth'], param_list.lam.values, contractType = 'cfd',
+                                                                        strikeQuantile = strikeQuantile, capQuantile=capQuantile,
+                                                                        surface = pricingSurface)
+  param_list['lam_capX_2'] = lam_params[:,0]
+  param_list['lam_capX_1'] = lam_params[:,1]
+  param_list['lam_capX_0'] = lam_params[:,2]
+  param_list['lam_capY_2'] = lam_params[:,3]
+  param_list['lam_capY_1'] = lam_params[:,4]
+  param_list['lam_capY_0'] = lam_params[:,5]
+
+  param_list.to_csv(dir_generated_inputs + 'param_LHC_sample_withLamPricing.txt', sep=' ', header=True, index=False)
 
 
 # ### get historical swe, gen, power price, revenue, net revenue. Period of record for hydropower = WY 1988-2016
-historical_data = pd.DataFrame({'sweFeb': swe.loc[revHistWyr.index,:].danFeb, 'sweApr': swe.loc[revHistWyr.index,:].danApr})
-historical_data['gen'] = genHistWyr.tot.values/1000
-powHistWyr.index = revHistWyr.index
-historical_data['pow'] = powHistWyr
-historical_data['rev'] = revHistWyr.rev
-
-historical_data.index = np.arange(1988, 2017)
-historical_data.to_csv(dir_generated_inputs + 'historical_data.csv', sep=' ')
+def stage_historical_data(clean, revenue):
+  revHistWyr = revenue['revHistWyr']
+  historical_data = pd.DataFrame({'sweFeb': clean['swe'].loc[revHistWyr.index,:].danFeb, 'sweApr': clean['swe'].loc[revHistWyr.index,:].danApr})
+  historical_data['gen'] = revenue['genHistWyr']/1000
+  historical_data['pow'] = revenue['powHistWyr']
+  historical_data['rev'] = revHistWyr
 
+  historical_data.index = np.arange(1988, 2017)
+  historical_data.to_csv(dir_generated_inputs + 'historical_data.csv', sep=' ')
+  functions_binary_data.save_binary_table(dir_generated_inputs + 'historical_data',
+                                          historical_data.rename_axis('wyear').reset_index(), index = 'wyear')
 
-### plot CFD contract as composite of put contract and short capped call contract
-# importlib.reload(functions_revenues_contracts)
-print('Plotting CFD contract as composite of put contract and short capped call contract (Fig S6)..., ', datetime.now() - startTime)
-functions_revenues_contracts.plot_contract(dir_figs, sweWtSynth, payoutPutSim, payoutShortCallSim, payoutCfdSim,
-                                       lambda_shifts=[0., 0.5], plot_type='composite')
 
+### plot CFD contract as composite of put contract and short capped call contract (fig S6), & with different loadings (fig 4)
+def stage_contract_figures(sweIndex, payouts, pricingSurface):
+  print('Plotting CFD contract as composite of put contract and short capped call contract (Fig S6)..., ', datetime.now() - startTime)
+  functions_revenues_contracts.plot_contract(dir_figs, sweIndex['sweWtSynth'], payouts['put'], payouts['shortcall'],
+                                             payouts['cfd'], lambda_shifts=[0., 0.5], plot_type='composite',
+                                             surface = pricingSurface, wtFeb = sweIndex['sweWtParams'][0])
 
-# ### plot CFD contract with different loadings 
-print('Plotting CFD contract with different loadings (fig 4)..., ', datetime.now() - startTime)
-functions_revenues_contracts.plot_contract(dir_figs, sweWtSynth, payoutPutSim, payoutShortCallSim, payoutCfdSim,
-                                       lambda_shifts=[0., 0.5], plot_type='lambda')
+  print('Plotting CFD contract with different loadings (fig 4)..., ', datetime.now() - startTime)
+  functions_revenues_contracts.plot_contract(dir_figs, sweIndex['sweWtSynth'], payouts['put'], payouts['shortcall'],
+                                             payouts['cfd'], lambda_shifts=[0., 0.5], plot_type='lambda',
+                                             surface = pricingSurface, wtFeb = sweIndex['sweWtParams'][0])
 
 
-### get stats for contracts without reserve, as function of slope 
-print('Plotting CFD contract with different loadings (fig 5)..., ', datetime.now() - startTime)
-functions_revenues_contracts.plot_cfd_slope_effect(dir_figs, sweWtSynth, revSimWyr, payoutCfdSim, meanRevenue, fixedCostFraction)
+### get stats for contracts without reserve, as function of slope
+def stage_fig5(revenue, sweIndex, payouts, fixedCostFraction):
+  print('Plotting CFD contract with different loadings (fig 5)..., ', datetime.now() - startTime)
+  functions_revenues_contracts.plot_cfd_slope_effect(dir_figs, sweIndex['sweWtSynth'], revenue['revSimWyr'], payouts['cfd'],
+                                                     sweIndex['meanRevenue'], fixedCostFraction)
 
 
-### plot of hedged & unhedged revenues in swe bins 
-print('Plotting hedged vs unhedged net revenue (fig 6)..., ', datetime.now() - startTime)
-functions_revenues_contracts.plot_swe_hedged_revenue(dir_figs, sweWtSynth, revSimWyr, payoutCfdSim, meanRevenue, fixedCostFraction)
+### plot of hedged & unhedged revenues in swe bins
+def stage_fig6(revenue, sweIndex, payouts, fixedCostFraction):
+  print('Plotting hedged vs unhedged net revenue (fig 6)..., ', datetime.now() - startTime)
+  # optimization subsample seeded here, so it does not depend on which stages ran before this one
+  np.random.seed(4)
+  functions_revenues_contracts.plot_swe_hedged_revenue(dir_figs, sweIndex['sweWtSynth'], revenue['revSimWyr'],
+                                                       payouts['cfd'], sweIndex['meanRevenue'], fixedCostFraction)
 
 
 ### save data to use as inputs to moea for the current study
-print('Saving synthetic data..., ', datetime.now() - startTime)
-functions_revenues_contracts.save_synthetic_data_moea(dir_generated_inputs, sweSynth, revSimWyr)
-
-print('Finished, ', datetime.now() - startTime)
+def stage_moea_data(swe, revenue):
+  functions_revenues_contracts.save_synthetic_data_moea(dir_generated_inputs, swe['sweSynth'], revenue['revSimWyr'],
+                                                        meta = {'seeds': functions_synthetic_data.SEEDS})
+
+
+
+### run as script only: copula replicate workers (stage swe_figures) import this module without running it
+if __name__ == '__main__':
+  synthetic = [functions_synthetic_data, functions_water_year, functions_binned_stats, functions_data_store]
+  contracts = [functions_revenues_contracts, functions_water_year, functions_binned_stats, functions_density,
+               functions_cache, functions_binary_data, functions_data_store]
+  # stages writing files list them as outputs, so a cached stage is re-run if they are deleted or overwritten
+  figs = lambda *names: [dir_figs + name for name in names]
+  generated = lambda *names: [dir_generated_inputs + name for name in names]
+  stages = [
+    functions_stages.stage('clean_data', stage_clean_data, code = [functions_clean_data],
+                           inputs = functions_stages.files_fingerprint(dir_downloaded_inputs)),
+    functions_stages.stage('swe', stage_swe, ['clean_data'], code = synthetic, shared = ['random']),
+    functions_stages.stage('swe_figures', stage_swe_figures, ['clean_data', 'swe'], code = synthetic,
+                           shared = ['pyplot', 'random'],
+                           outputs = figs('fig_sweTrends.jpg', 'fig_sweExceedance.jpg', 'fig_sweCopula.jpg')),
+    functions_stages.stage('generation', stage_generation, ['clean_data', 'swe'], code = synthetic,
+                           shared = ['pyplot', 'random'], outputs = figs('fig_hydroRegressions.jpg')),
+    functions_stages.stage('power', stage_power, ['clean_data'], code = synthetic, shared = ['random']),
+    functions_stages.stage('revenue', stage_revenue, ['clean_data', 'generation', 'power'], code = contracts),
+    # swe_index calls no project functions, so its own source is all the code it depends on
+    functions_stages.stage('swe_index', stage_swe_index, ['clean_data', 'swe', 'revenue'], code = []),
+    functions_stages.stage('fig2', stage_fig2, ['clean_data', 'swe', 'generation', 'revenue', 'swe_index'],
+                           params = {'fixedCostFraction': fixedCostFraction}, code = contracts, shared = ['pyplot'],
+                           outputs = figs('fig_sweCorrelations.jpg')),
+    functions_stages.stage('fig3', stage_fig3, ['clean_data', 'generation', 'power', 'swe_index'], code = synthetic,
+                           shared = ['pyplot'], outputs = figs('fig_synthGenPower.jpg')),
+    functions_stages.stage('payouts', stage_payouts, ['swe_index'], params = contractParams, code = contracts),
+    functions_stages.stage('pricing_surface', stage_pricing_surface, ['swe'], code = contracts),
+    functions_stages.stage('lambda_pricing', stage_lambda_pricing, ['swe', 'pricing_surface'], code = contracts,
+                           params = {'strikeQuantile': contractParams['strikeQuantile'],
+                                     'capQuantile': contractParams['capQuantile']},
+                           inputs = functions_stages.files_fingerprint(dir_generated_inputs + 'param_LHC_sample.txt'),
+                           outputs = generated('param_LHC_sample_withLamPricing.txt')),
+    functions_stages.stage('historical_data', stage_historical_data, ['clean_data', 'revenue'],
+                           code = [functions_binary_data],
+                           outputs = generated('historical_data.csv', 'historical_data.npy', 'historical_data.json')),
+    functions_stages.stage('contract_figures', stage_contract_figures, ['swe_index', 'payouts', 'pricing_surface'],
+                           code = contracts, shared = ['pyplot'],
+                           outputs = figs('fig_contractComponents.jpg', 'fig_contractLambda.jpg')),
+    functions_stages.stage('fig5', stage_fig5, ['revenue', 'swe_index', 'payouts'], code = contracts,
+                           params = {'fixedCostFraction': fixedCostFraction}, shared = ['pyplot'],
+                           outputs = figs('fig_cfdMarginal.jpg')),
+    functions_stages.stage('fig6', stage_fig6, ['revenue', 'swe_index', 'payouts'], code = contracts,
+                           params = {'fixedCostFraction': fixedCostFraction}, shared = ['pyplot', 'random'],
+                           outputs = figs('fig_sweHedged.jpg')),
+    functions_stages.stage('moea_data', stage_moea_data, ['swe', 'revenue'], code = contracts,
+                           outputs = generated('synthetic_data.txt', 'synthetic_data.npy', 'synthetic_data.json'))]
+
+  if (REVENUE_SCENARIOS):
+    stages.append(functions_stages.stage('revenue_scenarios', stage_revenue_scenarios,
+                                         ['clean_data', 'generation', 'power'], code = contracts))
+
+  results = functions_stages.run_stages(dir_cache, stages, targets = TARGETS, redo = REDO_STAGES, nThreads = N_THREADS,
+                                        startTime = startTime)
+  if ('revenue_scenarios' in results):
+    print('Annual revenue under historical tariffs & demand:\n', results['revenue_scenarios'])
+
+
+  ### optional: stream a longer synthetic record (swe, gen, power price, revenue) straight to disk in blocks of water
+  ###   years, with bounded memory. uses its own random streams, so not the same draws as the record above.
+  N_STREAM_YEARS = 0
+  if (N_STREAM_YEARS > 0):
+    print('Streaming synthetic data..., ', datetime.now() - startTime)
+    clean, sweModel = results['clean_data'], results['swe']['sweModel']
+    genModel = functions_synthetic_data.fit_generation_model(dir_figs, clean['gen'].copy(), plot = False)
+    powModel = functions_synthetic_data.fit_power_model(clean['power'].copy())
+    revParams = functions_revenues_contracts.get_revenue_params(clean['gen'].copy(), clean['hp_GWh'].copy(),
+                                                                clean['hp_dolPerKwh'])
+    functions_synthetic_stream.stream_synthetic_data(dir_generated_inputs, sweModel, genModel, powModel, revParams,
+                                                     N_STREAM_YEARS, blockYears = 100000, seed = 1)
+
+  print(functions_cache.cache_report())
+  print('Finished, ', datetime.now() - startTime)
 
 
 